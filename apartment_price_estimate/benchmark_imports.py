@@ -0,0 +1,73 @@
+"""
+Import-time benchmark of the serving path: the modules app.py needs to answer a request
+
+Runs a fresh interpreter with "python -X importtime", parses its report and fails (exit code 1), if
+* importing the serving modules takes longer than the budget, or
+* one of the heavy modules, that are only needed for training or the model registry, is imported eagerly.
+
+Run from within apartment_price_estimate/:
+python benchmark_imports.py --budget-ms 200
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# modules of the serving path
+SERVING_MODULES = ['inference', 'storage']
+
+# modules that must be imported on first use only, not when importing the serving modules
+LAZY_MODULES = ['mlflow', 'matplotlib', 'pandas', 'sklearn']
+
+
+def measure_import_time(modules, repeat=5):
+    """
+    Import the modules in fresh interpreters and parse the "-X importtime" report of the fastest run.
+
+    :return: (total import time of the modules in µs, list of (nesting depth, module name, cumulative µs))
+    """
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+        entries = []
+        for line in result.stderr.splitlines():
+            # format: "import time: self [us] | cumulative | imported package", nested imports are indented
+            if not line.startswith("import time:") or "imported package" in line:
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            entries.append((depth, name.strip(), int(cumulative)))
+        # the cumulative time of a directly imported module includes all of its sub-imports
+        total = sum(cumulative for depth, name, cumulative in entries if depth == 0 and name in modules)
+        if best is None or total < best[0]:
+            best = (total, entries)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Import-time benchmark of the serving path')
+    parser.add_argument("--budget-ms", type=float, default=200.0, help="maximum import time of the serving path")
+    parser.add_argument("--repeat", type=int, default=5, help="runs, the fastest one counts")
+    args = parser.parse_args()
+
+    total, entries = measure_import_time(SERVING_MODULES, args.repeat)
+    print("slowest imports of the serving path:")
+    for depth, name, cumulative in sorted((e for e in entries if e[0] == 1), key=lambda e: -e[2])[:10]:
+        print(f"{cumulative / 1000:8.1f} ms  {name}")
+    print(f"{total / 1000:8.1f} ms  total for {', '.join(SERVING_MODULES)} (budget {args.budget_ms:.0f} ms)")
+
+    eager = sorted({name for depth, name, cumulative in entries if name.split(".")[0] in LAZY_MODULES})
+    if eager:
+        print(f"FAILED: imported eagerly, but must be imported on first use only: {eager[:10]}")
+        return 1
+    if total / 1000 > args.budget_ms:
+        print("FAILED: import time of the serving path exceeds the budget")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""
+Benchmark of the inference functions: single-row predictions in a loop vs. batch prediction,
+each on the sklearn model and on its CompactLinearModel (which must predict exactly the same)
+
+Run from within apartment_price_estimate/:
+python benchmark_inference.py --rows 500000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import inference as inference
+import training as training
+
+
+def generate_apartments(n_rows, seed=0) -> np.ndarray:
+    """random apartments within the ranges offered by the UI, columns in the order of inference.FEATURE_NAMES"""
+    rng = np.random.default_rng(seed)
+    return np.column_stack([
+        rng.integers(30, 231, n_rows),                       # wohnflaeche
+        rng.integers(2, 17, n_rows) / 2,                     # zimmeranzahl
+        rng.integers(0, 6, n_rows),                          # schlafzimmer
+        rng.integers(1, 4, n_rows),                          # badezimmer
+        rng.integers(0, 2, (n_rows, 4)),                     # aufzug, balkon, denkmalobjekt, parkplatz
+        rng.integers(1, 9, n_rows),                          # energieeffizienzklasse
+    ]).astype(np.float64)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark single-row vs. batch apartment price estimates')
+    parser.add_argument("--rows", type=int, default=500_000, help="apartments valued in batch mode")
+    parser.add_argument("--single-rows", type=int, default=2_000, help="apartments valued one by one")
+    parser.add_argument("--model-file", default="model/lpz_apt_prices_regression_model.lpzm")
+    args = parser.parse_args()
+
+    model = inference.load_model_from_file(args.model_file)
+    if isinstance(model, inference.CompactLinearModel):
+        compact_model = model
+        regression_model = training.regression_model_from_compact_model(compact_model)
+    else:
+        regression_model = model
+        compact_model = inference.compact_model_from_regression_model(regression_model)
+    apartments = generate_apartments(args.rows)
+
+    # the compact model must reproduce the sklearn predictions bit for bit, before any rounding
+    difference = np.abs(compact_model.predict(apartments) - regression_model.predict(apartments)).max()
+    assert difference == 0.0, f"compact model deviates from sklearn model by up to {difference} EUR"
+    print(f"compact model matches sklearn model exactly on {args.rows:,} rows")
+
+    for name, model in (("sklearn", regression_model), ("compact", compact_model)):
+        start = time.perf_counter()
+        single_prices = [inference.predict_price_on_regression_model(model, apartments[i:i + 1])
+                         for i in range(args.single_rows)]
+        single_seconds = (time.perf_counter() - start) / args.single_rows
+
+        start = time.perf_counter()
+        batch_prices = inference.predict_prices_batch(model, apartments)
+        batch_rate = args.rows / (time.perf_counter() - start)
+
+        assert list(batch_prices[:args.single_rows]) == single_prices, "batch and single-row predictions differ"
+        print(f"{name} single-row: {1 / single_seconds:12,.0f} rows/s, {single_seconds * 1e6:8.1f} µs per row")
+        print(f"{name} batch:      {batch_rate:12,.0f} rows/s ({args.rows:,} rows)")
+        print(f"{name} speedup:    {batch_rate * single_seconds:12,.1f}x")
+
+
+if __name__ == '__main__':
+    main()
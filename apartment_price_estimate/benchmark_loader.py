@@ -0,0 +1,71 @@
+"""
+Benchmark of loading and preprocessing the ImmobilienScout24 CampusFile: full load vs. streaming loader,
+and of the out-of-core mode of training.py, which keeps only the sufficient statistics of the offers
+
+Each loader runs in a fresh process, which reports its wall time and peak memory (max RSS).
+Run from within apartment_price_estimate/:
+python benchmark_loader.py --rows 3000000
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import synthetic_data
+
+KEEP_SINCE_YEAR = 2020
+
+
+def run_loader(mode, path):
+    """load and preprocess the file with the given loader, in this process"""
+    import training
+    start = time.perf_counter()
+    if mode == 'full':
+        dataframe = training.load_immo24_offers_from_csv_into_pandas_dataframe(path)
+        dataframe = training.preprocess_immo24_offers(dataframe, keep_since_year=KEEP_SINCE_YEAR)
+    elif mode == 'streaming':
+        dataframe = training.load_immo24_offers_streaming(path, keep_since_year=KEEP_SINCE_YEAR)
+    else:
+        statistics = training.compute_sufficient_statistics_streaming([path], keep_since_year=KEEP_SINCE_YEAR)
+    seconds = time.perf_counter() - start
+    if mode == 'out-of-core':
+        # the number of rows is the entry of the constant column, see training._sufficient_statistics_of_arrays()
+        rows, result_bytes = int(statistics[-2, -2]), statistics.nbytes
+    else:
+        rows, result_bytes = len(dataframe), dataframe.memory_usage(deep=True).sum()
+    # ru_maxrss is in kilobytes on Linux
+    print(json.dumps({'mode': mode, 'seconds': seconds, 'rows': rows,
+                      'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                      'result_mb': result_bytes / 2 ** 20}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark full vs. streaming load of the CampusFile')
+    parser.add_argument("--rows", type=int, default=3_000_000, help="rows of the synthetic CampusFile")
+    parser.add_argument("--file", default="/tmp/synthetic_campusfile.csv", help="synthetic CampusFile to use")
+    parser.add_argument("--run", choices=['full', 'streaming', 'out-of-core'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_loader(args.run, args.file)
+        return
+
+    if not os.path.exists(args.file):
+        print(f"Writing synthetic CampusFile with {args.rows:,} rows to '{args.file}' ...")
+        synthetic_data.write_immo24_csv(args.file, args.rows)
+    print(f"{os.path.getsize(args.file) / 2 ** 20:,.0f} MB in '{args.file}'")
+
+    for mode in ('full', 'streaming', 'out-of-core'):
+        output = subprocess.run([sys.executable, __file__, "--file", args.file, "--run", mode],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{mode:12} {result['seconds']:8.2f} s  peak RSS {result['peak_rss_mb']:8.0f} MB  "
+              f"{result['rows']:,} rows kept ({result['result_mb']:.0f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Benchmark of the near-duplicate detection of near_duplicates.py on millions of synthetic offers
+
+A share of the synthetic offers is relisted: copied with a new obid, a price changed by up to 3 %, a living area
+corrected by up to 0.5 m² and a listing that starts 0 to 3 months after the original ended, like a relisting on
+ImmobilienScout24. Reported per size: seconds, offers per second, the share of relistings found, and the offers
+merged that are no relisting (independent offers with the same features, price and time, which the synthetic data
+has plenty of). The pairwise comparison that blocking replaces is timed on a sample and extrapolated.
+
+Millions of offers are many cities: each --city-size offers get a city of their own (column 'stadt', a block column),
+so the density of offers per city stays that of a large city. With --city-size 0, all offers are in one city, and
+the candidate pairs grow with the square of the offers.
+Run from within apartment_price_estimate/:
+python benchmark_near_duplicates.py --rows 1000000 2000000 4000000
+python benchmark_near_duplicates.py --rows 1000000 2000000 4000000 --city-size 0
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import near_duplicates as near_duplicates
+import synthetic_data as synthetic_data
+import training as training
+
+
+def generate_offers_with_relistings(n_rows, relisted_share=0.05, city_size=200_000, seed=0):
+    """
+    synthetic offers, the last relisted_share of them relistings of random other offers, each city_size offers
+    in a city of their own (column 'stadt'), all in city 0 for city_size 0
+
+    :return: (offers as preprocessed by training.py, row positions of the relistings, row positions of their originals)
+    """
+    rng = np.random.default_rng(seed)
+    n_relisted = int(n_rows * relisted_share)
+    chunks = [synthetic_data.generate_immo24_offers(min(500_000, n_rows - n_relisted - start), seed=seed + i,
+                                                    first_obid=start)
+              for i, start in enumerate(range(0, n_rows - n_relisted, 500_000))]
+    df_offers = pd.concat(chunks, ignore_index=True)
+    df_offers['duplicateid'] = np.nan
+    df_offers['stadt'] = np.arange(len(df_offers)) // city_size if city_size else 0
+    for name in ('adat', 'edat'):
+        df_offers[name] = training._parse_immo24_months(df_offers[name])
+
+    originals = rng.choice(len(df_offers), n_relisted, replace=False)
+    df_relisted = df_offers.iloc[originals].copy()
+    df_relisted['obid'] = np.arange(len(df_offers), len(df_offers) + n_relisted)
+    df_relisted['kaufpreis'] = np.round(df_relisted['kaufpreis'] * rng.uniform(0.97, 1.03, n_relisted), -2)
+    df_relisted['wohnflaeche'] = np.round(df_relisted['wohnflaeche'] + rng.uniform(-0.5, 0.5, n_relisted), 2)
+    duration = df_relisted['edat'].dt.to_period('M').astype(np.int64) - df_relisted['adat'].dt.to_period('M').astype(
+        np.int64)
+    start = df_relisted['edat'] + pd.to_timedelta(rng.integers(0, 4, n_relisted) * 31, unit='D')
+    df_relisted['adat'] = start.dt.to_period('M').dt.to_timestamp()
+    df_relisted['edat'] = (df_relisted['adat'].dt.to_period('M') + duration.to_numpy()).dt.to_timestamp()
+    relisted = np.arange(len(df_offers), len(df_offers) + n_relisted)
+    return pd.concat([df_offers, df_relisted], ignore_index=True), relisted, originals
+
+
+def time_pairwise(df_offers, n_sample=20_000) -> float:
+    """seconds of comparing all pairs of n_sample offers, vectorized per offer"""
+    sample = df_offers.iloc[:n_sample]
+    prices = sample['kaufpreis'].to_numpy(dtype=np.float64)
+    areas = sample['wohnflaeche'].to_numpy(dtype=np.float64)
+    features = sample[near_duplicates.BLOCK_COLUMNS].to_numpy(dtype=np.float64, na_value=-1)
+    started = time.perf_counter()
+    for i in range(len(sample) - 1):
+        low = np.minimum(prices[i + 1:], prices[i])
+        np.flatnonzero((features[i + 1:] == features[i]).all(axis=1)
+                       & (np.abs(areas[i + 1:] - areas[i]) <= near_duplicates.AREA_TOLERANCE)
+                       & (np.maximum(prices[i + 1:], prices[i]) <= low * (1 + near_duplicates.PRICE_TOLERANCE)))
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the near-duplicate detection')
+    parser.add_argument("--rows", type=int, nargs='+', default=[1_000_000, 2_000_000, 4_000_000],
+                        help="offers including the relistings")
+    parser.add_argument("--relisted-share", type=float, default=0.05, help="share of the offers that are relistings")
+    parser.add_argument("--city-size", type=int, default=200_000, help="offers per city, 0: all in one city")
+    parser.add_argument("--pairwise-sample", type=int, default=20_000,
+                        help="offers of the sample the pairwise comparison is timed on")
+    args = parser.parse_args()
+
+    for n_rows in args.rows:
+        df_offers, relisted, originals = generate_offers_with_relistings(n_rows, args.relisted_share, args.city_size)
+        block_columns = near_duplicates.BLOCK_COLUMNS + ['stadt']
+        started = time.perf_counter()
+        df_kept, df_report = near_duplicates.remove_near_duplicate_offers(df_offers, block_columns=block_columns)
+        seconds = time.perf_counter() - started
+        # once more for the share of the time taken by blocking and comparing, and for the clusters
+        started = time.perf_counter()
+        first, second = near_duplicates.find_near_duplicate_pairs(df_offers, block_columns=block_columns)
+        pairs_seconds = time.perf_counter() - started
+        labels = near_duplicates.near_duplicate_clusters(len(df_offers), first, second)
+
+        found = np.mean(labels[relisted] == labels[originals])
+        in_cluster = np.bincount(labels)[labels] > 1
+        in_cluster[relisted] = False
+        in_cluster[originals] = False
+        print(f"{len(df_offers):>10,} offers: {seconds:6.2f} s ({pairs_seconds:.2f} s blocking and pairs, "
+              f"{len(df_offers) / seconds:,.0f} offers/s), {len(first):,} pairs, {len(df_report):,} clusters; "
+              f"relistings found {found:.1%}, other offers merged {in_cluster.sum() / len(df_offers):.1%}")
+
+    n_sample = args.pairwise_sample
+    pairwise_seconds = time_pairwise(df_offers, n_sample)
+    print(f"Pairwise comparison of {n_sample:,} offers: {pairwise_seconds:.2f} s, extrapolated to "
+          f"{len(df_offers):,} offers: {pairwise_seconds * (len(df_offers) / n_sample) ** 2 / 3600:,.1f} h")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark of inference.ModelRegistry with hundreds of region models: latency of cold loads and of resident models,
+evictions under a memory budget and the memory the resident models take
+
+The region models are copies of the Leipzig model with perturbed coefficients, requested with Zipf-distributed
+popularity like the cities of a real deployment: few large cities take most requests.
+Run from within apartment_price_estimate/:
+python benchmark_registry.py --regions 500 --requests 200000 --memory-mb 0.1
+python benchmark_registry.py --regions 500 --format lpzm --memory-mb 0.1
+python benchmark_registry.py --regions 500 --format pickle --memory-mb 4
+"""
+
+import argparse
+import copy
+import json
+import os
+import pickle
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+import inference as inference
+import training as training
+from benchmark_inference import generate_apartments
+
+
+def write_region_models(model_dir, n_regions, model_format, base_model_file, seed=0) -> list:
+    """write n_regions perturbed copies of the base model to model_dir, return their region keys"""
+    rng = np.random.default_rng(seed)
+    compact_model = inference.load_model_from_file(base_model_file, compact=True)
+    regression_model = training.regression_model_from_compact_model(compact_model)
+    regions = [f'region-{i:04d}' for i in range(n_regions)]
+    for region in regions:
+        scale = rng.uniform(0.5, 1.5)
+        if model_format == 'json':
+            model_dict = compact_model.to_dict()
+            model_dict['coef'] = (compact_model.coef * scale).tolist()
+            with open(os.path.join(model_dir, f'{region}.json'), 'w') as model_file:
+                json.dump(model_dict, model_file)
+        elif model_format == 'lpzm':
+            region_model = inference.CompactLinearModel(compact_model.coef * scale, compact_model.intercept,
+                                                        compact_model.imputer_means, compact_model.feature_names,
+                                                        compact_model.covariance, compact_model.residual_variance)
+            inference.save_model_artifact(region_model, os.path.join(model_dir, f'{region}.lpzm'))
+        else:
+            region_model = copy.deepcopy(regression_model)
+            linear_model = region_model[-1] if hasattr(region_model, 'named_steps') else region_model
+            linear_model.coef_ = linear_model.coef_ * scale
+            with open(os.path.join(model_dir, f'{region}.pickle'), 'wb') as model_file:
+                pickle.dump(region_model, model_file, protocol=pickle.HIGHEST_PROTOCOL)
+    return regions
+
+
+def _max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the model registry with many region models')
+    parser.add_argument("--regions", type=int, default=500, help="region models on disk")
+    parser.add_argument("--requests", type=int, default=200_000, help="predictions, each for a Zipf-chosen region")
+    parser.add_argument("--zipf", type=float, default=1.2, help="exponent of the region popularity")
+    parser.add_argument("--memory-mb", type=float, default=64, help="memory budget of the registry")
+    parser.add_argument("--format", choices=['json', 'lpzm', 'pickle'], default='json',
+                        help="json: compact models, lpzm: model artifacts, pickle: sklearn models served as they are")
+    parser.add_argument("--model-file", default="model/lpz_apt_prices_regression_model.lpzm")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    apartments = generate_apartments(1000)
+    with tempfile.TemporaryDirectory() as model_dir:
+        regions = write_region_models(model_dir, args.regions, args.format, args.model_file)
+        registry = inference.ModelRegistry(model_dir=model_dir, memory_budget=int(args.memory_mb * 1024 * 1024),
+                                           use_model_store=False, compact=args.format != 'pickle')
+        ranks = rng.zipf(args.zipf, args.requests * 2)
+        requested = ranks[ranks <= len(regions)][:args.requests] - 1
+
+        rss_before = _max_rss_mb()
+        cold, warm = [], []
+        for i, region_index in enumerate(requested):
+            region = regions[region_index]
+            resident = registry.resident(region)
+            start = time.perf_counter()
+            registry.predict_price(region, apartments[i % len(apartments):i % len(apartments) + 1])
+            (warm if resident else cold).append(time.perf_counter() - start)
+        rss_after = _max_rss_mb()
+
+    stats = registry.stats()
+    print(f"{len(requested):,} requests over {len(regions)} {args.format} region models, "
+          f"{len(np.unique(requested))} distinct regions requested, budget {args.memory_mb:g} MB")
+    for name, latencies in (('resident', warm), ('cold load', cold)):
+        if latencies:
+            p50, p99 = np.percentile(np.asarray(latencies) * 1e6, [50, 99])
+            print(f"{name:10}: {len(latencies):9,} requests, latency p50 {p50:8.1f} us, p99 {p99:8.1f} us")
+    print(f"hits {stats['hits']:,}, loads {stats['loads']:,}, evictions {stats['evictions']:,}, "
+          f"{stats['load_seconds_total']:.2f} s loading")
+    print(f"resident: {stats['resident_models']} models, {stats['resident_bytes'] / 1024:,.0f} KiB estimated, "
+          f"{stats['resident_bytes'] / max(stats['resident_models'], 1):,.0f} bytes per model")
+    print(f"max RSS: {rss_before:,.0f} MB before, {rss_after:,.0f} MB after")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Load test of the HTTP service of service.py: latency percentiles and throughput under concurrent clients
+
+Without --url, a local service is started with the given number of workers and stopped afterwards.
+Each client process keeps --concurrency requests in flight for --duration seconds.
+Run from within apartment_price_estimate/:
+python benchmark_service.py --workers 2 --clients 2 --concurrency 32 --duration 10
+python benchmark_service.py --url http://localhost:8080 --batch 100
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import inference as inference
+from benchmark_inference import generate_apartments
+
+
+def request_bodies(batch, n_bodies=1000, seed=0) -> list:
+    """JSON bodies of random apartments: single apartments for batch=1, else batches for /estimates"""
+    apartments = [dict(zip(inference.FEATURE_NAMES, row)) for row in generate_apartments(n_bodies * batch, seed)
+                  .tolist()]
+    if batch == 1:
+        return [json.dumps(apartment) for apartment in apartments]
+    return [json.dumps({'apartments': apartments[i:i + batch]}) for i in range(0, len(apartments), batch)]
+
+
+async def _run_client(url, bodies, concurrency, duration):
+    from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def worker(offset):
+        nonlocal errors
+        i = offset
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                await client.fetch(url, method='POST', body=bodies[i % len(bodies)],
+                                   headers={'Content-Type': 'application/json'})
+            except (HTTPClientError, OSError):
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+            i += concurrency
+
+    await asyncio.gather(*(worker(offset) for offset in range(concurrency)))
+    client.close()
+    return latencies, errors
+
+
+def run_client(url, batch, concurrency, duration, seed):
+    """one client process: keep concurrency requests in flight, return latencies in seconds and the error count"""
+    bodies = request_bodies(batch, seed=seed)
+    return asyncio.run(_run_client(url, bodies, concurrency, duration))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_local_service(workers, max_delay_ms, timeout=60.0):
+    """start service.py in a subprocess, wait until it is ready; returns process and base URL"""
+    port = _free_port()
+    process = subprocess.Popen([sys.executable, 'service.py', '--port', str(port), '--address', '127.0.0.1',
+                                '--workers', str(workers), '--max-delay-ms', str(max_delay_ms)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"service exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(base_url + '/readyz', timeout=1) as response:
+                if response.status == 200:
+                    return process, base_url
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"service not ready within {timeout:.0f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the apartment price estimate HTTP service')
+    parser.add_argument("--url", help="base URL of a running service, default: start a local one")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the local service")
+    parser.add_argument("--max-delay-ms", type=float, default=2.0, help="batching window of the local service")
+    parser.add_argument("--clients", type=int, default=1, help="client processes")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight per client process")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--batch", type=int, default=1, help="apartments per request, 1: POST /estimate")
+    args = parser.parse_args()
+
+    process = None
+    base_url = args.url
+    if base_url is None:
+        process, base_url = start_local_service(args.workers, args.max_delay_ms)
+    url = base_url.rstrip('/') + ('/estimate' if args.batch == 1 else '/estimates')
+    try:
+        with ProcessPoolExecutor(max_workers=args.clients) as pool:
+            futures = [pool.submit(run_client, url, args.batch, args.concurrency, args.duration, seed)
+                       for seed in range(args.clients)]
+            results = [future.result() for future in futures]
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    latencies = np.concatenate([np.asarray(client_latencies) for client_latencies, _ in results]) * 1000
+    errors = sum(client_errors for _, client_errors in results)
+    if len(latencies) == 0:
+        print(f"No successful requests, {errors:,} errors.")
+        return
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    print(f"{url}: {args.clients} client(s) x {args.concurrency} in flight, {args.batch} apartment(s) per request")
+    print(f"requests:    {len(latencies):12,} ok, {errors:,} errors in {args.duration:.0f} s")
+    print(f"throughput:  {len(latencies) / args.duration:12,.0f} requests/s, "
+          f"{len(latencies) * args.batch / args.duration:,.0f} apartments/s")
+    print(f"latency ms:  p50 {p50:.2f}, p90 {p90:.2f}, p99 {p99:.2f}, max {latencies.max():.2f}")
+
+
+if __name__ == '__main__':
+    main()
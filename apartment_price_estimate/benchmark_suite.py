@@ -0,0 +1,249 @@
+"""
+End-to-end benchmark suite of the hot paths, with results as JSON to compare across commits
+
+Benchmarks, each on synthetic CampusFiles of the given sizes (see synthetic_data.py, with the sentinel values of the
+real data), repeated and reported as minimum and median:
+* load_csv:        training.load_immo24_offers_from_csv_into_pandas_dataframe()
+* preprocess:      training.preprocess_immo24_offers()
+* train:           training.train_regression_model()
+* predict_single:  inference.predict_price_on_regression_model(), one apartment per call, sklearn and compact model
+* predict_batch:   inference.predict_prices_batch(), sklearn and compact model
+* feedback:        the submit of app.py: storage.feedback_record() and one shard written by
+                   storage.put_feedback_shard(), then the log read back by storage.get_feedback_dataframe(),
+                   against a local S3 stand-in:
+                   --s3-endpoint (e.g. a local MinIO), else an in-process moto server if moto is installed
+
+Run from within apartment_price_estimate/:
+python benchmark_suite.py --rows 20000 200000 --output benchmark_results.json
+python benchmark_suite.py --rows 20000 200000 --compare benchmark_results.json --output new.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import inference as inference
+import synthetic_data as synthetic_data
+import training as training
+from benchmark_inference import generate_apartments
+from benchmark_service import _free_port
+
+KEEP_SINCE_YEAR = 2020
+
+# bucket of the feedback benchmark on the S3 stand-in
+BENCHMARK_BUCKET = 'benchmark'
+
+
+def measure(function, repeat) -> dict:
+    """run function repeat times, return min and median seconds and the result of the last run"""
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    return {'seconds_min': min(seconds), 'seconds_median': float(np.median(seconds)), 'repeat': repeat,
+            'result': result}
+
+
+def _entry(name, size, rows, measurement, **extra) -> dict:
+    """result of one benchmark: size is the row count of its CampusFile, the key for comparisons with name"""
+    entry = {'name': name, 'size': size, 'rows': rows, 'seconds_min': measurement['seconds_min'],
+             'seconds_median': measurement['seconds_median'], 'repeat': measurement['repeat']}
+    if rows:
+        entry['rows_per_second'] = rows / measurement['seconds_min']
+    entry.update(extra)
+    return entry
+
+
+def benchmark_pipeline(path, n_rows, repeat, single_calls) -> list:
+    """load, preprocess, train and predict on one synthetic CampusFile"""
+    results = []
+    load = measure(lambda: training.load_immo24_offers_from_csv_into_pandas_dataframe(path), repeat)
+    results.append(_entry('load_csv', n_rows, n_rows, load))
+
+    df_raw = load['result']
+    preprocess = measure(lambda: training.preprocess_immo24_offers(df_raw.copy(), keep_since_year=KEEP_SINCE_YEAR),
+                         repeat)
+    df_offers = preprocess['result']
+    results.append(_entry('preprocess', n_rows, n_rows, preprocess, rows_kept=len(df_offers)))
+
+    # train_regression_model() prints its results, which would drown the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        train = measure(lambda: training.train_regression_model(df_offers), repeat)
+    regression_model = train['result']
+    results.append(_entry('train', n_rows, len(df_offers), train))
+
+    compact_model = inference.compact_model_from_regression_model(regression_model)
+    apartments = generate_apartments(max(n_rows, single_calls))
+    for model_name, model in (('sklearn', regression_model), ('compact', compact_model)):
+        rows = apartments[:single_calls]
+        single = measure(lambda: [inference.predict_price_on_regression_model(model, rows[i:i + 1])
+                                  for i in range(single_calls)], repeat)
+        results.append(_entry(f'predict_single_{model_name}', n_rows, single_calls, single,
+                              us_per_call=single['seconds_min'] / single_calls * 1e6))
+        batch = measure(lambda: inference.predict_prices_batch(model, apartments[:n_rows]), repeat)
+        results.append(_entry(f'predict_batch_{model_name}', n_rows, n_rows, batch))
+    return results
+
+
+@contextlib.contextmanager
+def s3_stand_in(endpoint):
+    """
+    client of a local S3 stand-in: the server at endpoint, else an in-process moto server
+
+    :return: MinIO client, None if no stand-in is available
+    """
+    import storage as storage
+
+    # the stand-ins accept any credentials
+    os.environ.setdefault('ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    server = None
+    if endpoint is None:
+        try:
+            from moto.server import ThreadedMotoServer
+        except ImportError:
+            yield None
+            return
+        # the request log of moto's server would drown the report
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        port = _free_port()
+        server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+        server.start()
+        endpoint = f'127.0.0.1:{port}'
+    try:
+        yield storage.create_client(endpoint, secure=False)
+    finally:
+        if server is not None:
+            server.stop()
+
+
+def benchmark_feedback(client, repeat, records=200) -> list:
+    """round trips of single feedback records as submitted by app.py, then reading back the feedback log"""
+    import storage as storage
+
+    def clear_bucket():
+        # reading back the log must always find the records of one round, not those of earlier rounds or runs
+        for stale_object in client.list_objects(BENCHMARK_BUCKET, recursive=True):
+            client.remove_object(BENCHMARK_BUCKET, stale_object.object_name)
+
+    if not client.bucket_exists(BENCHMARK_BUCKET):
+        client.make_bucket(BENCHMARK_BUCKET)
+    apartment = {'kaufpreis': 185_000, 'wohnflaeche': 75, 'zimmeranzahl': 3.0, 'schlafzimmer': 1, 'badezimmer': 1,
+                 'aufzug': 0, 'balkon': 0, 'denkmalobjekt': 0, 'parkplatz': 1, 'energieeffizienzklasse': 4}
+
+    def submit_records():
+        for i in range(records):
+            record = storage.feedback_record(dict(apartment, session_id=f'benchmark-{i}'))
+            storage.put_feedback_shard(client, [record], bucket=BENCHMARK_BUCKET)
+
+    submit = measure(submit_records, repeat)
+    clear_bucket()
+    submit_records()
+    read = measure(lambda: storage.get_feedback_dataframe(client, bucket=BENCHMARK_BUCKET), repeat)
+    clear_bucket()
+    return [_entry('feedback_submit', None, records, submit, ms_per_record=submit['seconds_min'] / records * 1000),
+            _entry('feedback_read_log', None, len(read['result']), read)]
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> dict:
+    """commit, interpreter, library versions and machine of a run, to tell apart results that are not comparable"""
+    import pandas
+    import sklearn
+    return {'commit': _git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'pandas': pandas.__version__, 'sklearn': sklearn.__version__, 'machine': platform.machine(),
+            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+
+def compare(results, baseline_results, threshold) -> list:
+    """
+    print the ratio of the times to a baseline run
+
+    :return: names of the benchmarks more than threshold times slower than the baseline
+    """
+    baseline = {(entry['name'], entry['size']): entry for entry in baseline_results}
+    regressions = []
+    print(f"{'benchmark':28} {'rows':>10} {'baseline s':>12} {'now s':>12} {'ratio':>7}")
+    for entry in results:
+        old = baseline.get((entry['name'], entry['size']))
+        if old is None:
+            continue
+        ratio = entry['seconds_min'] / old['seconds_min']
+        flag = '  slower' if ratio > threshold else ''
+        print(f"{entry['name']:28} {entry['rows']:>10,} {old['seconds_min']:12.4f} {entry['seconds_min']:12.4f} "
+              f"{ratio:7.2f}{flag}")
+        if ratio > threshold:
+            regressions.append(entry['name'] if entry['size'] is None else f"{entry['name']}@{entry['size']}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='End-to-end benchmark suite of load, train, predict and feedback')
+    parser.add_argument("--rows", type=int, nargs='+', default=[20_000, 200_000], help="sizes of the CampusFiles")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the fastest one counts")
+    parser.add_argument("--single-calls", type=int, default=2_000, help="calls of the single-apartment predict")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument("--s3-endpoint", help="host:port of a local S3 stand-in, e.g. MinIO, default: moto")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write the results to")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="with --compare: exit with 1 if a benchmark is this many times slower")
+    args = parser.parse_args()
+
+    results = []
+    data_dir = tempfile.mkdtemp(prefix='benchmark-suite-')
+    try:
+        for n_rows in args.rows:
+            path = os.path.join(data_dir, f'campusfile-{n_rows}.csv')
+            synthetic_data.write_immo24_csv(path, n_rows, seed=args.seed)
+            results += benchmark_pipeline(path, n_rows, args.repeat, args.single_calls)
+            os.remove(path)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    with s3_stand_in(args.s3_endpoint) as client:
+        if client is None:
+            print("No S3 stand-in: pass --s3-endpoint or install moto[server], skipping the feedback benchmark.")
+        else:
+            results += benchmark_feedback(client, args.repeat)
+
+    for entry in results:
+        rate = f"{entry['rows_per_second']:14,.0f} rows/s" if 'rows_per_second' in entry else ''
+        print(f"{entry['name']:28} {entry['rows']:>10,} rows  {entry['seconds_min']:9.4f} s  {rate}")
+
+    with open(args.output, 'w') as output_file:
+        json.dump({'environment': environment(), 'arguments': vars(args), 'results': results}, output_file,
+                  indent=2)
+    print(f"Results written to '{args.output}'.")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file)['results'], args.threshold)
+        if regressions:
+            print(f"Slower than the baseline by more than {args.threshold}x: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+Diagnostics plots of the training data, rendered headless off the critical path of training.py
+
+The plots of the input data (price against each feature, price distributions per flag) are rendered by a pool of
+worker processes with the non-interactive Agg backend and written as PNG files to docs/plots/, see plots.md.
+Training goes on while they render, start_diagnostics() returns at once.
+
+* The columns are written once to .npy files and opened by every worker as read-only memory map, like in sweep.py.
+* The plots are skipped if the data hash (and DIAGNOSTICS_VERSION) is the same as for the PNG files on disk.
+* Scatter plots of more than max_scatter_points offers show a hexbin density (continuous features) or a random
+  sample (discrete features), as millions of markers take long to render and hide the distribution anyway.
+
+Run from within apartment_price_estimate/ to render the plots of the cached training data without training:
+python diagnostics.py
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# directory of the PNG files, linked from plots.md
+PLOT_DIR = '../docs/plots'
+
+# data hash and version of the PNG files in PLOT_DIR
+PLOT_STAMP_FILE = '.plots.json'
+
+# bump when the plots change, to render them again for unchanged data
+DIAGNOSTICS_VERSION = 1
+
+# offers above which scatter plots are reduced to a hexbin density or a random sample
+MAX_SCATTER_POINTS = 50_000
+
+# columns of the offers used by the plots
+PLOT_COLUMNS = ['kaufpreis', 'wohnflaeche', 'zimmeranzahl', 'schlafzimmer', 'badezimmer', 'aufzug', 'balkon',
+                'denkmalobjekt', 'parkplatz', 'energieeffizienzklasse']
+
+# file name -> price against a feature:         ('scatter', feature, title, x label, x limits, hexbin if large)
+#              price distribution per flag:     ('hist', flag, title, labels of flag 0 and 1)
+PLOTS = {
+    'kaufpreis-wohnflaeche': ('scatter', 'wohnflaeche', "Kaufpreis zu Wohnfläche", "Wohnfläche (m²)", (0, 225),
+                              True),
+    'kaufpreis-zimmeranzahl': ('scatter', 'zimmeranzahl', "Kaufpreis zu Zimmeranzahl", "Zimmeranzahl (Räume)", (0, 9),
+                               False),
+    'kaufpreis-schlafzimmer': ('scatter', 'schlafzimmer', "Kaufpreis zu Anz Schlafzimmer",
+                               "Schlafzimmeranzahl (Räume)", (-0.5, 5.5), False),
+    'kaufpreis-badezimmer': ('scatter', 'badezimmer', "Kaufpreis zu Anz Badezimmer", "Bäderanzahl (Räume)", (0, 3.5),
+                             False),
+    'verteilung-kaufpreis-aufzug': ('hist', 'aufzug', "Verteilung Preis für Aufzug",
+                                    ("Kein Aufzug", "Aufzug vorhanden")),
+    'verteilung-kaufpreis-balkon': ('hist', 'balkon', "Verteilung Preis für Balkon",
+                                    ("Kein Balkon", "Balkon vorhanden")),
+    'verteilung-kaufpreis-denkmal': ('hist', 'denkmalobjekt', "Verteilung Preis für Denkmalobjekt",
+                                     ("Kein Denkmalobjekt", "Denkmalobjekt")),
+    'verteilung-kaufpreis-parkplatz': ('hist', 'parkplatz', "Verteilung Preis für Parkplatz",
+                                       ("Kein Parkplatz", "Parkplatz vorhanden")),
+    'kaufpreis-energieeffizienzklasse': ('scatter', 'energieeffizienzklasse', "Kaufpreis zu Energieeffizienzklasse",
+                                         "Energieeffizienzklasse (1=A, 8=H)", (0, 8.5), False),
+}
+
+
+def data_hash(columns) -> str:
+    """sha256 of the plotted columns, see start_diagnostics()"""
+    checksum = hashlib.sha256(f"{DIAGNOSTICS_VERSION}:{len(columns)}".encode('utf-8'))
+    for column in columns:
+        checksum.update(np.ascontiguousarray(column, dtype=np.float64).data)
+    return checksum.hexdigest()
+
+
+def _plots_up_to_date(plot_dir, key) -> bool:
+    try:
+        with open(os.path.join(plot_dir, PLOT_STAMP_FILE)) as stamp_file:
+            stamp = json.load(stamp_file)
+    except (OSError, ValueError):
+        return False
+    return stamp.get('data_hash') == key and all(os.path.exists(os.path.join(plot_dir, f'{name}.png'))
+                                                 for name in PLOTS)
+
+
+def render_plot(name, data_dir, plot_dir, keep_since_year, max_scatter_points=MAX_SCATTER_POINTS) -> float:
+    """
+    render one plot of PLOTS to plot_dir/<name>.png, in a worker process
+
+    :param data_dir: directory with one .npy file per column of PLOT_COLUMNS
+    :param keep_since_year: offers have been cut off before that year, used for labels in charts only
+    :return: seconds taken
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    started = time.perf_counter()
+    kind, feature, title = PLOTS[name][:3]
+    prices = np.load(os.path.join(data_dir, 'kaufpreis.npy'), mmap_mode='r')
+    values = np.load(os.path.join(data_dir, f'{feature}.npy'), mmap_mode='r')
+    title = f"{title} (ImmobilienScout24 für Wohnungen in Leipzig ab {keep_since_year})"
+
+    fig, ax = plt.subplots(figsize=(10, 6))
+    if kind == 'scatter':
+        x_label, x_limits, hexbin = PLOTS[name][3:]
+        if len(prices) <= max_scatter_points:
+            ax.scatter(x=values, y=prices)
+        elif hexbin:
+            observed = np.isfinite(values)
+            ax.hexbin(values[observed], prices[observed], gridsize=80, bins='log', mincnt=1,
+                      extent=(*x_limits, 0, 1.5e6))
+            title += f"\nDichte von {len(prices):,} Angeboten"
+        else:
+            sample = np.sort(np.random.default_rng(0).choice(len(prices), max_scatter_points, replace=False))
+            ax.scatter(x=values[sample], y=prices[sample], s=4, alpha=0.3)
+            title += f"\nStichprobe von {max_scatter_points:,}"
+        ax.set_xlabel(x_label)
+        ax.set_xlim(x_limits)
+        ax.set_ylim([0, 1.5e6])
+        ax.set_ylabel("Kaufpreis (Mio EUR)")
+    else:
+        labels = PLOTS[name][3]
+        n_bins = 100
+        ax.hist(prices[values == 0], bins=n_bins, alpha=0.5, label=labels[0])
+        ax.hist(prices[values == 1], bins=n_bins, alpha=0.5, label=labels[1])
+        ax.set_xlabel("Kaufpreis (Mio EUR)")
+        ax.set_ylabel("Anzahl Wohnungen")
+        ax.legend(loc='upper right')
+    ax.set_title(title)
+
+    # the PNG becomes visible only when it is complete
+    file_name = os.path.join(plot_dir, f'{name}.png')
+    fig.savefig(f'{file_name}.tmp', dpi=100, format='png')
+    plt.close(fig)
+    os.replace(f'{file_name}.tmp', file_name)
+    return time.perf_counter() - started
+
+
+class DiagnosticsJob:
+    """plots rendering in the background, see start_diagnostics()"""
+
+    def __init__(self, pool, futures, data_dir, plot_dir, key):
+        self._pool = pool
+        self._futures = futures
+        self._data_dir = data_dir
+        self._plot_dir = plot_dir
+        self._key = key
+        self._started = time.perf_counter()
+
+    def wait(self) -> dict:
+        """
+        wait until all plots are written, then mark them as up to date for their data hash
+
+        :return: dict of plot name -> seconds taken to render it
+        :raises Exception: of the first plot that failed, the data hash is not written then
+        """
+        try:
+            seconds = {name: future.result() for name, future in self._futures.items()}
+        finally:
+            self._pool.shutdown()
+            shutil.rmtree(self._data_dir, ignore_errors=True)
+        with open(os.path.join(self._plot_dir, PLOT_STAMP_FILE), 'w') as stamp_file:
+            json.dump({'data_hash': self._key, 'plots': sorted(seconds)}, stamp_file, indent=2)
+        print(f"Rendered {len(seconds)} diagnostics plots to '{self._plot_dir}' "
+              f"in {time.perf_counter() - self._started:.1f} s.")
+        return seconds
+
+
+def start_diagnostics(df_offers, keep_since_year, plot_dir=PLOT_DIR, workers=None,
+                      max_scatter_points=MAX_SCATTER_POINTS):
+    """
+    Start rendering the plots of PLOTS for the offers in worker processes and return at once.
+
+    :param df_offers: preprocessed offers as pandas dataframe, with (at least) the columns PLOT_COLUMNS
+    :param keep_since_year: offers have been cut off before that year, used for labels in charts only
+    :param plot_dir: directory of the PNG files
+    :param workers: number of worker processes, default: one per plot, at most the number of CPUs
+    :param max_scatter_points: see MAX_SCATTER_POINTS
+    :return: DiagnosticsJob to wait() for, None if the plots are up to date for this data
+    """
+    columns = [df_offers[name].to_numpy(dtype=np.float64, na_value=np.nan) for name in PLOT_COLUMNS]
+    key = data_hash(columns + [np.array([keep_since_year, max_scatter_points], dtype=np.float64)])
+    if _plots_up_to_date(plot_dir, key):
+        print(f"Diagnostics plots in '{plot_dir}' are up to date.")
+        return None
+
+    os.makedirs(plot_dir, exist_ok=True)
+    data_dir = tempfile.mkdtemp(prefix='diagnostics-')
+    for name, column in zip(PLOT_COLUMNS, columns):
+        np.save(os.path.join(data_dir, f'{name}.npy'), column)
+    pool = ProcessPoolExecutor(max_workers=workers or min(len(PLOTS), os.cpu_count() or 1))
+    futures = {name: pool.submit(render_plot, name, data_dir, plot_dir, keep_since_year, max_scatter_points)
+               for name in PLOTS}
+    return DiagnosticsJob(pool, futures, data_dir, plot_dir, key)
+
+
+def main():
+    import training as training
+
+    parser = argparse.ArgumentParser(description='Render the diagnostics plots of the training data')
+    parser.add_argument("--data-file", default='../data/CampusFile_Wohnungskauf_Leipzig.csv')
+    parser.add_argument("--keep-since-year", type=int, default=2020)
+    parser.add_argument("--plot-dir", default=PLOT_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default: one per plot")
+    args = parser.parse_args()
+
+    df_offers = training.load_preprocessed_immo24_offers(args.data_file, keep_since_year=args.keep_since_year)
+    job = start_diagnostics(df_offers, args.keep_since_year, args.plot_dir, args.workers)
+    if job is not None:
+        for name, seconds in job.wait().items():
+            print(f"{name:35} {seconds:6.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,456 @@
+"""
+Data-drift monitor: compares the apartments users ask about and their feedback prices with the training data
+
+Each column (the 9 features of inference.FEATURE_NAMES and the price kaufpreis) is kept as a streaming histogram
+over fixed bins, DRIFT_BIN_EDGES, plus a bin for values above the last edge and one for missing values. The bins
+are the same for every sketch, so a sketch takes constant memory per column, no matter how many rows it has seen;
+sketches of chunks are merged by adding their counts, and any two sketches can be compared:
+* training: training.py sketches the (weighted) training rows and writes them next to the model file,
+  DRIFT_REFERENCE_FILE, and registers them with the model version, see inference.DRIFT_REFERENCE_ARTIFACT
+* live: app.py and service.py observe every estimated apartment (source 'query'), app.py every feedback record
+  with its price (source 'feedback'). DriftMonitor buffers the rows and bins them in batches, so an observation
+  costs about a microsecond. Counts are halved every half_life observations, so the live sketches follow the
+  recent traffic. Following an inference.ModelProvider, the live data is compared with the reference of the model
+  version served, also after a swap.
+
+A column has drifted if its population stability index (PSI) against the reference exceeds PSI_THRESHOLD, once
+MIN_DRIFT_OBSERVATIONS rows have been observed. The PSI compares the observed values only: the training data has
+missing values, the apartments of the UI never do, so the missing bin would flag a drift that is none. DriftMonitor checks every check_interval observations and, with
+metrics enabled, publishes lpz_drift_psi{source,column} and lpz_drift_detected{source}, to alert on and retrain.
+
+Run from within apartment_price_estimate/ to check the feedback log (or the live sketches of DRIFT_STATE_FILE)
+against the reference; exits with status 1 on drift, e.g. as a trigger of "python training.py -f" in a scheduled job:
+python drift.py --feedback
+"""
+
+import argparse
+import bisect
+import json
+import math
+import os
+import sys
+import threading
+
+import numpy as np
+
+try:
+    from . import inference
+    from . import metrics
+except ImportError:
+    import inference
+    import metrics
+
+# upper bin edges per column: a value v falls into the first bin with v <= edge, above the last edge into an
+# overflow bin; covers the inputs of the UI (see inference.UI_GRID) and the bulk of the offers
+DRIFT_BIN_EDGES = {
+    'wohnflaeche': (30, 40, 50, 60, 70, 80, 90, 100, 120, 140, 170, 200, 250),
+    'zimmeranzahl': (1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 5.0, 6.0),
+    'schlafzimmer': (0, 1, 2, 3, 4),
+    'badezimmer': (1, 2, 3),
+    'aufzug': (0, 1),
+    'balkon': (0, 1),
+    'denkmalobjekt': (0, 1),
+    'parkplatz': (0, 1),
+    'energieeffizienzklasse': (1, 2, 3, 4, 5, 6, 7, 8),
+    'kaufpreis': (50_000, 75_000, 100_000, 125_000, 150_000, 175_000, 200_000, 250_000, 300_000, 350_000, 400_000,
+                  500_000, 650_000, 800_000, 1_000_000, 1_500_000),
+}
+
+# columns of the sources of live data: the apartments of estimates, and feedback records with their price
+QUERY_COLUMNS = list(inference.FEATURE_NAMES)
+FEEDBACK_COLUMNS = QUERY_COLUMNS + ['kaufpreis']
+
+# sketch of the training data of the model file written by training.py, see inference.drift_reference_file()
+DRIFT_REFERENCE_FILE = inference.drift_reference_file('model/lpz_apt_prices_regression_model.lpzm')
+
+# optional file the live sketches are written to at every check, see DriftMonitor
+DRIFT_STATE_FILE = os.environ.get('DRIFT_STATE_FILE')
+
+# PSI above which a column has drifted; 0.1 to 0.25 is commonly read as a moderate, above 0.25 as a major shift
+PSI_THRESHOLD = 0.25
+
+# fewest (decayed) live observations before a column is checked
+MIN_DRIFT_OBSERVATIONS = 200
+
+# live observations after which the counts of a live sketch are halved
+DRIFT_HALF_LIFE = 10_000
+
+# share of a bin assumed for empty bins, so the PSI stays finite
+_PSI_EPSILON = 1e-4
+
+
+class DriftSketch:
+    """
+    Histograms of some columns over the fixed bins of DRIFT_BIN_EDGES, in constant memory per column.
+    observe() takes one row and is thread-safe, observe_rows() takes a matrix at once.
+    """
+
+    def __init__(self, columns, half_life=None):
+        """
+        :param columns: names of the columns, in the order of the values of a row, see DRIFT_BIN_EDGES
+        :param half_life: observations after which all counts are halved, None to keep all counts
+        """
+        self.columns = list(columns)
+        self.edges = [DRIFT_BIN_EDGES[column] for column in self.columns]
+        # per column: one count per edge, one for values above the last edge, one for missing values
+        self.counts = [[0.0] * (len(edges) + 2) for edges in self.edges]
+        self.observations = 0.0
+        self.half_life = half_life
+        self._until_decay = half_life
+        self._lock = threading.Lock()
+
+    def observe(self, values):
+        """
+        add one row
+
+        :param values: one value per column, None or NaN for missing
+        """
+        with self._lock:
+            for counts, edges, value in zip(self.counts, self.edges, values):
+                if value is None or value != value:
+                    counts[-1] += 1.0
+                else:
+                    counts[bisect.bisect_left(edges, value)] += 1.0
+            self.observations += 1.0
+            if self.half_life:
+                self._until_decay -= 1
+                if self._until_decay <= 0:
+                    self._decay()
+
+    def _decay(self):
+        for counts in self.counts:
+            for i in range(len(counts)):
+                counts[i] *= 0.5
+        self.observations *= 0.5
+        self._until_decay = self.half_life
+
+    def observe_rows(self, rows, sample_weight=None):
+        """
+        add the rows of a matrix at once
+
+        :param rows: numpy array of shape (n, columns) with NaN for missing values
+        :param sample_weight: optional weight of each row, e.g. of a training window
+        """
+        rows = np.asarray(rows, dtype=np.float64)
+        weights = np.ones(len(rows)) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+        with self._lock:
+            for j, (counts, edges) in enumerate(zip(self.counts, self.edges)):
+                values = rows[:, j]
+                bins = np.where(np.isnan(values), len(edges) + 1,
+                                np.searchsorted(np.asarray(edges, dtype=np.float64), values, side='left'))
+                added = np.bincount(bins, weights=weights, minlength=len(counts))
+                for i in range(len(counts)):
+                    counts[i] += float(added[i])
+            self.observations += float(weights.sum())
+            if self.half_life:
+                # the rows of a matrix are decayed together, as if observed at once
+                self._until_decay -= len(rows)
+                if self._until_decay <= 0:
+                    self._decay()
+
+    def merge(self, other):
+        """add the counts of a sketch of the same columns, e.g. of another chunk of the training data"""
+        if other.columns != self.columns:
+            raise ValueError(f"sketches of different columns: {other.columns} and {self.columns}")
+        with self._lock:
+            for counts, other_counts in zip(self.counts, other.counts):
+                for i in range(len(counts)):
+                    counts[i] += other_counts[i]
+            self.observations += other.observations
+
+    def distribution(self, column) -> list:
+        """
+        share of each bin of a column among its observed values, see DRIFT_BIN_EDGES; missing values are left out,
+        as the training data has them but the live data of the UI and the service never does
+        """
+        counts = self.counts[self.columns.index(column)][:-1]
+        total = sum(counts)
+        return [count / total for count in counts] if total else [0.0] * len(counts)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {'observations': self.observations,
+                    'columns': {column: {'edges': list(edges), 'counts': list(counts)}
+                                for column, edges, counts in zip(self.columns, self.edges, self.counts)}}
+
+    @classmethod
+    def from_dict(cls, sketch_dict, half_life=None):
+        """
+        :raises ValueError: if the bins of a column differ from DRIFT_BIN_EDGES, e.g. of a reference written before
+            they were changed; the training data must be sketched anew then
+        """
+        sketch = cls(sketch_dict['columns'], half_life)
+        for column, counts in zip(sketch.columns, sketch.counts):
+            column_dict = sketch_dict['columns'][column]
+            if (tuple(column_dict['edges']) != tuple(DRIFT_BIN_EDGES[column])
+                    or len(column_dict['counts']) != len(counts)):
+                raise ValueError(f"bins of column '{column}' differ from DRIFT_BIN_EDGES, sketch the training data "
+                                 f"anew")
+            counts[:] = [float(count) for count in column_dict['counts']]
+        sketch.observations = float(sketch_dict['observations'])
+        return sketch
+
+
+def population_stability_index(expected, actual) -> float:
+    """
+    PSI = sum over bins of (actual - expected) * ln(actual / expected), of two distributions over the same bins
+
+    :param expected: shares of the bins in the reference, see DriftSketch.distribution()
+    :param actual: shares of the bins in the live data
+    """
+    psi = 0.0
+    for expected_share, actual_share in zip(expected, actual):
+        expected_share = max(expected_share, _PSI_EPSILON)
+        actual_share = max(actual_share, _PSI_EPSILON)
+        psi += (actual_share - expected_share) * math.log(actual_share / expected_share)
+    return psi
+
+
+def compare_sketches(reference, live, threshold=PSI_THRESHOLD, min_observations=MIN_DRIFT_OBSERVATIONS) -> dict:
+    """
+    PSI of every column of the live sketch that the reference has, over the observed values, see
+    DriftSketch.distribution()
+
+    :param reference: DriftSketch of the training data
+    :param live: DriftSketch of live data
+    :return: column -> {'psi': ..., 'drift': True if psi > threshold}; 'drift' is False as long as the live sketch
+        has fewer than min_observations observations
+    """
+    report = {}
+    for column in live.columns:
+        if column not in reference.columns:
+            continue
+        live_distribution = live.distribution(column)
+        # a column without observed value, e.g. only missing in the live data, has no distribution to compare
+        psi = (population_stability_index(reference.distribution(column), live_distribution)
+               if any(live_distribution) else 0.0)
+        report[column] = {'psi': psi, 'drift': live.observations >= min_observations and psi > threshold}
+    return report
+
+
+def drifted_columns(report) -> list:
+    return [column for column, entry in report.items() if entry['drift']]
+
+
+def save_sketch(sketch, file_name):
+    with open(f'{file_name}.tmp', 'w') as sketch_file:
+        json.dump(sketch.to_dict(), sketch_file)
+    os.replace(f'{file_name}.tmp', file_name)
+
+
+def load_sketch(file_name, half_life=None) -> DriftSketch:
+    with open(file_name) as sketch_file:
+        return DriftSketch.from_dict(json.load(sketch_file), half_life)
+
+
+def save_sketches(sketches, file_name):
+    """write sketches by name, e.g. the live sketches of DriftMonitor, atomically"""
+    with open(f'{file_name}.tmp', 'w') as sketches_file:
+        json.dump({name: sketch.to_dict() for name, sketch in sketches.items()}, sketches_file)
+    os.replace(f'{file_name}.tmp', file_name)
+
+
+def load_sketches(file_name) -> dict:
+    with open(file_name) as sketches_file:
+        return {name: DriftSketch.from_dict(sketch_dict) for name, sketch_dict in json.load(sketches_file).items()}
+
+
+class DriftMonitor:
+    """
+    Live sketches of the sources 'query' and 'feedback', checked against the reference every check_interval
+    observations of a source. Without reference file, observe() does nothing and a warning is printed.
+    With model_provider, the reference is that of the model version served, swapped with the model.
+
+    observe() and observe_rows() only add the rows to a buffer of the source; a full buffer is binned at once with
+    DriftSketch.observe_rows() and then checked. So an observation costs about a microsecond, and the memory stays
+    bounded by check_interval rows per source (plus the last batch of observe_rows()).
+    """
+
+    def __init__(self, reference_file=DRIFT_REFERENCE_FILE, half_life=DRIFT_HALF_LIFE, check_interval=1000,
+                 state_file=DRIFT_STATE_FILE, model_provider=None):
+        """
+        :param reference_file: sketch of the training data, see DRIFT_REFERENCE_FILE; not used with model_provider
+        :param half_life: see DriftSketch
+        :param check_interval: observations of a source between two checks
+        :param state_file: optional JSON file the live sketches are written to at every check, for "drift.py --live"
+        :param model_provider: inference.ModelProvider to take the reference of the served model from, see
+            ModelProvider.drift_reference_file
+        """
+        self.reference = None
+        self.reference_file = None
+        self.model_provider = model_provider
+        self.sketches = {'query': DriftSketch(QUERY_COLUMNS, half_life),
+                         'feedback': DriftSketch(FEEDBACK_COLUMNS, half_life)}
+        self.check_interval = check_interval
+        self.state_file = state_file
+        self.reports = {}
+        # per source: rows of observe(), arrays of observe_rows(), number of rows in both
+        self._pending = {source: ([], [], 0) for source in self.sketches}
+        self._lock = threading.Lock()
+        if model_provider is None:
+            self.use_reference(reference_file)
+
+    @property
+    def enabled(self) -> bool:
+        return self.reference is not None
+
+    def use_reference(self, reference_file, model_version=None):
+        """
+        compare the live sketches with the sketch in reference_file from now on, e.g. of a model swapped in;
+        drift is not monitored while the file is missing or invalid
+        """
+        model = f"model version {model_version}" if model_version is not None else "the model"
+        reference = None
+        if not os.path.isfile(reference_file):
+            print(f"Warning: drift reference '{reference_file}' of {model} is missing, data drift is not monitored.")
+        else:
+            try:
+                reference = load_sketch(reference_file)
+            except (ValueError, KeyError) as e:
+                print(f"Warning: drift reference '{reference_file}' of {model} not used, data drift is not monitored: "
+                      f"{e}")
+        with self._lock:
+            self.reference, self.reference_file = reference, reference_file
+            # a drift against the new reference is reported anew
+            self.reports = {}
+
+    def _follow_model_provider(self):
+        """use the reference of the model served by model_provider, once it is loaded or swapped"""
+        provider = self.model_provider
+        if provider is None:
+            return
+        reference_file = provider.drift_reference_file
+        if reference_file is not None and reference_file != self.reference_file:
+            self.use_reference(reference_file, provider.version)
+
+    def observe(self, source, values):
+        """
+        :param source: 'query' or 'feedback'
+        :param values: one row in the order of QUERY_COLUMNS or FEEDBACK_COLUMNS, None or NaN for missing
+        """
+        if self.reference is None:
+            self._follow_model_provider()
+            if self.reference is None:
+                return
+        with self._lock:
+            rows, arrays, n_rows = self._pending[source]
+            rows.append(values)
+            self._pending[source] = rows, arrays, n_rows + 1
+            if n_rows + 1 < self.check_interval:
+                return
+            self._pending[source] = [], [], 0
+        self._add(source, rows, arrays)
+
+    def observe_rows(self, source, rows):
+        """
+        :param source: see observe()
+        :param rows: numpy array of shape (n, columns), e.g. the apartments of a batch request
+        """
+        if self.reference is None:
+            self._follow_model_provider()
+            if self.reference is None:
+                return
+        with self._lock:
+            pending_rows, arrays, n_rows = self._pending[source]
+            arrays.append(rows)
+            self._pending[source] = pending_rows, arrays, n_rows + len(rows)
+            if n_rows + len(rows) < self.check_interval:
+                return
+            self._pending[source] = [], [], 0
+        self._add(source, pending_rows, arrays)
+
+    def _add(self, source, rows, arrays):
+        """bin the buffered rows into the sketch of the source and check it"""
+        if rows:
+            arrays = arrays + [np.array(rows, dtype=np.float64)]
+        self.sketches[source].observe_rows(np.concatenate(arrays))
+        self.check(source)
+
+    def flush(self):
+        """add and check the rows observed since the last check"""
+        for source in self.sketches:
+            with self._lock:
+                rows, arrays, n_rows = self._pending[source]
+                self._pending[source] = [], [], 0
+            if n_rows:
+                self._add(source, rows, arrays)
+
+    def check(self, source) -> dict:
+        """compare the live sketch of a source with the reference, see compare_sketches()"""
+        self._follow_model_provider()
+        reference = self.reference
+        if reference is None:
+            return {}
+        report = compare_sketches(reference, self.sketches[source])
+        drifted = drifted_columns(report)
+        with self._lock:
+            newly_drifted = drifted and not drifted_columns(self.reports.get(source, {}))
+            self.reports[source] = report
+        if newly_drifted:
+            print(f"Data drift in the {source} data: {', '.join(drifted)}, consider retraining the model.")
+        for column, entry in report.items():
+            metrics.set_gauge('drift_psi', entry['psi'], source=source, column=column)
+        metrics.set_gauge('drift_detected', float(bool(drifted)), source=source)
+        if self.state_file:
+            save_sketches(self.sketches, self.state_file)
+        return report
+
+
+_drift_monitor = None
+_drift_monitor_lock = threading.Lock()
+
+
+def get_drift_monitor(**kwargs) -> DriftMonitor:
+    """
+    The process-wide DriftMonitor, created on first call.
+    kwargs are passed to DriftMonitor on creation only.
+    """
+    global _drift_monitor
+    with _drift_monitor_lock:
+        if _drift_monitor is None:
+            _drift_monitor = DriftMonitor(**kwargs)
+        return _drift_monitor
+
+
+def print_report(source, live, report):
+    print(f"{source}: {live.observations:,.0f} observations")
+    for column, entry in sorted(report.items(), key=lambda item: -item[1]['psi']):
+        print(f"  {column:24} PSI {entry['psi']:7.3f}{'  drift' if entry['drift'] else ''}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Check live data against the training data of the model')
+    parser.add_argument("--reference", default=DRIFT_REFERENCE_FILE, help="sketch of the training data")
+    parser.add_argument("--feedback", action='store_true', help="check the feedback log of the MinIO bucket")
+    parser.add_argument("--live", default=DRIFT_STATE_FILE, help="live sketches written by DriftMonitor")
+    parser.add_argument("--threshold", type=float, default=PSI_THRESHOLD)
+    parser.add_argument("--min-observations", type=float, default=MIN_DRIFT_OBSERVATIONS)
+    args = parser.parse_args()
+
+    reference = load_sketch(args.reference)
+    live_sketches = {}
+    if args.feedback:
+        import training as training
+
+        df_feedback = training.load_feedback_from_csv_into_pandas_dataframe()
+        live_sketches['feedback'] = DriftSketch(FEEDBACK_COLUMNS)
+        live_sketches['feedback'].observe_rows(
+            df_feedback[FEEDBACK_COLUMNS].to_numpy(dtype=np.float64, na_value=np.nan))
+    if args.live:
+        for source, sketch in load_sketches(args.live).items():
+            live_sketches.setdefault(source, sketch)
+    if not live_sketches:
+        parser.error("nothing to check, use --feedback or --live")
+
+    drift = False
+    for source, live in live_sketches.items():
+        report = compare_sketches(reference, live, args.threshold, args.min_observations)
+        print_report(source, live, report)
+        drift = drift or bool(drifted_columns(report))
+    if drift:
+        print("Data drift detected, retrain the model: python training.py -f")
+    return 1 if drift else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
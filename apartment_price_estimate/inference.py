@@ -5,37 +5,747 @@ This file offers the function for actually doing the apartment price estimate fr
 that uses linear regression.
 * The regression model is typically loaded from a MLFlow model registry but is also possible to load from a file.
 * Inference then uses a simple predict() on the regression model with a feature vector for an apartment.
+* For bulk valuation, predict_prices_batch() and predict_prices_from_file() validate, encode and predict whole
+  tables of apartments in chunks, also available as command line tool:
+  python inference.py --input apartments.csv --output estimates.csv
+* A linear model can also be served as CompactLinearModel: just coefficients, intercept and imputation means in a
+  small JSON file, predicted with plain NumPy, without sklearn and its per-call input validation.
+* For serving, get_model_provider() loads the model once per process, caches the registry download on local disk
+  and swaps in a new "Production" version in the background, as soon as one is registered.
+* Models trained by training.py carry the covariance of their coefficients, so predict_price_interval() and
+  predict_price_intervals_batch() give a price range per estimate in closed form, see CompactLinearModel.
+* ModelRegistry serves the models of many regions from one process, routed to by region key, loaded on first use
+  and evicted least recently used beyond a memory budget.
+* Models are saved as binary model artifacts (.lpzm): the arrays of a CompactLinearModel behind a small JSON header
+  with a checksum, loaded with one memory map and no copies, without unpickling and independent of the sklearn
+  version, see save_model_artifact().
+* The inputs of the UI span a finite grid of about 1.4 million apartments. PriceLookupTable holds the estimates of a
+  model for all of them, so predict_price_with_lookup_table() answers UI inputs with an array lookup.
 """
 
+import argparse
+import hashlib
+import json
+import math
+import mmap
+import os
 import pickle
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
 import numpy as np
-import mlflow.sklearn
 from dotenv import load_dotenv
 
+try:
+    from . import metrics
+except ImportError:
+    import metrics
+
+# MLflow and pandas are imported on first use only: serving predictions needs neither of them, and they dominate
+# the import time of this module
+
 # Loading environment variables for MLFLOW: MLFLOW_TRACKING_USERNAME, MLFLOW_TRACKING_PASSWORD, MLFLOW_TRACKING_URI
 # they are used implicitly by the ML Flow functions
 load_dotenv()
 
+# order of the 9 input features of the regression model
+FEATURE_NAMES = ['wohnflaeche', 'zimmeranzahl', 'schlafzimmer', 'badezimmer', 'aufzug', 'balkon', 'denkmalobjekt',
+                 'parkplatz', 'energieeffizienzklasse']
+
+# translate energy efficiency class labels to numeric values, same as in the UI
+ENERGY_EFFICIENCY_CLASSES = {'A': 1, 'B': 2, 'C': 3, 'D': 4, 'E': 5, 'F': 6, 'G': 7, 'H': 8}
+
+# sentinel values of ImmobilienScout24 for "not available", treated as missing like in training
+MISSING_VALUES = {'zimmeranzahl': [-5, 0],
+                  'schlafzimmer': [-5, -9],
+                  'badezimmer': [-9],
+                  'parkplatz': [-9],
+                  'energieeffizienzklasse': [-7]}
+
+# valid values per feature, once the sentinels of MISSING_VALUES are missing: (minimum, maximum); generous for
+# living area and rooms, as offers go far beyond the inputs of the UI, exact for the flags and the energy classes
+FEATURE_RANGES = {'wohnflaeche': (1, 10_000),
+                  'zimmeranzahl': (0.5, 100),
+                  'schlafzimmer': (0, 100),
+                  'badezimmer': (0, 100),
+                  'aufzug': (0, 1),
+                  'balkon': (0, 1),
+                  'denkmalobjekt': (0, 1),
+                  'parkplatz': (0, 1),
+                  'energieeffizienzklasse': (1, 8)}
+_FEATURE_MINIMA = np.array([FEATURE_RANGES[name][0] for name in FEATURE_NAMES], dtype=np.float64)
+_FEATURE_MAXIMA = np.array([FEATURE_RANGES[name][1] for name in FEATURE_NAMES], dtype=np.float64)
+
+# column of the price estimate in batch output
+PREDICTION_COLUMN = 'kaufpreis_schaetzung'
+
+# grid of the UI inputs per feature, in the order of FEATURE_NAMES: (first value, step, number of values)
+UI_GRID = [(30, 5, 41),     # wohnflaeche: 30 to 230 m²
+           (1.0, 0.5, 15),  # zimmeranzahl: 1 to 8 rooms
+           (0, 1, 6),       # schlafzimmer: 0 to 5
+           (1, 1, 3),       # badezimmer: 1 to 3
+           (0, 1, 2),       # aufzug
+           (0, 1, 2),       # balkon
+           (0, 1, 2),       # denkmalobjekt
+           (0, 1, 2),       # parkplatz
+           (1, 1, 8)]       # energieeffizienzklasse: A to H
+
+# name of the model in the ML Flow model registry
+REGISTERED_MODEL_NAME = 'group7-linear-regression-model'
+
+# region of the model REGISTERED_MODEL_NAME; models of other regions are registered as
+# REGISTERED_MODEL_NAME-<region>, see registered_model_name()
+DEFAULT_REGION = 'leipzig'
+
+# model files of all regions, <region>.lpzm, as saved by "training.py --regions-dir"
+REGION_MODEL_DIR = 'model/regions'
+
+# binary model artifact, see save_model_artifact()
+MODEL_ARTIFACT_EXTENSION = '.lpzm'
+MODEL_ARTIFACT_MAGIC = b'LPZMODEL'
+MODEL_ARTIFACT_VERSION = 1
+# offset of the arrays in an artifact is a multiple of this, so every array is aligned for any dtype
+_MODEL_ARTIFACT_ALIGNMENT = 64
+
+# sketch of the training data of a model for the drift monitor of drift.py: file name of it within the directory of a
+# registered model version; next to a model file, it is named by drift_reference_file()
+DRIFT_REFERENCE_ARTIFACT = 'drift_reference.json'
+
+# local disk cache of models downloaded from the registry
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'lpz-apt-prices'))
+
 
 def load_regression_model_from_file(file_name) -> object:
-    """load a regression model from a file
-    the file must have been saved before with train.py
+    """load a pickled regression model from a file
+    the file must have been saved before with train.py; unpickling runs code of the file, so trusted files only,
+    and the sklearn version must match the one that trained the model. Linear models are saved as model artifacts
+    instead, see load_model_from_file().
     """
-    loaded_model = pickle.load(open(file_name, 'rb'))
+    with metrics.timer('model_load_seconds', source='file'), open(file_name, 'rb') as model_file:
+        loaded_model = pickle.load(model_file)
     return loaded_model
 
 
-def load_regression_model_from_model_store() -> object:
+def load_regression_model_from_model_store(model_name=REGISTERED_MODEL_NAME) -> object:
     """load the model from model store in ML Flow"""
-    loaded_model = mlflow.sklearn.load_model("models:/group7-linear-regression-model/Production")
+    import mlflow.sklearn
+    with metrics.timer('model_load_seconds', source='model_store'):
+        loaded_model = mlflow.sklearn.load_model(f"models:/{model_name}/Production")
     return loaded_model
 
 
+def normalize_region(region) -> str:
+    """
+    region key in lower case, e.g. 'leipzig' for 'Leipzig'
+
+    :raises ValueError: if the key has other characters than letters, digits, '-' and '_', which keeps region keys
+        of requests from pointing anywhere but into the model directory
+    """
+    key = str(region).strip().lower()
+    if not key or not all(character.isascii() and (character.isalnum() or character in '-_') for character in key):
+        raise ValueError(f"invalid region '{region}'")
+    return key
+
+
+def registered_model_name(region=DEFAULT_REGION) -> str:
+    """name of the model of a region in the ML Flow model registry"""
+    region = normalize_region(region)
+    return REGISTERED_MODEL_NAME if region == DEFAULT_REGION else f"{REGISTERED_MODEL_NAME}-{region}"
+
+
+@lru_cache(maxsize=16)
+def _normal_quantile(level) -> float:
+    """two-sided quantile of the standard normal distribution for a confidence level, e.g. 1.96 for 0.95"""
+    from statistics import NormalDist
+    if not 0 < level < 1:
+        raise ValueError(f"confidence level must be between 0 and 1, got {level}")
+    return NormalDist().inv_cdf(0.5 + level / 2)
+
+
+class CompactLinearModel:
+    """
+    Linear regression model reduced to its arrays, with the same predict() as the sklearn model it came from:
+    prediction = imputed features @ coef + intercept, where missing values (NaN) are imputed by imputer_means.
+
+    Models trained by training.py also carry the covariance of [intercept, coef], residual_variance * (X^T X)^-1 of
+    the training data with a leading column of ones, and the residual variance. predict_interval() evaluates the
+    variance of an estimate as quadratic form of the imputed features in this covariance, with a factor of the
+    covariance computed once per model, so a batch costs one more matrix product than predict().
+    """
+
+    FORMAT = "lpz-apt-prices-linear-v1"
+
+    def __init__(self, coef, intercept, imputer_means=None, feature_names=None, covariance=None,
+                 residual_variance=None):
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = float(intercept)
+        self.imputer_means = None if imputer_means is None else np.asarray(imputer_means, dtype=np.float64)
+        self.feature_names = list(feature_names or FEATURE_NAMES)
+        if self.coef.shape != (len(self.feature_names),):
+            raise ValueError(f"model needs {len(self.feature_names)} coefficients, got {self.coef.shape}")
+        self.covariance = None if covariance is None else np.asarray(covariance, dtype=np.float64)
+        self.residual_variance = None if residual_variance is None else float(residual_variance)
+        self._covariance_factor = None
+        if self.covariance is not None:
+            if self.covariance.shape != (len(self.coef) + 1,) * 2 or self.residual_variance is None:
+                raise ValueError(f"model needs a covariance of shape {(len(self.coef) + 1,) * 2} "
+                                 f"and a residual variance, got {self.covariance.shape}")
+
+    @property
+    def has_intervals(self) -> bool:
+        return self.covariance is not None
+
+    def _factor(self) -> np.ndarray:
+        """factor F of the covariance, computed on first use, so loading a model stays cheap"""
+        if self._covariance_factor is None:
+            # covariance = F F^T, so x^T covariance x = |x F|^2; eigh also copes with rounding to slightly negative
+            eigenvalues, eigenvectors = np.linalg.eigh(self.covariance)
+            self._covariance_factor = eigenvectors * np.sqrt(np.clip(eigenvalues, 0.0, None))
+        return self._covariance_factor
+
+    def _impute(self, X) -> np.ndarray:
+        X = np.asarray(X, dtype=np.float64)
+        if self.imputer_means is not None:
+            X = np.where(np.isnan(X), self.imputer_means, X)
+        return X
+
+    def predict(self, X) -> np.ndarray:
+        """predict prices for a 2D array of apartments, columns in the order of feature_names"""
+        return self._impute(X) @ self.coef + self.intercept
+
+    def predict_interval(self, X, level=0.95, kind='prediction'):
+        """
+        price estimates with a two-sided interval, for a 2D array of apartments
+
+        The interval is estimate -/+ z * sqrt(variance): for kind 'confidence' the variance of the estimated mean
+        price, for kind 'prediction' plus the residual variance, which covers the price of a single apartment.
+        z is the normal quantile, as the residual degrees of freedom run into the thousands. Imputed values are
+        taken as given, their own uncertainty is not included.
+
+        :param X: 2D array of apartments, columns in the order of feature_names
+        :param level: confidence level, e.g. 0.95
+        :param kind: 'prediction' or 'confidence'
+        :return: estimates, lower and upper bounds as float arrays
+        :raises ValueError: if the model was trained without covariance, or for an invalid level or kind
+        """
+        if not self.has_intervals:
+            raise ValueError("model has no coefficient covariance for intervals, it must be retrained")
+        if kind not in ('prediction', 'confidence'):
+            raise ValueError(f"kind must be 'prediction' or 'confidence', got {kind!r}")
+        X = self._impute(X)
+        estimates = X @ self.coef + self.intercept
+        # [1, x] F, with the row of the intercept split off to avoid stacking a column of ones
+        factor = self._factor()
+        projected = X @ factor[1:] + factor[0]
+        variance = np.einsum('ij,ij->i', projected, projected)
+        if kind == 'prediction':
+            variance += self.residual_variance
+        half_width = _normal_quantile(level) * np.sqrt(variance)
+        return estimates, estimates - half_width, estimates + half_width
+
+    def to_dict(self) -> dict:
+        """compact model as JSON-serializable dict, floats survive a JSON round trip exactly"""
+        return {'format': self.FORMAT,
+                'feature_names': self.feature_names,
+                'coef': self.coef.tolist(),
+                'intercept': self.intercept,
+                'imputer_means': None if self.imputer_means is None else self.imputer_means.tolist(),
+                'covariance': None if self.covariance is None else self.covariance.tolist(),
+                'residual_variance': self.residual_variance}
+
+    @classmethod
+    def from_dict(cls, model_dict):
+        """restore a compact model from to_dict(), models saved without covariance have no intervals"""
+        if model_dict.get('format') != cls.FORMAT:
+            raise ValueError(f"unknown model format {model_dict.get('format')!r}, expected {cls.FORMAT!r}")
+        return cls(model_dict['coef'], model_dict['intercept'], model_dict['imputer_means'],
+                   model_dict['feature_names'], model_dict.get('covariance'), model_dict.get('residual_variance'))
+
+
+def compact_model_from_regression_model(regression_model) -> CompactLinearModel:
+    """
+    Extract the compact model from a trained sklearn model: a LinearRegression (or Ridge), or a pipeline of
+    SimpleImputer and LinearRegression as trained by training.py, which sets coef_covariance_ and residual_variance_
+    on the LinearRegression for intervals
+
+    :raise ValueError: if the model is not linear in the 9 features, e.g. other models of sweep.py
+    """
+    imputer_means = None
+    if hasattr(regression_model, 'named_steps'):
+        if list(regression_model.named_steps) != ['imputer', 'regression']:
+            raise ValueError(f"no compact form for pipeline with steps {list(regression_model.named_steps)}")
+        imputer_means = regression_model.named_steps['imputer'].statistics_
+        regression_model = regression_model.named_steps['regression']
+    if type(regression_model).__name__ not in ('LinearRegression', 'Ridge'):
+        raise ValueError(f"no compact form for model {type(regression_model).__name__}")
+    return CompactLinearModel(regression_model.coef_, regression_model.intercept_, imputer_means,
+                              covariance=getattr(regression_model, 'coef_covariance_', None),
+                              residual_variance=getattr(regression_model, 'residual_variance_', None))
+
+
+def _to_compact_model_if_possible(regression_model):
+    """the compact form of a linear model, other models unchanged"""
+    try:
+        return compact_model_from_regression_model(regression_model)
+    except ValueError:
+        return regression_model
+
+
+def load_compact_model_from_file(file_name) -> CompactLinearModel:
+    """load a compact model from a JSON file saved before with training.py"""
+    with metrics.timer('model_load_seconds', source='compact_file'), open(file_name, 'r') as model_file:
+        return CompactLinearModel.from_dict(json.load(model_file))
+
+
+def save_model_artifact(model, file_name):
+    """
+    Save a linear model as binary model artifact, which is loaded without unpickling and without sklearn.
+
+    Layout: MODEL_ARTIFACT_MAGIC, the artifact version and the length of the header as little-endian uint32, the
+    header as UTF-8 JSON (format and feature names of the model, intercept, residual variance, offset and shape of
+    each array and the sha256 of the array data), padded to a multiple of 64 bytes, and then the arrays coef,
+    imputer_means and covariance (as far as the model has them) as little-endian float64, each at a 64-byte aligned
+    offset. The file is replaced atomically.
+
+    :param model: CompactLinearModel, or a sklearn model that compact_model_from_regression_model() accepts
+    :param file_name: file to write, by convention with MODEL_ARTIFACT_EXTENSION
+    """
+    compact_model = model if isinstance(model, CompactLinearModel) else compact_model_from_regression_model(model)
+    arrays = {name: np.ascontiguousarray(getattr(compact_model, name), dtype='<f8')
+              for name in ('coef', 'imputer_means', 'covariance') if getattr(compact_model, name) is not None}
+    data, layout = bytearray(), {}
+    for name, array in arrays.items():
+        data += bytes(-len(data) % _MODEL_ARTIFACT_ALIGNMENT)
+        layout[name] = {'offset': len(data), 'shape': list(array.shape)}
+        data += array.tobytes()
+    header = json.dumps({'format': compact_model.FORMAT,
+                         'feature_names': compact_model.feature_names,
+                         'intercept': compact_model.intercept,
+                         'residual_variance': compact_model.residual_variance,
+                         'dtype': '<f8',
+                         'arrays': layout,
+                         'data_bytes': len(data),
+                         'sha256': hashlib.sha256(data).hexdigest()}).encode('utf-8')
+    prefix_length = len(MODEL_ARTIFACT_MAGIC) + 8
+    header += b' ' * (-(prefix_length + len(header)) % _MODEL_ARTIFACT_ALIGNMENT)
+    with open(f"{file_name}.tmp", 'wb') as artifact_file:
+        artifact_file.write(MODEL_ARTIFACT_MAGIC)
+        artifact_file.write(MODEL_ARTIFACT_VERSION.to_bytes(4, 'little') + len(header).to_bytes(4, 'little'))
+        artifact_file.write(header)
+        artifact_file.write(data)
+    os.replace(f"{file_name}.tmp", file_name)
+
+
+def load_model_artifact(file_name, verify=True) -> CompactLinearModel:
+    """
+    Load a model artifact saved by save_model_artifact(): the file is memory mapped once, and the arrays of the model
+    are read-only views of the mapping, no copies.
+
+    :param verify: check the sha256 of the array data
+    :raises ValueError: if the file is no model artifact, of another artifact version or damaged
+    """
+    with metrics.timer('model_load_seconds', source='artifact'), open(file_name, 'rb') as artifact_file:
+        try:
+            # the mapping outlives the file handle, and is unmapped once no array refers to it any more
+            buffer = mmap.mmap(artifact_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError(f"'{file_name}' is empty, not a model artifact")
+        prefix_length = len(MODEL_ARTIFACT_MAGIC) + 8
+        if buffer[:len(MODEL_ARTIFACT_MAGIC)] != MODEL_ARTIFACT_MAGIC or len(buffer) < prefix_length:
+            raise ValueError(f"'{file_name}' is not a model artifact")
+        version = int.from_bytes(buffer[prefix_length - 8:prefix_length - 4], 'little')
+        header_length = int.from_bytes(buffer[prefix_length - 4:prefix_length], 'little')
+        if version != MODEL_ARTIFACT_VERSION:
+            raise ValueError(f"model artifact '{file_name}' has version {version}, expected {MODEL_ARTIFACT_VERSION}")
+        try:
+            header = json.loads(bytes(buffer[prefix_length:prefix_length + header_length]))
+        except ValueError:
+            raise ValueError(f"model artifact '{file_name}' has a damaged header")
+        data_offset = prefix_length + header_length
+        data = memoryview(buffer)[data_offset:]
+        if len(data) != header['data_bytes'] or (verify and hashlib.sha256(data).hexdigest() != header['sha256']):
+            raise ValueError(f"model artifact '{file_name}' is damaged, the checksum of its arrays does not match")
+        if header['format'] != CompactLinearModel.FORMAT:
+            raise ValueError(f"unknown model format {header['format']!r}, expected {CompactLinearModel.FORMAT!r}")
+        arrays = {name: np.frombuffer(buffer, dtype=header['dtype'], count=math.prod(layout['shape']),
+                                      offset=data_offset + layout['offset']).reshape(layout['shape'])
+                  for name, layout in header['arrays'].items()}
+        return CompactLinearModel(arrays['coef'], header['intercept'], arrays.get('imputer_means'),
+                                  header['feature_names'], arrays.get('covariance'), header['residual_variance'])
+
+
+def load_model_from_file(file_name, compact=False):
+    """
+    load a model file by its extension: a model artifact (MODEL_ARTIFACT_EXTENSION) or .json as CompactLinearModel,
+    any other file as pickled sklearn model, see load_regression_model_from_file()
+
+    :param compact: convert a pickled linear model to a CompactLinearModel
+    """
+    if file_name.endswith(MODEL_ARTIFACT_EXTENSION):
+        return load_model_artifact(file_name)
+    if file_name.endswith('.json'):
+        return load_compact_model_from_file(file_name)
+    model = load_regression_model_from_file(file_name)
+    return _to_compact_model_if_possible(model) if compact else model
+
+
+def drift_reference_file(model_file) -> str:
+    """sketch of the training data of a model file (any extension), saved next to it, see drift.py"""
+    return f'{os.path.splitext(model_file)[0]}.drift.json'
+
+
+def _checksum_of_directory(path) -> str:
+    """sha256 over names and contents of all files below path"""
+    checksum = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(path)):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            checksum.update(os.path.relpath(file_path, path).encode('utf-8'))
+            with open(file_path, 'rb') as model_file:
+                for block in iter(lambda: model_file.read(1 << 20), b''):
+                    checksum.update(block)
+    return checksum.hexdigest()
+
+
+class ModelProvider:
+    """
+    Process-wide, lazily loaded regression model from the ML Flow model registry.
+
+    * get() loads the model on first use only and then returns it from memory.
+    * Downloads are cached on local disk below cache_dir/<model name>/<version>, with a checksum file that is
+      verified before a cached download is reused.
+    * With version=None, the latest version in the given stage is served, and a background thread polls the
+      registry every poll_interval seconds. A new version is loaded in that thread and then swapped in with a
+      single assignment, so requests are never blocked by a reload.
+    * With a pinned version, the registry is neither polled nor asked which version is current.
+    * Without registry (offline), the newest cached version is served, else the model from fallback_file.
+    * drift_reference_file is the sketch of the training data of the served model, registered with its version or
+      next to fallback_file, so the drift monitor of drift.py follows a swap.
+    """
+
+    def __init__(self, model_name=REGISTERED_MODEL_NAME, stage='Production', version=None, cache_dir=MODEL_CACHE_DIR,
+                 poll_interval=300.0, fallback_file=None, compact=False):
+        """
+        :param model_name: name of the model in the registry
+        :param stage: stage to serve the latest version from, if no version is pinned
+        :param version: pin this registry version
+        :param cache_dir: local disk cache for downloaded models
+        :param poll_interval: seconds between polls for a new version, 0 to never poll
+        :param fallback_file: model file to load with load_model_from_file() if nothing else works
+        :param compact: serve a linear model as CompactLinearModel, see compact_model_from_regression_model()
+        """
+        self.model_name = model_name
+        self.stage = stage
+        self.pinned_version = None if version is None else str(version)
+        self.cache_dir = os.path.join(cache_dir, model_name)
+        self.poll_interval = poll_interval
+        self.fallback_file = fallback_file
+        self.compact = compact
+        self.version = None
+        # sketch of the training data of the served model, see DRIFT_REFERENCE_ARTIFACT; None until loaded
+        self.drift_reference_file = None
+        # False once mlflow turned out not to be installed: the fallback file is served and the registry not polled
+        self._registry_available = True
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._poller = None
+
+    def get(self):
+        """the current model, loaded on first use"""
+        model = self._model
+        if model is None:
+            with self._load_lock:
+                if self._model is None:
+                    self._model, self.version, self.drift_reference_file = self._load(self._resolve_version())
+                    self._start_polling()
+                model = self._model
+        return model
+
+    @property
+    def loaded(self) -> bool:
+        """True once a model was loaded, without loading it"""
+        return self._model is not None
+
+    def reload(self) -> bool:
+        """load the current version from the registry, if it is new; returns True if the model was swapped"""
+        version = self._resolve_version()
+        if version is None or version == self.version:
+            return False
+        with self._load_lock:
+            model, version, drift_reference = self._load(version)
+            # a single assignment swaps the model for all following requests
+            self._model, self.version, self.drift_reference_file = model, version, drift_reference
+        print(f"Swapped in version {version} of model '{self.model_name}'.")
+        return True
+
+    def close(self):
+        """stop polling the registry"""
+        self._stop.set()
+
+    def _start_polling(self):
+        if (self.pinned_version is None and self.poll_interval > 0 and self._poller is None
+                and self._registry_available):
+            self._poller = threading.Thread(target=self._poll, name=f"model-poller-{self.model_name}", daemon=True)
+            self._poller.start()
+
+    def _poll(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.reload()
+            except Exception as e:  # keep serving the current model if the registry is unavailable
+                print(f"Polling for a new version of model '{self.model_name}' failed: {e}")
+
+    def _resolve_version(self):
+        """version to serve: the pinned one or the latest in the stage, None if the registry is unavailable"""
+        if self.pinned_version is not None:
+            return self.pinned_version
+        if not self._registry_available:
+            return None
+        try:
+            from mlflow.tracking import MlflowClient
+        except ImportError as e:
+            self._registry_available = False
+            print(f"Model registry unavailable, mlflow is not installed: {e}")
+            return None
+        try:
+            versions = MlflowClient().get_latest_versions(self.model_name, stages=[self.stage])
+        except Exception as e:
+            print(f"Model registry unavailable, using cached model: {e}")
+            return None
+        return str(max(int(v.version) for v in versions)) if versions else None
+
+    def _cached_versions(self):
+        """versions in the local cache with a checksum file, newest first"""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        versions = [v for v in os.listdir(self.cache_dir)
+                    if v.isdigit() and os.path.isfile(os.path.join(self.cache_dir, v, 'checksum.sha256'))]
+        return sorted(versions, key=int, reverse=True)
+
+    def _download(self, version) -> str:
+        """local directory of the model version, downloaded from the registry unless validly cached"""
+        version_dir = os.path.join(self.cache_dir, version)
+        model_dir = os.path.join(version_dir, 'model')
+        checksum_file = os.path.join(version_dir, 'checksum.sha256')
+        if os.path.isfile(checksum_file):
+            with open(checksum_file) as f:
+                if f.read().strip() == _checksum_of_directory(model_dir):
+                    return model_dir
+            print(f"Cached version {version} of model '{self.model_name}' is corrupt, downloading it again.")
+        import mlflow.artifacts
+        download_dir = version_dir + '.download'
+        shutil.rmtree(version_dir, ignore_errors=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
+        local_path = mlflow.artifacts.download_artifacts(artifact_uri=f"models:/{self.model_name}/{version}",
+                                                         dst_path=download_dir)
+        os.makedirs(version_dir)
+        os.replace(local_path, model_dir)
+        shutil.rmtree(download_dir, ignore_errors=True)
+        with open(checksum_file, 'w') as f:
+            f.write(_checksum_of_directory(model_dir))
+        return model_dir
+
+    def _load(self, version):
+        """
+        load the model of a version, falling back to the newest cached version and then to the fallback file;
+        mlflow is imported only to load a version, the fallback file is loaded without it
+
+        :return: model, version (None for the fallback file), file of its drift reference (may not exist)
+        """
+        candidates = ([version] if version is not None else []) + self._cached_versions()
+        for candidate in candidates:
+            try:
+                import mlflow.sklearn
+                with metrics.timer('model_load_seconds', source='model_store'):
+                    model_dir = self._download(candidate)
+                    model = mlflow.sklearn.load_model(model_dir)
+            except Exception as e:
+                print(f"Loading version {candidate} of model '{self.model_name}' failed: {e}")
+                continue
+            return ((_to_compact_model_if_possible(model) if self.compact else model), candidate,
+                    os.path.join(model_dir, DRIFT_REFERENCE_ARTIFACT))
+        if self.fallback_file is None:
+            raise RuntimeError(f"no version of model '{self.model_name}' available")
+        return (load_model_from_file(self.fallback_file, self.compact), None,
+                drift_reference_file(self.fallback_file))
+
+
+_model_providers = {}
+_model_providers_lock = threading.Lock()
+
+
+def get_model_provider(model_name=REGISTERED_MODEL_NAME, **kwargs) -> ModelProvider:
+    """
+    The process-wide ModelProvider for a registered model, created on first call.
+    kwargs are passed to ModelProvider on creation only.
+    """
+    with _model_providers_lock:
+        if model_name not in _model_providers:
+            _model_providers[model_name] = ModelProvider(model_name, **kwargs)
+        return _model_providers[model_name]
+
+
+# model files of a region in model_dir of ModelRegistry, in order of preference
+_REGION_MODEL_EXTENSIONS = (MODEL_ARTIFACT_EXTENSION, '.json', '.pickle')
+
+
+class ModelRegistry:
+    """
+    Models of many regions (cities, segments) in one process, routed to by region key.
+
+    * Models are loaded on first use of their region only.
+    * The models held in memory are bounded by memory_budget bytes, estimated by the pickled size of each model.
+      Beyond it, the least recently used models are evicted and loaded again on their next use.
+    * With use_model_store, the model of a region is served by a ModelProvider of registered_model_name(region),
+      with the model file in model_dir as fallback, so it is polled for new versions as long as it is held.
+      Without, the model files in model_dir are loaded directly: <region>.lpzm (model artifact), <region>.json
+      (compact) or <region>.pickle.
+    """
+
+    def __init__(self, model_dir=REGION_MODEL_DIR, memory_budget=64 * 1024 * 1024, use_model_store=True,
+                 compact=True, poll_interval=300.0):
+        """
+        :param model_dir: directory with the model files of the regions
+        :param memory_budget: bytes of models to hold in memory at most; the last used model is always held
+        :param use_model_store: load models from the ML Flow model registry, with the files as fallback
+        :param compact: serve linear models as CompactLinearModel
+        :param poll_interval: see ModelProvider
+        """
+        self.model_dir = model_dir
+        self.memory_budget = memory_budget
+        self.use_model_store = use_model_store
+        self.compact = compact
+        self.poll_interval = poll_interval
+        # region -> (model, ModelProvider or None, estimated bytes), least recently used first
+        self._models = OrderedDict()
+        self._resident_bytes = 0
+        self._lock = threading.Lock()
+        self._region_locks = {}
+        self._counters = {'hits': 0, 'loads': 0, 'evictions': 0, 'load_seconds_total': 0.0}
+
+    def regions(self) -> list:
+        """regions with a model file in model_dir"""
+        if not os.path.isdir(self.model_dir):
+            return []
+        return sorted({os.path.splitext(name)[0] for name in os.listdir(self.model_dir)
+                       if name.endswith(_REGION_MODEL_EXTENSIONS)})
+
+    def get(self, region=DEFAULT_REGION):
+        """
+        the model of a region, loaded on first use
+
+        :raises ValueError: for an invalid region key
+        :raises KeyError: if there is no model for the region
+        """
+        region = normalize_region(region)
+        with self._lock:
+            entry = self._models.get(region)
+            if entry is not None:
+                self._models.move_to_end(region)
+                self._counters['hits'] += 1
+                return self._current_model(entry)
+            region_lock = self._region_locks.setdefault(region, threading.Lock())
+
+        # load outside of the registry lock, so other regions are served meanwhile; concurrent requests for the
+        # same region wait for one load
+        with region_lock:
+            with self._lock:
+                entry = self._models.get(region)
+            if entry is None:
+                entry = self._load(region)
+                with self._lock:
+                    self._models[region] = entry
+                    self._resident_bytes += entry[2]
+                    self._evict()
+        return self._current_model(entry)
+
+    def resident(self, region) -> bool:
+        """True if the model of the region is held in memory, so get() returns without loading"""
+        with self._lock:
+            return normalize_region(region) in self._models
+
+    def predict_price(self, region, apartment_features) -> int:
+        """predict the price of an apartment with the model of its region, see predict_price_on_regression_model()"""
+        return predict_price_on_regression_model(self.get(region), apartment_features)
+
+    def stats(self) -> dict:
+        """resident models and bytes, hits, loads, evictions and the time spent loading"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['resident_models'] = len(self._models)
+            stats['resident_bytes'] = self._resident_bytes
+        return stats
+
+    def close(self):
+        """drop all models and stop the polling of their providers"""
+        with self._lock:
+            for _, provider, _ in self._models.values():
+                if provider is not None:
+                    provider.close()
+            self._models.clear()
+            self._resident_bytes = 0
+
+    @staticmethod
+    def _current_model(entry):
+        # a provider may have swapped in a new version since the region was loaded
+        model, provider, _ = entry
+        return provider.get() if provider is not None else model
+
+    def _model_file(self, region):
+        for extension in _REGION_MODEL_EXTENSIONS:
+            file_name = os.path.join(self.model_dir, region + extension)
+            if os.path.isfile(file_name):
+                return file_name
+        return None
+
+    def _load(self, region):
+        """(model, provider, estimated bytes) of a region"""
+        started = time.perf_counter()
+        model_file = self._model_file(region)
+        provider = None
+        if self.use_model_store:
+            provider = ModelProvider(registered_model_name(region), poll_interval=self.poll_interval,
+                                     fallback_file=model_file, compact=self.compact)
+            try:
+                model = provider.get()
+            except RuntimeError:
+                raise KeyError(f"no model for region '{region}'")
+        elif model_file is None:
+            raise KeyError(f"no model for region '{region}'")
+        else:
+            model = load_model_from_file(model_file, self.compact)
+        with self._lock:
+            self._counters['loads'] += 1
+            self._counters['load_seconds_total'] += time.perf_counter() - started
+        return model, provider, len(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def _evict(self):
+        """evict least recently used models beyond the memory budget, called with the lock held"""
+        while self._resident_bytes > self.memory_budget and len(self._models) > 1:
+            _, (_, provider, size) = self._models.popitem(last=False)
+            self._resident_bytes -= size
+            self._counters['evictions'] += 1
+            if provider is not None:
+                provider.close()
+
+
+def _supports_missing_values(regression_model) -> bool:
+    """True if the model imputes missing values itself"""
+    return hasattr(regression_model, 'named_steps') or getattr(regression_model, 'imputer_means', None) is not None
+
+
 def predict_price_on_regression_model(regression_model, apartment_features) -> int:
     """
     Predict the price of an apartment in Leipzig
 
-    :param regression_model: a regression_model that must be loaded beforehand via load_regression_model
+    :param regression_model: a regression_model that must be loaded beforehand via load_regression_model,
+        or a CompactLinearModel
     :param apartment_features: an input vector as numpy array of exactly 9 float values
         wohnflaeche   : apartment living area in square meters
         zimmeranzahl  : 1 to 8 or 1.5 or 2.5 for half rooms
@@ -49,18 +759,394 @@ def predict_price_on_regression_model(regression_model, apartment_features) -> i
 
     :return: predicted price in EUR
     """
+    # a timer would cost more than a compact predict() while metrics are disabled, see metrics.py
+    started = time.perf_counter() if metrics.ENABLED else None
     result = regression_model.predict(apartment_features)
+    if started is not None:
+        metrics.observe('predict_seconds', time.perf_counter() - started, path='single')
     # item() to get rid of surrounding np.array
     # rounding to cut decimals, which do not make sense anyways
     return round(result.item())
 
 
+def encode_apartment_features(apartments) -> np.ndarray:
+    """
+    Validate and encode a table of apartments into the input matrix of the regression model
+
+    :param apartments: pandas dataframe with (at least) the columns FEATURE_NAMES, or a numpy array of shape (n, 9)
+        with the columns in the order of FEATURE_NAMES.
+        energieeffizienzklasse may be given as label 'A' to 'H', the flags as booleans.
+        Sentinel values of ImmobilienScout24 (see MISSING_VALUES) are treated as missing values.
+    :return: float64 numpy array of shape (n, 9), missing values are NaN
+    :raises ValueError: for non-numeric, infinite or out of range values, see FEATURE_RANGES
+    """
+    # if pandas was never imported, apartments cannot be a dataframe
+    pd = sys.modules.get('pandas')
+    if pd is not None and isinstance(apartments, pd.DataFrame):
+        missing_columns = [name for name in FEATURE_NAMES if name not in apartments.columns]
+        if missing_columns:
+            raise ValueError(f"apartments lack the feature columns {missing_columns}")
+        columns = []
+        for name in FEATURE_NAMES:
+            column = apartments[name]
+            if name == 'energieeffizienzklasse' and not pd.api.types.is_numeric_dtype(column):
+                labels = column.astype(str).str.strip().str.upper()
+                encoded = labels.map(ENERGY_EFFICIENCY_CLASSES).fillna(pd.to_numeric(labels, errors='coerce'))
+                invalid = column.notna() & encoded.isna()
+                if invalid.any():
+                    raise ValueError(f"invalid energy efficiency classes {sorted(set(column[invalid]))[:10]}")
+                column = encoded
+            try:
+                columns.append(column.to_numpy(dtype=np.float64, na_value=np.nan))
+            except (TypeError, ValueError):
+                raise ValueError(f"feature column '{name}' is not numeric")
+        features = np.column_stack(columns) if columns else np.empty((0, len(FEATURE_NAMES)))
+    else:
+        try:
+            features = np.array(apartments, dtype=np.float64, ndmin=2)
+        except (TypeError, ValueError):
+            raise ValueError("apartments must be numeric")
+        if features.ndim != 2 or features.shape[1] != len(FEATURE_NAMES):
+            raise ValueError(f"apartments must have shape (n, {len(FEATURE_NAMES)}), got {features.shape}")
+
+    for name, sentinels in MISSING_VALUES.items():
+        column = features[:, FEATURE_NAMES.index(name)]
+        column[np.isin(column, sentinels)] = np.nan
+    # NaN compares False, infinite values are out of range
+    invalid = (features < _FEATURE_MINIMA) | (features > _FEATURE_MAXIMA)
+    if invalid.any():
+        row, j = np.argwhere(invalid)[0]
+        minimum, maximum = FEATURE_RANGES[FEATURE_NAMES[j]]
+        raise ValueError(f"feature '{FEATURE_NAMES[j]}' must be within [{minimum}, {maximum}], "
+                         f"got {features[row, j]} in row {row}")
+    return features
+
+
+def predict_prices_batch(regression_model, apartments, chunk_size=100_000) -> np.ndarray:
+    """
+    Predict the prices of many apartments in Leipzig at once
+
+    Missing values are imputed by the model, if it was trained with imputation (see training.py),
+    otherwise they are rejected.
+
+    :param regression_model: a regression_model that must be loaded beforehand via load_regression_model
+    :param apartments: pandas dataframe or numpy array, see encode_apartment_features()
+    :param chunk_size: number of apartments predicted at once, bounds the temporary memory of predict()
+    :return: predicted prices in EUR as numpy int64 array, in the order of the apartments
+    """
+    features = encode_apartment_features(apartments)
+    if not _supports_missing_values(regression_model) and np.isnan(features).any():
+        raise ValueError("apartments have missing values, but the regression model has no imputation")
+
+    prices = np.empty(len(features), dtype=np.int64)
+    with metrics.timer('predict_seconds', path='batch'):
+        for start in range(0, len(features), chunk_size):
+            chunk = features[start:start + chunk_size]
+            # rounding to cut decimals, same as predict_price_on_regression_model()
+            prices[start:start + chunk_size] = np.rint(regression_model.predict(chunk))
+    metrics.count('predict_rows_total', len(features), path='batch')
+    return prices
+
+
+# compact form of the sklearn models intervals were last asked for: id(model) -> (model, compact model)
+_interval_models = {}
+
+
+def _interval_model(regression_model) -> CompactLinearModel:
+    """the compact form of a model for intervals, converted once per model"""
+    if isinstance(regression_model, CompactLinearModel):
+        return regression_model
+    entry = _interval_models.get(id(regression_model))
+    if entry is None or entry[0] is not regression_model:
+        entry = (regression_model, compact_model_from_regression_model(regression_model))
+        _interval_models.clear()
+        _interval_models[id(regression_model)] = entry
+    return entry[1]
+
+
+def supports_prediction_intervals(regression_model) -> bool:
+    """True if the model carries the covariance of its coefficients, see CompactLinearModel.predict_interval()"""
+    try:
+        return _interval_model(regression_model).has_intervals
+    except ValueError:
+        return False
+
+
+def predict_price_interval(regression_model, apartment_features, level=0.95, kind='prediction'):
+    """
+    Range of the price of an apartment in Leipzig, see CompactLinearModel.predict_interval()
+
+    :param regression_model: a linear model trained by training.py, sklearn pipeline or CompactLinearModel
+    :param apartment_features: see predict_price_on_regression_model()
+    :param level: confidence level, e.g. 0.95
+    :param kind: 'prediction' for the price of this apartment, 'confidence' for the mean price of such apartments
+    :return: lower and upper bound in EUR
+    :raises ValueError: if the model has no coefficient covariance
+    """
+    _, lower, upper = _interval_model(regression_model).predict_interval(apartment_features, level, kind)
+    return round(lower.item()), round(upper.item())
+
+
+def predict_price_intervals_batch(regression_model, apartments, level=0.95, kind='prediction', chunk_size=100_000):
+    """
+    Price ranges of many apartments at once, vectorized like predict_prices_batch()
+
+    :param regression_model: see predict_price_interval()
+    :param apartments: pandas dataframe or numpy array, see encode_apartment_features()
+    :param level: confidence level, e.g. 0.95
+    :param kind: see predict_price_interval()
+    :param chunk_size: number of apartments evaluated at once
+    :return: lower and upper bounds in EUR as numpy int64 arrays, in the order of the apartments
+    :raises ValueError: if the model has no coefficient covariance, or for missing values without imputation
+    """
+    model = _interval_model(regression_model)
+    features = encode_apartment_features(apartments)
+    if not _supports_missing_values(model) and np.isnan(features).any():
+        raise ValueError("apartments have missing values, but the regression model has no imputation")
+
+    lower = np.empty(len(features), dtype=np.int64)
+    upper = np.empty(len(features), dtype=np.int64)
+    for start in range(0, len(features), chunk_size):
+        _, chunk_lower, chunk_upper = model.predict_interval(features[start:start + chunk_size], level, kind)
+        lower[start:start + chunk_size] = np.rint(chunk_lower)
+        upper[start:start + chunk_size] = np.rint(chunk_upper)
+    return lower, upper
+
+
+def _read_apartments_in_chunks(path, chunk_size):
+    """read a CSV (comma-separated) or Parquet file in chunks of pandas dataframes"""
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        import pandas as pd
+        yield from pd.read_csv(path, chunksize=chunk_size)
+
+
+def predict_prices_from_file(regression_model, input_path, output_path, chunk_size=100_000,
+                             interval_level=None) -> int:
+    """
+    Stream apartments from a CSV or Parquet file through the regression model into an output file.
+
+    The output has all input columns plus the estimate in column PREDICTION_COLUMN. Only one chunk
+    is held in memory at a time, so files of any size can be valued.
+
+    :param regression_model: a regression_model that must be loaded beforehand via load_regression_model
+    :param input_path: CSV (comma-separated, with header) or Parquet file with the columns FEATURE_NAMES
+    :param output_path: CSV or Parquet file to write, the format follows the file extension
+    :param chunk_size: number of apartments per chunk
+    :param interval_level: also write the prediction interval of this level, see predict_price_intervals_batch(),
+        in the columns PREDICTION_COLUMN + '_von' and '_bis'
+    :return: number of apartments valued
+    """
+    writer = None
+    n_rows = 0
+    try:
+        for i, chunk in enumerate(_read_apartments_in_chunks(input_path, chunk_size)):
+            chunk[PREDICTION_COLUMN] = predict_prices_batch(regression_model, chunk, chunk_size)
+            if interval_level is not None:
+                chunk[f'{PREDICTION_COLUMN}_von'], chunk[f'{PREDICTION_COLUMN}_bis'] = \
+                    predict_price_intervals_batch(regression_model, chunk, interval_level, chunk_size=chunk_size)
+            if output_path.endswith('.parquet'):
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_path, table.schema)
+                writer.write_table(table)
+            else:
+                chunk.to_csv(output_path, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+            n_rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_rows
+
+
+def model_fingerprint(regression_model) -> str:
+    """
+    identifies the model a lookup table was computed with: for linear models the sha256 of what determines their
+    prices (feature names, coef, intercept, imputation means), so neither caches of the model such as the factor of
+    its covariance nor the pickle format of sklearn change it; for other models the sha256 of their pickle
+    """
+    try:
+        compact_model = (regression_model if isinstance(regression_model, CompactLinearModel)
+                         else compact_model_from_regression_model(regression_model))
+    except ValueError:
+        return hashlib.sha256(pickle.dumps(regression_model)).hexdigest()
+    digest = hashlib.sha256(CompactLinearModel.FORMAT.encode('utf-8'))
+    digest.update(json.dumps(compact_model.feature_names).encode('utf-8'))
+    digest.update(compact_model.coef.astype('<f8').tobytes())
+    digest.update(np.array([compact_model.intercept], dtype='<f8').tobytes())
+    if compact_model.imputer_means is not None:
+        digest.update(compact_model.imputer_means.astype('<f8').tobytes())
+    return digest.hexdigest()
+
+
+class PriceLookupTable:
+    """
+    Price estimates of one model for every combination of UI_GRID, as int32 array with one axis per feature.
+    Loaded from disk as read-only memory map, so all server processes share one copy of it.
+    """
+
+    def __init__(self, prices, fingerprint, model_version=None):
+        # plain ndarray view of a memory map, indexing np.memmap is several times slower
+        self.prices = np.asarray(prices)
+        self._flat_prices = self.prices.reshape(-1)
+        self._strides = [stride // self.prices.itemsize for stride in self.prices.strides]
+        self.fingerprint = fingerprint
+        self.model_version = model_version
+
+    def lookup(self, apartment_features):
+        """
+        price estimate of an apartment in O(1)
+
+        :param apartment_features: 9 feature values, in the order of FEATURE_NAMES
+        :return: price in EUR, None if the apartment is not on the grid
+        """
+        flat_index = 0
+        for value, (first, step, count), stride in zip(np.ravel(apartment_features).tolist(), UI_GRID, self._strides):
+            if value is None or not math.isfinite(value):
+                # missing values are imputed by the model, infinite ones are rejected by it
+                return None
+            position = (value - first) / step
+            i = round(position)
+            if not 0 <= i < count or abs(position - i) > 1e-9:
+                return None
+            flat_index += i * stride
+        return int(self._flat_prices[flat_index])
+
+
+def build_price_lookup_table(regression_model, file_name, model_version=None, chunk_size=100_000) -> PriceLookupTable:
+    """
+    Evaluate the model on all combinations of UI_GRID and save the estimates as .npy file, with the fingerprint
+    and version of the model in a .json file next to it.
+
+    :param regression_model: model to evaluate, sklearn model or CompactLinearModel
+    :param file_name: .npy file to write
+    :param model_version: registry version of the model, for information only
+    :param chunk_size: grid points predicted at once
+    :return: the table
+    """
+    axes = [first + step * np.arange(count) for first, step, count in UI_GRID]
+    shape = tuple(count for first, step, count in UI_GRID)
+    prices = np.empty(int(np.prod(shape)), dtype=np.int32)
+    for start in range(0, len(prices), chunk_size):
+        # grid points start to start + chunk_size, in row-major order of the table
+        indices = np.unravel_index(np.arange(start, min(start + chunk_size, len(prices))), shape)
+        apartments = np.column_stack([axis[index] for axis, index in zip(axes, indices)])
+        prices[start:start + chunk_size] = predict_prices_batch(regression_model, apartments, chunk_size)
+    prices = prices.reshape(shape)
+
+    fingerprint = model_fingerprint(regression_model)
+    np.save(f"{file_name}.tmp.npy", prices)
+    with open(f"{os.path.splitext(file_name)[0]}.json", 'w') as meta_file:
+        json.dump({'fingerprint': fingerprint, 'model_version': model_version, 'grid': UI_GRID}, meta_file)
+    # the table becomes visible only when it is complete
+    os.replace(f"{file_name}.tmp.npy", file_name)
+    return PriceLookupTable(prices, fingerprint, model_version)
+
+
+def load_price_lookup_table(file_name) -> PriceLookupTable:
+    """load a table saved by build_price_lookup_table() as read-only memory map"""
+    with open(f"{os.path.splitext(file_name)[0]}.json") as meta_file:
+        meta = json.load(meta_file)
+    if [tuple(axis) for axis in meta['grid']] != UI_GRID:
+        raise ValueError(f"lookup table '{file_name}' was built for another grid")
+    return PriceLookupTable(np.load(file_name, mmap_mode='r'), meta['fingerprint'], meta['model_version'])
+
+
+# lookup table per model in memory: id(model) -> (model, table)
+_price_lookup_tables = {}
+_price_lookup_tables_lock = threading.Lock()
+
+
+def _remove_stale_lookup_tables(lookup_dir, keep):
+    """
+    remove the tables of other models, e.g. of a model swapped out or of an older fingerprint; processes still
+    serving from them keep their memory map, the file is freed when the last one unmaps it
+    """
+    for name in os.listdir(lookup_dir):
+        path = os.path.join(lookup_dir, name)
+        # tables being built by another process are left alone
+        if name.startswith('prices-') and '.tmp' not in name and not path.startswith(os.path.splitext(keep)[0]):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def get_price_lookup_table(regression_model, model_version=None, cache_dir=MODEL_CACHE_DIR) -> PriceLookupTable:
+    """
+    The lookup table of a model: from memory, else from the disk cache, else built and saved to the disk cache.
+    """
+    entry = _price_lookup_tables.get(id(regression_model))
+    if entry is not None and entry[0] is regression_model:
+        return entry[1]
+    with _price_lookup_tables_lock:
+        fingerprint = model_fingerprint(regression_model)
+        file_name = os.path.join(cache_dir, 'lookup', f"prices-{fingerprint[:16]}.npy")
+        try:
+            table = load_price_lookup_table(file_name)
+        except (OSError, ValueError):
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            table = build_price_lookup_table(regression_model, file_name, model_version)
+            _remove_stale_lookup_tables(os.path.dirname(file_name), keep=file_name)
+        # only the tables of the current models are kept, a swapped out model frees its table
+        _price_lookup_tables.clear()
+        _price_lookup_tables[id(regression_model)] = (regression_model, table)
+        return table
+
+
+def predict_price_with_lookup_table(regression_model, apartment_features) -> int:
+    """
+    Predict the price of an apartment like predict_price_on_regression_model(), but for inputs on the grid
+    of the UI from the precomputed lookup table of the model.
+    """
+    started = time.perf_counter() if metrics.ENABLED else None
+    price = get_price_lookup_table(regression_model).lookup(apartment_features)
+    if started is not None:
+        metrics.observe('predict_seconds', time.perf_counter() - started, path='lookup')
+        metrics.count('lookup_table_total', result='miss' if price is None else 'hit')
+    if price is None:
+        price = predict_price_on_regression_model(regression_model, apartment_features)
+    return price
+
+
 def main():
     """
     Some simple test code to show usage of the defined functions.
+    With --input and --output: value all apartments of a file in bulk.
     """
-    # regression_model = load_regression_model_from_file("model/lpz_apt_prices_regression_model.pickle")
-    regression_model = load_regression_model_from_model_store()
+    parser = argparse.ArgumentParser(description='Apartment price estimate for single samples or files in bulk')
+    parser.add_argument("--input", help="CSV or Parquet file with apartments, one column per feature")
+    parser.add_argument("--output", help="CSV or Parquet file to write the apartments with price estimates to")
+    parser.add_argument("--model-file", help="load the model from this file instead of the model store, "
+                                             f"a {MODEL_ARTIFACT_EXTENSION} or .json file as compact model")
+    parser.add_argument("--chunk-size", type=int, default=100_000, help="apartments predicted at once")
+    parser.add_argument("--interval", type=float, metavar="LEVEL",
+                        help="with --input: also write the prediction interval of this level, e.g. 0.95")
+    parser.add_argument("--build-lookup-table", metavar="FILE",
+                        help="evaluate the model on the grid of the UI inputs and save the estimates to this .npy file")
+    args = parser.parse_args()
+
+    if args.model_file:
+        regression_model = load_model_from_file(args.model_file)
+    else:
+        regression_model = load_regression_model_from_model_store()
+
+    if args.build_lookup_table:
+        table = build_price_lookup_table(regression_model, args.build_lookup_table)
+        print(f"Saved {table.prices.size:,} estimates to '{args.build_lookup_table}'.")
+        return
+
+    if args.input:
+        output = args.output or f"{os.path.splitext(args.input)[0]}_estimates.csv"
+        n_rows = predict_prices_from_file(regression_model, args.input, output, chunk_size=args.chunk_size,
+                                          interval_level=args.interval)
+        print(f"Valued {n_rows:,} apartments into '{output}'.")
+        return
 
     sample_apartments = [np.array([[50,  2, 1, 1, 0, 0, 0, 1, 4]]),
                          np.array([[50, 2.5, 1, 1, 0, 0, 0, 1, 4]]),
@@ -73,8 +1159,11 @@ def main():
                          ]
     for x in sample_apartments:
         apartment_price_estimate = predict_price_on_regression_model(regression_model, x)
-        price = f'{apartment_price_estimate:,}'
-        print(f"""The prediction on {x} is {price} EUR.""")
+        price = f'{apartment_price_estimate:,} EUR'
+        if supports_prediction_intervals(regression_model):
+            lower, upper = predict_price_interval(regression_model, x)
+            price += f' (95 % prediction interval {lower:,} to {upper:,} EUR)'
+        print(f"""The prediction on {x} is {price}.""")
 
 
 if __name__ == '__main__':
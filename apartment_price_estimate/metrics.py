@@ -0,0 +1,319 @@
+"""
+Lightweight instrumentation of the hot paths: latency and size histograms, counters and gauges, Prometheus text format
+
+Disabled by default, and then close to free: timer() hands out one shared no-op context manager, observe(),
+count() and set_gauge() return after a single check. Enabled with the environment variable METRICS_ENABLED=1 or
+with enable().
+Even a no-op with-block costs a few hundred nanoseconds, more than a compact predict() takes, so paths of a few
+microseconds per call check ENABLED themselves and take the time only then:
+    started = time.perf_counter() if metrics.ENABLED else None
+
+Export, all in the Prometheus text exposition format:
+* render() - the text of all metrics; served by service.py on GET /metrics
+* write_file() - written atomically, e.g. for the textfile collector of the node exporter; training.py writes
+  METRICS_FILE at the end of a run
+* start_http_server() - for processes without an HTTP server of their own, e.g. the Streamlit app with METRICS_PORT
+
+SamplingProfiler samples the stacks of all threads of the process at a fixed interval, with no dependency and no
+cost while off, and writes them as collapsed stacks for flamegraph.pl or speedscope. It is switched on per run with
+PROFILE_OUTPUT=<file>, see start_profiler_from_environment(), or with --profile of training.py and service.py.
+
+This module imports the standard library only, so the serving path stays fast to import.
+"""
+
+import atexit
+import bisect
+import collections
+import os
+import sys
+import threading
+import time
+
+ENABLED = os.environ.get('METRICS_ENABLED', '0').lower() in ('1', 'true', 'yes')
+
+# file to write the metrics to at the end of a training run, see write_file()
+METRICS_FILE = os.environ.get('METRICS_FILE')
+
+# port of the metrics endpoint of processes without HTTP server of their own, see start_http_server()
+METRICS_PORT = os.environ.get('METRICS_PORT')
+
+# upper bounds of the latency buckets in seconds: from a compact predict (µs) to a training stage (minutes)
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# upper bounds of the size buckets in bytes
+SIZE_BUCKETS = (1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+
+# prefix of all metric names
+PREFIX = 'lpz_'
+
+
+class Histogram:
+    """distribution of observed values in cumulative buckets, with count and sum, like a Prometheus histogram"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+# (name, sorted labels) -> Histogram, counter or gauge value
+_histograms = {}
+_counters = collections.defaultdict(float)
+_gauges = {}
+_lock = threading.Lock()
+
+
+def enable(enabled=True):
+    """switch the instrumentation on or off for the whole process"""
+    global ENABLED
+    ENABLED = enabled
+
+
+def reset():
+    """drop all values recorded so far"""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """
+    record a value in the histogram of a metric
+
+    :param name: metric name without PREFIX, by convention with its unit, e.g. 'predict_seconds'
+    :param value: observed value
+    :param buckets: bucket bounds, used when the histogram is recorded to for the first time
+    :param labels: label name -> value, e.g. path='batch'
+    """
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+
+def count(name, value=1, **labels):
+    """add to a counter, see observe() for name and labels"""
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[(name, tuple(sorted(labels.items())))] += value
+
+
+def set_gauge(name, value, **labels):
+    """set a gauge to its current value, e.g. the PSI of a column of drift.py; see observe() for name and labels"""
+    if not ENABLED:
+        return
+    with _lock:
+        _gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.labels['error'] = exc_type.__name__
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timer(name, **labels):
+    """
+    context manager that records its duration in seconds in the histogram of a metric, see observe();
+    a block left by an exception is recorded with label error=<exception type>
+    """
+    return _Timer(name, labels) if ENABLED else _NO_TIMER
+
+
+def _format_labels(labels, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + '}'
+
+
+def render() -> str:
+    """all metrics in the Prometheus text exposition format"""
+    with _lock:
+        histograms = {key: (histogram.buckets, list(histogram.bucket_counts), histogram.count, histogram.sum)
+                      for key, histogram in _histograms.items()}
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+
+    lines = []
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f'# TYPE {PREFIX}{name} histogram')
+        for (metric, labels), (buckets, bucket_counts, total, value_sum) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels, le=le)} {cumulative}')
+            lines.append(f'{PREFIX}{name}_sum{_format_labels(labels)} {value_sum!r}')
+            lines.append(f'{PREFIX}{name}_count{_format_labels(labels)} {total}')
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f'# TYPE {PREFIX}{name} counter')
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f'{PREFIX}{name}{_format_labels(labels)} {value!r}')
+    for name in sorted({name for name, _ in gauges}):
+        lines.append(f'# TYPE {PREFIX}{name} gauge')
+        for (metric, labels), value in sorted(gauges.items()):
+            if metric == name:
+                lines.append(f'{PREFIX}{name}{_format_labels(labels)} {float(value)!r}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_file(file_name=None):
+    """write render() to a file, atomically, so a collector never reads half a file; default METRICS_FILE"""
+    file_name = file_name or METRICS_FILE
+    if not file_name:
+        return
+    with open(f'{file_name}.tmp', 'w') as metrics_file:
+        metrics_file.write(render())
+    os.replace(f'{file_name}.tmp', file_name)
+
+
+_http_servers = {}
+
+
+def start_http_server(port=None, address=''):
+    """
+    serve render() on http://<address>:<port>/metrics in a daemon thread, once per port and process
+
+    :param port: default METRICS_PORT; without, no server is started
+    :return: the server, None without port
+    """
+    port = int(port or METRICS_PORT or 0)
+    if not port:
+        return None
+    with _lock:
+        if port not in _http_servers:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            server = ThreadingHTTPServer((address, port), MetricsHandler)
+            threading.Thread(target=server.serve_forever, name=f'metrics-{port}', daemon=True).start()
+            _http_servers[port] = server
+        return _http_servers[port]
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a daemon thread takes the stacks of all other threads every interval seconds and counts
+    each distinct stack. stop() writes them as collapsed stacks, one line "frame;frame;... count" per stack, for
+    flamegraph.pl or speedscope. The overhead is the sampling thread only, about 1 % at the default interval.
+    """
+
+    def __init__(self, output, interval=0.005):
+        """
+        :param output: file to write the collapsed stacks to
+        :param interval: seconds between samples
+        """
+        self.output = output
+        self.interval = interval
+        self.samples = 0
+        self._stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """stop sampling and write the collapsed stacks"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        with open(self.output, 'w') as output_file:
+            for stack, stack_count in self._stacks.most_common():
+                output_file.write(f'{stack} {stack_count}\n')
+        print(f"Profiled {self.samples:,} samples into '{self.output}'.")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        own_thread = threading.get_ident()
+        thread_names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                thread_names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                frames.append(thread_names.get(thread_id, str(thread_id)))
+                self._stacks[';'.join(reversed(frames))] += 1
+            self.samples += 1
+
+
+def start_profiler_from_environment():
+    """
+    start a SamplingProfiler if PROFILE_OUTPUT is set, writing to that file when the process exits
+
+    :return: the profiler, None if PROFILE_OUTPUT is not set
+    """
+    output = os.environ.get('PROFILE_OUTPUT')
+    if not output:
+        return None
+    profiler = SamplingProfiler(output, float(os.environ.get('PROFILE_INTERVAL', '0.005'))).start()
+    atexit.register(profiler.stop)
+    return profiler
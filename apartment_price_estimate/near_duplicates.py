@@ -0,0 +1,235 @@
+"""
+Detection of near-duplicate offers: relisted apartments that the duplicateid of ImmobilienScout24 does not mark
+
+An apartment that is taken offline and listed again, often with a slightly changed price or a corrected living area,
+is a new offer with its own obid, so it counts twice in training. Two offers are near duplicates if
+* all discrete features are equal (rooms, bed and bath rooms, the flags, energy efficiency class; missing equals
+  missing),
+* their living areas differ by at most area_tolerance square meters,
+* their prices differ by at most price_tolerance (relative to the lower price) and
+* their listing periods overlap or are at most max_months_apart months apart.
+Near duplicates are merged transitively into clusters, of which the most recently listed offer is kept.
+
+Comparing all pairs of offers is quadratic. Instead, the offers are blocked by a hash of the discrete features and
+a bucket of the living area, sorted by price within a block and compared with their neighbours in price order only
+as long as the price is within tolerance. The area buckets are 2 * area_tolerance wide and laid out twice, the
+second grid shifted by area_tolerance, so every pair within tolerance shares a block in at least one of the grids.
+The work is a sort plus the number of candidate pairs, near-linear in the number of offers.
+
+The data has no location, so different apartments with the same features and about the same price and time of
+listing (e.g. the units of a new building) are merged as well; the tolerances are kept tight for that reason.
+
+Run from within apartment_price_estimate/ for a report of the near duplicates in a CampusFile:
+python near_duplicates.py --data-file ../data/CampusFile_Wohnungskauf_Leipzig.csv --report near_duplicates.csv
+"""
+
+import argparse
+
+import numpy as np
+
+# most difference of the living areas of near duplicates in square meters
+AREA_TOLERANCE = 1.0
+
+# most difference of the prices of near duplicates, relative to the lower price
+PRICE_TOLERANCE = 0.05
+
+# most months between the end of one listing and the start of the other
+MAX_MONTHS_APART = 6
+
+# features that must be equal for near duplicates
+BLOCK_COLUMNS = ['zimmeranzahl', 'schlafzimmer', 'badezimmer', 'aufzug', 'balkon', 'denkmalobjekt', 'parkplatz',
+                 'energieeffizienzklasse']
+
+# merged clusters of the last training, see remove_near_duplicate_offers()
+NEAR_DUPLICATES_REPORT_FILE = 'near_duplicates.csv'
+
+
+def _float_column(df_offers, name) -> np.ndarray:
+    return df_offers[name].to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def _month_column(df_offers, name) -> np.ndarray:
+    """months since 1970 as float, NaN for missing months"""
+    import pandas as pd
+
+    months = pd.to_datetime(df_offers[name]).to_numpy().astype('datetime64[M]')
+    missing = np.isnat(months)
+    months = months.astype(np.int64).astype(np.float64)
+    months[missing] = np.nan
+    return months
+
+
+def _block_codes(df_offers, block_columns) -> np.ndarray:
+    """one int64 per offer, equal for offers with equal block columns (missing values included)"""
+    codes = np.zeros(len(df_offers), dtype=np.int64)
+    for name in block_columns:
+        # NaN sorts last in np.unique, so missing values get a code of their own
+        values = df_offers[name].to_numpy(na_value=np.nan)
+        _, column_codes = np.unique(values, return_inverse=True, equal_nan=values.dtype.kind == 'f')
+        cardinality = int(column_codes.max(initial=0)) + 1
+        if int(codes.max(initial=0)) >= 2 ** 62 // cardinality:
+            # renumber the combinations seen so far densely, so the codes never overflow
+            codes = np.unique(codes, return_inverse=True)[1].reshape(-1)
+        codes = codes * cardinality + column_codes.reshape(-1)
+    return codes
+
+
+def find_near_duplicate_pairs(df_offers, area_tolerance=AREA_TOLERANCE, price_tolerance=PRICE_TOLERANCE,
+                              max_months_apart=MAX_MONTHS_APART, block_columns=BLOCK_COLUMNS):
+    """
+    All pairs of near-duplicate offers, see the module documentation.
+
+    :param df_offers: offers as pandas dataframe with the columns kaufpreis, wohnflaeche, adat, edat and block_columns
+    :param block_columns: columns that must be equal for near duplicates, e.g. BLOCK_COLUMNS plus a numeric region id
+        for offers of several cities
+    :return: (first, second) int64 arrays of row positions, each pair once with first < second; offers without
+        price or living area have no near duplicates
+    """
+    prices = _float_column(df_offers, 'kaufpreis')
+    areas = _float_column(df_offers, 'wohnflaeche')
+    starts = _month_column(df_offers, 'adat')
+    ends = _month_column(df_offers, 'edat')
+    candidates = np.flatnonzero(np.isfinite(prices) & np.isfinite(areas))
+    codes = _block_codes(df_offers, block_columns)[candidates]
+    prices, areas = prices[candidates], areas[candidates]
+    starts, ends = starts[candidates], ends[candidates]
+
+    bucket_width = 2 * area_tolerance if area_tolerance > 0 else 1.0
+    first, second = [], []
+    for offset in (0.0, area_tolerance):
+        buckets = np.floor((areas + offset) / bucket_width).astype(np.int64)
+        buckets -= buckets.min(initial=0)
+        keys = codes * (int(buckets.max(initial=0)) + 1) + buckets
+        order = np.lexsort((prices, keys))
+        sorted_keys, sorted_prices = keys[order], prices[order]
+        # compare every offer with the offer `shift` places further in price order, as long as any of them is
+        # in the same block and within the price tolerance; prices only grow with the shift
+        left = np.arange(len(order) - 1)
+        shift = 1
+        while left.size:
+            right = left + shift
+            in_range = right < len(order)
+            left, right = left[in_range], right[in_range]
+            in_tolerance = ((sorted_keys[right] == sorted_keys[left])
+                            & (sorted_prices[right] <= sorted_prices[left] * (1 + price_tolerance)))
+            left, right = left[in_tolerance], right[in_tolerance]
+            i, j = order[left], order[right]
+            close = np.abs(areas[i] - areas[j]) <= area_tolerance
+            # listing periods overlap or are at most max_months_apart apart; missing months do not rule out a pair
+            with np.errstate(invalid='ignore'):
+                apart = np.maximum(starts[i] - ends[j], starts[j] - ends[i])
+            close &= ~(apart > max_months_apart)
+            first.append(np.minimum(i[close], j[close]))
+            second.append(np.maximum(i[close], j[close]))
+            shift += 1
+
+    first = candidates[np.concatenate(first)] if first else np.empty(0, dtype=np.int64)
+    second = candidates[np.concatenate(second)] if second else np.empty(0, dtype=np.int64)
+    # pairs within tolerance of both grids are found twice
+    pairs = np.unique(first * len(df_offers) + second)
+    return pairs // len(df_offers), pairs % len(df_offers)
+
+
+def near_duplicate_clusters(n_offers, first, second) -> np.ndarray:
+    """
+    Merge pairs of near duplicates transitively into clusters.
+
+    :param n_offers: number of offers
+    :param first: row positions of the pairs, see find_near_duplicate_pairs()
+    :param second: row positions of the pairs
+    :return: int64 array of the cluster of each offer; offers without near duplicates have a cluster of their own
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    graph = coo_matrix((np.ones(len(first), dtype=np.int8), (first, second)), shape=(n_offers, n_offers))
+    _, labels = connected_components(graph, directed=False)
+    return labels.astype(np.int64)
+
+
+def remove_near_duplicate_offers(df_offers, area_tolerance=AREA_TOLERANCE, price_tolerance=PRICE_TOLERANCE,
+                                 max_months_apart=MAX_MONTHS_APART, block_columns=BLOCK_COLUMNS):
+    """
+    Keep one offer per cluster of near duplicates: the most recently listed one (latest edat, then adat, then obid),
+    as a relisted apartment is offered at its last price.
+
+    :param df_offers: offers as pandas dataframe, see find_near_duplicate_pairs(), with column obid
+    :return: (offers without near duplicates, report with one row per merged cluster), both pandas dataframes;
+        the report has the columns cluster, offers, kept_obid, merged_obids (space separated), kaufpreis_min,
+        kaufpreis_max, wohnflaeche_min, wohnflaeche_max, adat_first, edat_last
+    """
+    import pandas as pd
+
+    first, second = find_near_duplicate_pairs(df_offers, area_tolerance, price_tolerance, max_months_apart,
+                                              block_columns)
+    labels = near_duplicate_clusters(len(df_offers), first, second)
+    sizes = np.bincount(labels)
+    merged = np.flatnonzero(sizes[labels] > 1)
+
+    # most recent offer last within each cluster; missing months sort first
+    recency = [df_offers['obid'].to_numpy()[merged], _month_column(df_offers, 'adat')[merged],
+               _month_column(df_offers, 'edat')[merged], labels[merged]]
+    recency[1] = np.nan_to_num(recency[1], nan=-np.inf)
+    recency[2] = np.nan_to_num(recency[2], nan=-np.inf)
+    ordered = merged[np.lexsort(recency)]
+    ordered_labels = labels[ordered]
+    is_last = np.append(ordered_labels[1:] != ordered_labels[:-1], True) if len(ordered) else np.empty(0, bool)
+    kept = ordered[is_last]
+    dropped = ordered[~is_last]
+
+    keep = np.ones(len(df_offers), dtype=bool)
+    keep[dropped] = False
+    df_kept = df_offers[keep]
+
+    df_merged = df_offers.iloc[ordered][['obid', 'kaufpreis', 'wohnflaeche', 'adat', 'edat']].assign(
+        cluster=ordered_labels)
+    grouped = df_merged.groupby('cluster', sort=True)
+    # the offers of a cluster are consecutive in ordered, joined without a Python call per group
+    obids = df_merged['obid'].astype(str).to_numpy()
+    df_report = pd.DataFrame({
+        'offers': grouped.size(),
+        'kept_obid': pd.Series(df_offers['obid'].to_numpy()[kept], index=ordered_labels[is_last]),
+        'merged_obids': pd.Series([' '.join(part) for part in np.split(obids, np.flatnonzero(is_last[:-1]) + 1)]
+                                  if len(obids) else [], index=ordered_labels[is_last], dtype=object),
+        'kaufpreis_min': grouped['kaufpreis'].min(),
+        'kaufpreis_max': grouped['kaufpreis'].max(),
+        'wohnflaeche_min': grouped['wohnflaeche'].min(),
+        'wohnflaeche_max': grouped['wohnflaeche'].max(),
+        'adat_first': grouped['adat'].min(),
+        'edat_last': grouped['edat'].max(),
+    }).rename_axis('cluster').reset_index()
+    return df_kept, df_report
+
+
+def print_report(df_offers, df_kept, df_report):
+    """summary of remove_near_duplicate_offers()"""
+    print(f"Near duplicates: {len(df_offers) - len(df_kept):,} of {len(df_offers):,} offers merged into "
+          f"{len(df_report):,} clusters, {len(df_kept):,} offers kept.")
+    if not df_report.empty:
+        spread = (df_report['kaufpreis_max'] / df_report['kaufpreis_min'] - 1) * 100
+        print(f"Offers per cluster: median {df_report['offers'].median():g}, max {df_report['offers'].max()}; "
+              f"price spread within clusters: median {spread.median():.1f} %, max {spread.max():.1f} %")
+
+
+def main():
+    import training as training
+
+    parser = argparse.ArgumentParser(description='Report near-duplicate offers of a CampusFile')
+    parser.add_argument("--data-file", default='../data/CampusFile_Wohnungskauf_Leipzig.csv')
+    parser.add_argument("--keep-since-year", type=int, default=2020)
+    parser.add_argument("--area-tolerance", type=float, default=AREA_TOLERANCE, help="square meters")
+    parser.add_argument("--price-tolerance", type=float, default=PRICE_TOLERANCE, help="relative, e.g. 0.05")
+    parser.add_argument("--max-months-apart", type=int, default=MAX_MONTHS_APART)
+    parser.add_argument("--report", default=NEAR_DUPLICATES_REPORT_FILE, help="CSV file of the merged clusters")
+    args = parser.parse_args()
+
+    df_offers = training.load_preprocessed_immo24_offers(args.data_file, keep_since_year=args.keep_since_year)
+    df_kept, df_report = remove_near_duplicate_offers(df_offers, args.area_tolerance, args.price_tolerance,
+                                                      args.max_months_apart)
+    print_report(df_offers, df_kept, df_report)
+    df_report.to_csv(args.report, index=False)
+    print(f"Report written to '{args.report}'.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+"""
+HTTP service for the apartment price estimate, for API clients without the Streamlit UI
+
+JSON endpoints:
+* POST /estimate   - one apartment as JSON object with the features of inference.FEATURE_NAMES,
+                     answers {"kaufpreis_schaetzung": 184865}
+* POST /estimates  - {"apartments": [{...}, ...]}, answers {"kaufpreis_schaetzung": [184865, ...]}
+* both with ?region=<key> - estimate with the model of another region, see inference.ModelRegistry and --model-dir
+* GET  /healthz    - liveness probe, 200 as long as the process serves requests
+* GET  /readyz     - readiness probe, 200 once the model is loaded, 503 before and while shutting down
+* GET  /metrics    - request, model load and predict latencies of the worker in the Prometheus text format,
+                     recorded with --metrics or METRICS_ENABLED=1, see metrics.py; with the drift of the
+                     apartments estimated with the default model from its training data, see drift.py
+
+energieeffizienzklasse may be given as label 'A' to 'H' or as number 1 to 8, the flags as booleans or 0/1.
+Features that are missing or null are imputed by the model, if it was trained with imputation.
+
+Concurrent requests are coalesced by a MicroBatcher: the apartments of all requests arriving within max_delay are
+stacked and predicted with one vectorized call of inference.predict_prices_batch(), which gives the same prices as
+inference.predict_price_on_regression_model() for every single apartment.
+The model is served by inference.get_model_provider(), so a new "Production" version is swapped in while running.
+Models of other regions are loaded on first request and evicted least recently used beyond --model-memory-mb;
+each region has its own batcher, as a batch is predicted with one model.
+
+The service runs on tornado, which comes with Streamlit. With --workers, the port is bound once and shared by
+several forked worker processes, each with its own model and batcher (0 = one worker per CPU):
+python service.py --port 8080 --workers 4
+"""
+
+import argparse
+import asyncio
+import json
+import signal
+
+import numpy as np
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
+import tornado.web
+
+import drift as drift
+import inference as inference
+import metrics as metrics
+
+# fallback if neither the model registry nor the local model cache are available, see inference.ModelProvider
+MODEL_FALLBACK_FILE = 'model/lpz_apt_prices_regression_model.lpzm'
+
+# seconds between attempts to load the model, if loading failed on startup
+MODEL_LOAD_RETRY_INTERVAL = 10.0
+
+
+class MicroBatcher:
+    """
+    Coalesces the apartments of concurrent requests into vectorized predict calls.
+
+    The first apartments after a flush start a timer of max_delay seconds. All apartments submitted until the timer
+    fires are predicted in one batch, earlier if max_batch_size apartments are pending. Predictions run on the event
+    loop: a vectorized predict of a batch takes microseconds to about a millisecond, less than handing it to a thread.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=1024, max_delay=0.002):
+        """
+        :param predict_batch: function of a feature matrix, returning the prices in the order of its rows
+        :param max_batch_size: number of pending apartments that triggers a prediction right away
+        :param max_delay: seconds the first pending apartments wait for others to join their batch
+        """
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.batches = 0
+        self.apartments = 0
+        self._pending = []
+        self._pending_rows = 0
+        self._timer = None
+
+    async def predict(self, features) -> np.ndarray:
+        """prices of the rows of an encoded feature matrix, predicted together with those of concurrent requests"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((features, future))
+        self._pending_rows += len(features)
+        if self._pending_rows >= self.max_batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self.flush)
+        return await future
+
+    def flush(self):
+        """predict all pending apartments in one batch and hand each request its share of the prices"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending, self._pending_rows = self._pending, [], 0
+        if not pending:
+            return
+        try:
+            prices = self.predict_batch(np.concatenate([features for features, _ in pending]))
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.apartments += len(prices)
+        start = 0
+        for features, future in pending:
+            # a request whose client went away has a cancelled future
+            if not future.done():
+                future.set_result(prices[start:start + len(features)])
+            start += len(features)
+
+
+def apartments_from_json(apartments) -> np.ndarray:
+    """
+    Validate and encode apartments of a JSON request into the input matrix of the regression model
+
+    :param apartments: list of dicts of feature name -> value, as parsed from JSON
+    :return: float64 numpy array of shape (n, 9), missing values are NaN
+    :raises ValueError: if an apartment is no object, has unknown features or invalid values, e.g. infinite or out
+        of range, see inference.encode_apartment_features(); answered with 400
+    """
+    if not isinstance(apartments, list) or not apartments:
+        raise ValueError("apartments must be a non-empty list")
+    rows = []
+    for apartment in apartments:
+        if not isinstance(apartment, dict):
+            raise ValueError("each apartment must be a JSON object")
+        unknown_features = sorted(set(apartment) - set(inference.FEATURE_NAMES))
+        if unknown_features:
+            raise ValueError(f"unknown features {unknown_features}, expected {inference.FEATURE_NAMES}")
+        row = []
+        for name in inference.FEATURE_NAMES:
+            value = apartment.get(name)
+            if value is None:
+                row.append(np.nan)
+            elif name == 'energieeffizienzklasse' and isinstance(value, str):
+                label = value.strip().upper()
+                if label not in inference.ENERGY_EFFICIENCY_CLASSES:
+                    raise ValueError(f"invalid energy efficiency class '{value}'")
+                row.append(inference.ENERGY_EFFICIENCY_CLASSES[label])
+            elif isinstance(value, (bool, int, float)):
+                row.append(float(value))
+            else:
+                raise ValueError(f"feature '{name}' must be a number")
+        rows.append(row)
+    return inference.encode_apartment_features(rows)
+
+
+class PriceEstimateService:
+    """model provider, micro-batcher and state shared by the request handlers of a worker process"""
+
+    def __init__(self, model_provider, max_batch_size=1024, max_delay=0.002, max_apartments=10_000,
+                 model_registry=None, drift_monitor=None):
+        """
+        :param model_provider: inference.ModelProvider to take the current model from for every batch
+        :param max_batch_size: see MicroBatcher
+        :param max_delay: see MicroBatcher
+        :param max_apartments: most apartments accepted in one request
+        :param model_registry: inference.ModelRegistry for the models of regions other than inference.DEFAULT_REGION
+        :param drift_monitor: drift.DriftMonitor the apartments estimated with the default model are observed by
+        """
+        self.model_provider = model_provider
+        self.max_apartments = max_apartments
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.batcher = MicroBatcher(self._predict_batch, max_batch_size=max_batch_size, max_delay=max_delay)
+        self.model_registry = model_registry
+        self.drift_monitor = drift_monitor
+        # regions are listed once, so requests for unknown regions neither touch the disk nor grow region_batchers
+        self.regions = set(model_registry.regions()) if model_registry is not None else set()
+        self.region_batchers = {}
+        self.draining = False
+
+    @property
+    def ready(self) -> bool:
+        return self.model_provider.loaded and not self.draining
+
+    def _predict_batch(self, features) -> np.ndarray:
+        return inference.predict_prices_batch(self.model_provider.get(), features)
+
+    def _region_batcher(self, region) -> MicroBatcher:
+        if region not in self.region_batchers:
+            def predict_batch(features):
+                return inference.predict_prices_batch(self.model_registry.get(region), features)
+            self.region_batchers[region] = MicroBatcher(predict_batch, max_batch_size=self.max_batch_size,
+                                                        max_delay=self.max_delay)
+        return self.region_batchers[region]
+
+    async def estimate(self, apartments, region=None) -> list:
+        """
+        :param apartments: apartments of one request, see apartments_from_json()
+        :param region: region key of the model to estimate with, default: inference.DEFAULT_REGION
+        :return: estimated prices in EUR, in the order of the apartments
+        :raises ValueError: if the apartments or the region key are invalid
+        :raises KeyError: if there is no model for the region
+        """
+        if isinstance(apartments, list) and len(apartments) > self.max_apartments:
+            raise ValueError(f"at most {self.max_apartments} apartments per request")
+        region = inference.normalize_region(region) if region is not None else inference.DEFAULT_REGION
+        if region == inference.DEFAULT_REGION:
+            model, batcher = self.model_provider.get(), self.batcher
+        elif region in self.regions:
+            if not self.model_registry.resident(region):
+                # loading may download from the model store, which must not block the event loop
+                await asyncio.get_running_loop().run_in_executor(None, self.model_registry.get, region)
+            model, batcher = self.model_registry.get(region), self._region_batcher(region)
+        else:
+            raise KeyError(f"no model for region '{region}'")
+        features = apartments_from_json(apartments)
+        # checked per request, so a single invalid request cannot fail the whole batch it is coalesced into
+        if not inference._supports_missing_values(model) and np.isnan(features).any():
+            raise ValueError("apartments have missing values, but the regression model has no imputation")
+        if self.drift_monitor is not None and region == inference.DEFAULT_REGION:
+            # the reference of the monitor is the training data of the default model
+            self.drift_monitor.observe_rows('query', features)
+        prices = await batcher.predict(features)
+        return prices.tolist()
+
+    async def load_model(self):
+        """load the model in a thread, retrying until it succeeds, so the probes answer in the meantime"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.model_provider.get)
+            except Exception as e:
+                print(f"Loading the model failed, retrying in {MODEL_LOAD_RETRY_INTERVAL:.0f} s: {e}")
+                await asyncio.sleep(MODEL_LOAD_RETRY_INTERVAL)
+                continue
+            print(f"Model version {self.model_provider.version or 'from fallback file'} loaded.")
+            return
+
+
+class JsonHandler(tornado.web.RequestHandler):
+    def initialize(self, service):
+        self.service = service
+
+    def json_body(self):
+        try:
+            return json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="request body is not valid JSON")
+
+    def write_error(self, status_code, **kwargs):
+        self.finish({'error': self._reason})
+
+    def on_finish(self):
+        metrics.observe('request_seconds', self.request.request_time(), handler=type(self).__name__,
+                        status=self.get_status())
+
+    async def estimate(self, apartments):
+        if not self.service.ready:
+            raise tornado.web.HTTPError(503, reason="model not loaded")
+        try:
+            return await self.service.estimate(apartments, region=self.get_query_argument('region', None))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+        except KeyError as e:
+            raise tornado.web.HTTPError(404, reason=e.args[0])
+
+
+class EstimateHandler(JsonHandler):
+    async def post(self):
+        prices = await self.estimate([self.json_body()])
+        self.finish({inference.PREDICTION_COLUMN: prices[0]})
+
+
+class EstimatesHandler(JsonHandler):
+    async def post(self):
+        body = self.json_body()
+        apartments = body.get('apartments') if isinstance(body, dict) else None
+        if apartments is None:
+            raise tornado.web.HTTPError(400, reason="request body must be {\"apartments\": [...]}")
+        self.finish({inference.PREDICTION_COLUMN: await self.estimate(apartments)})
+
+
+class LivenessHandler(JsonHandler):
+    def get(self):
+        self.finish({'status': 'alive'})
+
+
+class ReadinessHandler(JsonHandler):
+    def get(self):
+        service = self.service
+        if not service.ready:
+            self.set_status(503)
+            self.finish({'status': 'draining' if service.draining else 'loading'})
+            return
+        status = {'status': 'ready', 'model_version': service.model_provider.version,
+                  'batches': service.batcher.batches, 'apartments': service.batcher.apartments}
+        if service.model_registry is not None:
+            status['regions'] = len(service.regions)
+            status['region_models'] = service.model_registry.stats()
+        self.finish(status)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(metrics.render())
+
+
+def make_app(service) -> tornado.web.Application:
+    handler_arguments = {'service': service}
+    return tornado.web.Application([
+        (r'/estimate', EstimateHandler, handler_arguments),
+        (r'/estimates', EstimatesHandler, handler_arguments),
+        (r'/healthz', LivenessHandler, handler_arguments),
+        (r'/readyz', ReadinessHandler, handler_arguments),
+        (r'/metrics', MetricsHandler),
+    ])
+
+
+async def serve(sockets, model_provider, max_batch_size, max_delay, max_apartments, model_registry=None,
+                drift_monitor=None):
+    """serve on the bound sockets until SIGTERM or SIGINT, then finish the requests in flight"""
+    service = PriceEstimateService(model_provider, max_batch_size=max_batch_size, max_delay=max_delay,
+                                   max_apartments=max_apartments, model_registry=model_registry,
+                                   drift_monitor=drift_monitor)
+    server = tornado.httpserver.HTTPServer(make_app(service), xheaders=True)
+    server.add_sockets(sockets)
+    model_loading = asyncio.ensure_future(service.load_model())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, stop.set)
+    await stop.wait()
+
+    service.draining = True
+    server.stop()
+    service.batcher.flush()
+    for batcher in service.region_batchers.values():
+        batcher.flush()
+    await server.close_all_connections()
+    model_loading.cancel()
+    if drift_monitor is not None:
+        drift_monitor.flush()
+    model_provider.close()
+    if model_registry is not None:
+        model_registry.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP service for apartment price estimates')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--address", default='', help="address to bind, default: all interfaces")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, 0: one per CPU")
+    parser.add_argument("--max-batch-size", type=int, default=1024,
+                        help="pending apartments that are predicted right away")
+    parser.add_argument("--max-delay-ms", type=float, default=2.0,
+                        help="milliseconds a request waits for concurrent requests to join its batch")
+    parser.add_argument("--max-apartments", type=int, default=10_000, help="most apartments in one request")
+    parser.add_argument("--model-version", help="serve this registry version instead of the latest in Production")
+    parser.add_argument("--model-file", default=MODEL_FALLBACK_FILE,
+                        help="model file used if the registry and the local model cache are unavailable")
+    parser.add_argument("--model-dir", help="serve the models of the regions in this directory with ?region=, e.g. "
+                                            f"{inference.REGION_MODEL_DIR}")
+    parser.add_argument("--model-memory-mb", type=float, default=64,
+                        help="megabytes of region models held in memory per worker")
+    parser.add_argument("--no-model-store", action='store_true',
+                        help="load the region models from --model-dir only, not from the ML Flow model registry")
+    parser.add_argument("--metrics", action='store_true', help="record the metrics served on /metrics")
+    parser.add_argument("--drift-reference",
+                        help="sketch of the training data the estimated apartments are compared with, see drift.py; "
+                             "default: the one registered with the served model version, or next to --model-file")
+    parser.add_argument("--drift-state", default=drift.DRIFT_STATE_FILE,
+                        help="write the live sketches of each worker to DRIFT_STATE.<worker>, for drift.py --live")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="sample the stacks of each worker and write them as collapsed stacks to FILE.<worker> "
+                             "on shutdown")
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.enable()
+
+    sockets = tornado.netutil.bind_sockets(args.port, args.address)
+    if args.workers != 1:
+        # forks before any model is loaded or thread started, every worker loads its own model
+        tornado.process.fork_processes(args.workers)
+    model_provider = inference.get_model_provider(compact=True, version=args.model_version,
+                                                  fallback_file=args.model_file)
+    model_registry = None
+    if args.model_dir:
+        model_registry = inference.ModelRegistry(model_dir=args.model_dir,
+                                                 memory_budget=int(args.model_memory_mb * 1024 * 1024),
+                                                 use_model_store=not args.no_model_store)
+    task_id = tornado.process.task_id()
+    worker = 0 if task_id is None else task_id
+    drift_monitor = drift.get_drift_monitor(reference_file=args.drift_reference,
+                                            state_file=f'{args.drift_state}.{worker}' if args.drift_state else None,
+                                            model_provider=None if args.drift_reference else model_provider)
+    print(f"Worker {worker} serving on port {args.port}.")
+    profiler = metrics.SamplingProfiler(f'{args.profile}.{worker}').start() if args.profile else None
+    try:
+        asyncio.run(serve(sockets, model_provider, args.max_batch_size, args.max_delay_ms / 1000,
+                          args.max_apartments, model_registry, drift_monitor))
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,61 +1,629 @@
 """
 Basic MInIO client to get and save feedback in a fixed file: group7/feedback.csv
+
+Feedback can also be written as an append-only log:
+* every feedback record (or small batch of records) is its own immutable CSV object ("shard") below
+  group7/feedback/shards/, partitioned by day and hour of submission
+* a compaction job merges shards into columnar Parquet snapshots below group7/feedback/snapshots/
+So a submit costs one small PUT, no matter how much feedback has been collected before.
+
+FeedbackWriter takes the PUT off the caller's thread: records are buffered in a bounded queue and written
+as one shard per batch by a background thread.
+
+FEEDBACK_SCHEMA types and bounds the columns of a feedback record for both sides: the app validates records with
+feedback_record() before writing them, training reads them by column name with read_feedback_csv() and
+get_feedback_dataframe(), and validate_feedback() quarantines invalid records and drops repeated submissions.
 """
 
-from minio import Minio
-from minio.error import S3Error
+import argparse
+import atexit
+import io
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING
 
 from dotenv import load_dotenv
 import os
 
+try:
+    from . import metrics
+except ImportError:
+    import metrics
+
+if TYPE_CHECKING:
+    # for the annotations only, pandas itself is imported on first use, see below
+    import pandas as pd
+
+# minio and pandas are imported on first use only: the minio client is created with the first feedback, and
+# pandas is needed to read and compact the feedback log, not to write it
+
 # Loading environment variables for MinIO: ACCESS_KEY and SECRET_KEY
 load_dotenv()
 
+# MinIO server and bucket of the feedback, e.g. MINIO_ENDPOINT=localhost:9000 MINIO_SECURE=false for a local stand-in
+MINIO_ENDPOINT = os.environ.get('MINIO_ENDPOINT', 'api.storage.sws.informatik.uni-leipzig.de')
+MINIO_SECURE = os.environ.get('MINIO_SECURE', 'true').lower() not in ('0', 'false', 'no')
+FEEDBACK_BUCKET = os.environ.get('MINIO_BUCKET', 'group7')
+
+# connections per host kept open in the connection pool shared by all clients and threads of the process
+MINIO_POOL_SIZE = int(os.environ.get('MINIO_POOL_SIZE', '16'))
+
+# local copies of downloaded objects, each with the ETag it was downloaded with, see download_object()
+STORAGE_CACHE_DIR = os.environ.get('STORAGE_CACHE_DIR',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'lpz-apt-prices', 'storage'))
+
+# bytes of a download written to disk at a time
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+_http_client = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _create_http_client():
+    """
+    connection pool for all MinIO clients of the process: bounded timeouts, so a hanging server cannot block the
+    feedback writer for minutes, and retries with backoff for connection errors and temporary server errors
+    """
+    import certifi
+    import urllib3
+    return urllib3.PoolManager(
+        maxsize=MINIO_POOL_SIZE,
+        timeout=urllib3.Timeout(connect=10, read=60),
+        retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504],
+                              respect_retry_after_header=True),
+        cert_reqs='CERT_REQUIRED',
+        ca_certs=os.environ.get('SSL_CERT_FILE') or certifi.where())
+
 
-def create_client() -> object:
+def create_client(endpoint=None, secure=None) -> object:
     """
-    Create client for MinIO server.
+    Client for the MinIO server, created once per endpoint and then shared by all callers of the process.
+    MinIO clients are thread-safe, and all of them share one pool of persistent connections.
 
+    :param endpoint: host[:port] of the server, default MINIO_ENDPOINT
+    :param secure: use HTTPS, default MINIO_SECURE
     :return: client object
     """
-    client = Minio(
-        "api.storage.sws.informatik.uni-leipzig.de",
-        access_key=os.environ.get('ACCESS_KEY'),
-        secret_key=os.environ.get('SECRET_KEY')
-    )
-    return client
+    global _http_client
+    endpoint = endpoint or MINIO_ENDPOINT
+    secure = MINIO_SECURE if secure is None else secure
+    with _clients_lock:
+        if (endpoint, secure) not in _clients:
+            from minio import Minio
+            if _http_client is None:
+                _http_client = _create_http_client()
+            _clients[(endpoint, secure)] = Minio(
+                endpoint,
+                access_key=os.environ.get('ACCESS_KEY'),
+                secret_key=os.environ.get('SECRET_KEY'),
+                secure=secure,
+                http_client=_http_client
+            )
+        return _clients[(endpoint, secure)]
+
+
+def download_object(client, bucket, object_name, file_name, chunk_size=DOWNLOAD_CHUNK_SIZE) -> bool:
+    """
+    Download an object to a local file, unless the local file is still current.
+
+    The ETag of the download is kept next to the file (file_name + '.etag') and sent as If-None-Match with the next
+    download, so an unchanged object costs one request without body. The body is streamed to disk as is, in chunks
+    of chunk_size bytes, and replaces the local file only once it is complete.
+
+    :param client: MinIO client, see create_client()
+    :param bucket: bucket of the object
+    :param object_name: name of the object
+    :param file_name: local file to download to
+    :param chunk_size: bytes read and written at a time
+    :return: True if downloaded, False if the local file was current
+    """
+    from minio.error import ServerError
+    etag_file = file_name + '.etag'
+    request_headers = {}
+    if os.path.isfile(file_name) and os.path.isfile(etag_file):
+        with open(etag_file) as f:
+            request_headers['If-None-Match'] = f.read().strip()
 
+    response = None
+    started = time.perf_counter()
+    try:
+        try:
+            response = client.get_object(bucket, object_name, request_headers=request_headers)
+        except ServerError as e:
+            if e.status_code == 304:  # not modified
+                metrics.count('storage_not_modified_total')
+                return False
+            raise
+        os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+        partial_file = f"{file_name}.{uuid.uuid4().hex}.part"
+        size = 0
+        try:
+            with open(partial_file, 'wb') as f:
+                for chunk in response.stream(chunk_size):
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(partial_file, file_name)
+        finally:
+            if os.path.exists(partial_file):
+                os.remove(partial_file)
+        # written after the file, so a stale ETag can never vouch for a new file
+        with open(etag_file, 'w') as f:
+            f.write(response.headers.get('ETag', ''))
+        metrics.observe('storage_download_seconds', time.perf_counter() - started, operation='file')
+        metrics.observe('storage_download_bytes', size, buckets=metrics.SIZE_BUCKETS, operation='file')
+    finally:
+        if response is not None:
+            response.close()
+            response.release_conn()
+    return True
+
+
+def _cached_object_file(bucket, object_name) -> str:
+    """local file of an object below STORAGE_CACHE_DIR"""
+    return os.path.join(STORAGE_CACHE_DIR, bucket, *object_name.split('/'))
 
-def upload_to_minio(client):
+
+def upload_to_minio(client, bucket=FEEDBACK_BUCKET):
     """
-    Uploads feedback.csv (has to be in working directory) to minio group7
-    s3 bucket.
+    Uploads feedback.csv (has to be in working directory) to the s3 bucket.
     """
+    from minio.error import S3Error
     try:
-        client.fput_object("group7", "feedback.csv", "./feedback.csv")
-        print("'feedback.csv' was successfully uploaded to bucket 'group7'.")
+        client.fput_object(bucket, "feedback.csv", "./feedback.csv")
+        print(f"'feedback.csv' was successfully uploaded to bucket '{bucket}'.")
     except S3Error as e:
         print(e.message, e.args)
 
 
-def get_feedback_from_minio(client):
+def get_feedback_from_minio(client, bucket=FEEDBACK_BUCKET, file_name="feedback.csv"):
     """
-    Connects to group7 minio bucket and retrieves feedback.csv as bytestream.
-    Bytestream gets saved as feedback.csv in working directory.
+    Retrieves feedback.csv from the bucket and saves it as file_name, by default in the working directory.
+    The file is streamed to disk and only downloaded again if it changed, see download_object().
+    Empty lines are skipped when reading it, see read_feedback_csv().
     """
+    from minio.error import S3Error
     try:
-        # Get data of an object.
-        response = client.get_object("group7", "feedback.csv")
-        print("'feedback.csv' was successfully received from bucket 'group7'.")
-        # Split the long string into a list of lines
-        lines = response.data.decode('utf-8').splitlines()
-        # Open CSV file for writing
-        with open("feedback.csv", "w") as csv_file:
-            for line in lines:
-                if not line.isspace():  # necessary to get rid of empty lines in CSV
-                    csv_file.write(line + "\n")
+        if download_object(client, bucket, "feedback.csv", file_name):
+            print(f"'feedback.csv' was successfully received from bucket '{bucket}'.")
+        else:
+            print(f"'feedback.csv' in bucket '{bucket}' is unchanged, using '{file_name}'.")
     except S3Error as e:
         print(e.message, e.args)
+
+
+FEEDBACK_SHARD_PREFIX = "feedback/shards/"
+FEEDBACK_SNAPSHOT_PREFIX = "feedback/snapshots/"
+
+# typed schema of a feedback record, shared by the app that writes and training that reads the feedback:
+# column -> (dtype, minimum, maximum, step), in the column order of the feedback log.
+# Bounds and steps are those of the inputs of the app, so feedback outside of them is corrupt. Step None allows any
+# value within the bounds. session_id identifies the UI session that submitted the record.
+FEEDBACK_SCHEMA = {
+    'kaufpreis': ('float64', 20_000, 1_400_000, None),
+    'wohnflaeche': ('float64', 30, 230, None),
+    'zimmeranzahl': ('float64', 1, 8, 0.5),
+    'schlafzimmer': ('int8', 0, 5, 1),
+    'badezimmer': ('int8', 1, 3, 1),
+    'aufzug': ('int8', 0, 1, 1),
+    'balkon': ('int8', 0, 1, 1),
+    'denkmalobjekt': ('int8', 0, 1, 1),
+    'parkplatz': ('int8', 0, 1, 1),
+    'energieeffizienzklasse': ('int8', 1, 8, 1),
+    'session_id': ('string', None, None, None),
+}
+
+# column order of a feedback record, same as the header of the shards of the feedback log
+FEEDBACK_COLUMNS = list(FEEDBACK_SCHEMA)
+
+# columns of feedback.csv and of shards written before the session was recorded, also assumed for files without header
+LEGACY_FEEDBACK_COLUMNS = FEEDBACK_COLUMNS[:-1]
+
+
+def feedback_record(values) -> list:
+    """
+    Validate one feedback record against FEEDBACK_SCHEMA.
+
+    :param values: dict of column -> value, with all columns of FEEDBACK_SCHEMA
+    :return: values in the order of FEEDBACK_COLUMNS
+    :raises ValueError: if a column is missing or unknown, or a value violates the schema
+    """
+    missing_columns = [column for column in FEEDBACK_COLUMNS if column not in values]
+    unknown_columns = sorted(set(values) - set(FEEDBACK_COLUMNS))
+    if missing_columns or unknown_columns:
+        raise ValueError(f"feedback record lacks columns {missing_columns} or has unknown columns {unknown_columns}")
+    record = []
+    for column, (dtype, minimum, maximum, step) in FEEDBACK_SCHEMA.items():
+        value = values[column]
+        if dtype == 'string':
+            value = str(value)
+            if not value or any(character in value for character in ',"\r\n'):
+                raise ValueError(f"feedback {column} must be a non-empty string without separators")
+        else:
+            value = float(value)
+            if not minimum <= value <= maximum or (step is not None and value % step != 0):
+                raise ValueError(f"feedback {column} {value} is not within [{minimum}, {maximum}]"
+                                 + (f" in steps of {step}" if step is not None else ""))
+            if dtype != 'float64':
+                value = int(value)
+        record.append(value)
+    return record
+
+
+def _shard_object_name(now) -> str:
+    """
+    Name of a new feedback shard, partitioned by day and hour of submission.
+    The random suffix keeps concurrent sessions from ever writing to the same object.
+    """
+    return (f"{FEEDBACK_SHARD_PREFIX}dt={now:%Y-%m-%d}/hour={now:%H}/"
+            f"{now:%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex}.csv")
+
+
+def shard_watermark(shard_name, lag) -> str:
+    """
+    Lower bound for reading the feedback log again after the shard shard_name was read: the names of all shards
+    submitted up to lag before it sort after the bound. A shard is named by the clock of its writer when the upload
+    starts, so a slow upload or a writer with a clock behind lands shards that sort before the newest one already read.
+
+    :param shard_name: object name of a shard, see _shard_object_name()
+    :param lag: time the bound trails the shard
+    :return: name to compare shard names with, e.g. as since_shard of get_feedback_dataframe()
+    """
+    submitted = datetime.strptime(shard_name.rsplit('/', 1)[-1][:21], '%Y%m%dT%H%M%S%f')
+    bound = submitted - lag
+    return f"{FEEDBACK_SHARD_PREFIX}dt={bound:%Y-%m-%d}/hour={bound:%H}/{bound:%Y%m%dT%H%M%S%f}"
+
+
+def put_feedback_shard(client, records, bucket=FEEDBACK_BUCKET, now=None) -> str:
+    """
+    Write feedback records as one new immutable object to the feedback log.
+
+    :param client: MinIO client, see create_client()
+    :param records: list of feedback records, each a list of values in the order of FEEDBACK_COLUMNS,
+        see feedback_record()
+    :param bucket: bucket holding the feedback log
+    :param now: time of submission (UTC), used for the partition of the shard
+    :return: object name of the written shard
+    """
+    now = now or datetime.now(timezone.utc)
+    lines = [",".join(FEEDBACK_COLUMNS)]
+    for record in records:
+        if len(record) != len(FEEDBACK_COLUMNS):
+            raise ValueError(f"feedback record needs {len(FEEDBACK_COLUMNS)} values, got {len(record)}")
+        lines.append(",".join(str(value) for value in record))
+    data = ("\n".join(lines) + "\n").encode('utf-8')
+
+    object_name = _shard_object_name(now)
+    with metrics.timer('storage_upload_seconds', operation='feedback_shard'):
+        client.put_object(bucket, object_name, io.BytesIO(data), length=len(data), content_type="text/csv")
+    metrics.observe('storage_upload_bytes', len(data), buckets=metrics.SIZE_BUCKETS, operation='feedback_shard')
+    return object_name
+
+
+def _read_object(client, bucket, object_name) -> bytes:
+    """read a whole (small) object into memory"""
+    started = time.perf_counter()
+    response = client.get_object(bucket, object_name)
+    try:
+        data = response.read()
     finally:
         response.close()
         response.release_conn()
+    metrics.observe('storage_download_seconds', time.perf_counter() - started, operation='object')
+    metrics.observe('storage_download_bytes', len(data), buckets=metrics.SIZE_BUCKETS, operation='object')
+    return data
+
+
+def _list_objects(client, bucket, prefix, suffix):
+    """list objects below a prefix, recursively, that end with the given suffix"""
+    return [obj for obj in client.list_objects(bucket, prefix=prefix, recursive=True)
+            if obj.object_name.endswith(suffix)]
+
+
+def _typed_feedback(frame, extra_columns=()) -> 'pd.DataFrame':
+    """
+    columns of FEEDBACK_SCHEMA (and extra_columns) of a feedback dataframe, matched by name: numbers as float64,
+    so that values, which are missing, no numbers or from a missing column, become NaN; session_id as string
+    """
+    import pandas as pd
+    typed = pd.DataFrame(index=frame.index)
+    for column, (dtype, _, _, _) in FEEDBACK_SCHEMA.items():
+        values = frame[column] if column in frame else pd.Series(None, index=frame.index, dtype='object')
+        if dtype == 'string':
+            typed[column] = values.astype('string')
+        else:
+            typed[column] = pd.to_numeric(values, errors='coerce').astype('float64')
+    for column in extra_columns:
+        typed[column] = frame[column] if column in frame else pd.Series(None, index=frame.index, dtype='string')
+    return typed
+
+
+def read_feedback_csv(source) -> 'pd.DataFrame':
+    """
+    Read a feedback CSV file (feedback.csv or a shard of the feedback log) into the columns of FEEDBACK_SCHEMA.
+
+    Columns are matched by the names in the header, not by position. A file without header is read as
+    LEGACY_FEEDBACK_COLUMNS. Columns the file lacks are missing values, unknown columns are dropped, and values
+    that are no numbers become missing values, so validate_feedback() quarantines them.
+
+    :param source: path or file-like object of the CSV file
+    :return: pandas dataframe with the columns FEEDBACK_COLUMNS, numbers as float64
+    """
+    import pandas as pd
+    try:
+        frame = pd.read_csv(source, sep=",", header=None, dtype=str, skip_blank_lines=True, on_bad_lines='warn')
+    except pd.errors.EmptyDataError:
+        frame = pd.DataFrame()
+    if len(frame) and set(frame.iloc[0].str.strip()) <= set(FEEDBACK_COLUMNS):
+        frame.columns = list(frame.iloc[0].str.strip())
+        frame = frame.iloc[1:]
+    else:
+        frame = frame.iloc[:, :len(LEGACY_FEEDBACK_COLUMNS)]
+        frame.columns = LEGACY_FEEDBACK_COLUMNS[:frame.shape[1]]
+    return _typed_feedback(frame.reset_index(drop=True))
+
+
+def _read_snapshots(client, bucket) -> 'pd.DataFrame':
+    """read all compacted snapshots, each row keeps the name of the shard it came from in column 'shard'"""
+    import pandas as pd
+    frames = []
+    for obj in _list_objects(client, bucket, FEEDBACK_SNAPSHOT_PREFIX, ".parquet"):
+        # snapshots are immutable, so they are downloaded once and then read from the local cache
+        snapshot_file = _cached_object_file(bucket, obj.object_name)
+        download_object(client, bucket, obj.object_name, snapshot_file)
+        frames.append(pd.read_parquet(snapshot_file))
+    if not frames:
+        return _typed_feedback(pd.DataFrame(), extra_columns=['shard'])
+    # snapshots written before the session was recorded lack session_id
+    return _typed_feedback(pd.concat(frames, ignore_index=True), extra_columns=['shard'])
+
+
+def _read_shards(client, bucket, shard_objects) -> 'pd.DataFrame':
+    """read the given shards into one dataframe, with the name of the shard in column 'shard'"""
+    import pandas as pd
+    frames = []
+    for obj in shard_objects:
+        frame = read_feedback_csv(io.BytesIO(_read_object(client, bucket, obj.object_name)))
+        frame['shard'] = obj.object_name
+        frames.append(frame)
+    if not frames:
+        return _typed_feedback(pd.DataFrame(), extra_columns=['shard'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_feedback_dataframe(client, bucket=FEEDBACK_BUCKET, since_shard=None, with_shard=False) -> 'pd.DataFrame':
+    """
+    Read the whole feedback log: all compacted snapshots plus the shards that are not compacted yet.
+    Shards that were already merged into a snapshot, but not yet deleted, are only counted once.
+    Records are in order of submission: snapshots and shards are both named by time, and every snapshot only holds
+    shards older than the ones not compacted yet. The records are not validated, see validate_feedback().
+
+    :param client: MinIO client, see create_client()
+    :param bucket: bucket holding the feedback log
+    :param since_shard: only read records of shards with a name after this one, i.e. submitted later.
+        Older shards that are not compacted yet are not even downloaded.
+    :param with_shard: keep the name of the source shard of every record in column 'shard'
+    :return: pandas dataframe with the columns FEEDBACK_COLUMNS (and 'shard'), numbers as float64
+    """
+    import pandas as pd
+    df_snapshots = _read_snapshots(client, bucket)
+    compacted = set(df_snapshots['shard'])
+    pending = [obj for obj in _list_objects(client, bucket, FEEDBACK_SHARD_PREFIX, ".csv")
+               if obj.object_name not in compacted and (since_shard is None or obj.object_name > since_shard)]
+    if since_shard is not None:
+        df_snapshots = df_snapshots[df_snapshots['shard'] > since_shard]
+    df_shards = _read_shards(client, bucket, pending)
+    columns = FEEDBACK_COLUMNS + (['shard'] if with_shard else [])
+    frames = [frame for frame in (df_snapshots, df_shards) if not frame.empty]
+    if not frames:
+        return df_shards[columns]
+    return pd.concat(frames, ignore_index=True)[columns]
+
+
+def validate_feedback(df_feedback):
+    """
+    Split feedback into valid and quarantined records, and count repeated submissions of a session only once.
+
+    A record is quarantined if a value is missing, no number, or outside the bounds and steps of FEEDBACK_SCHEMA:
+    feedback always comes with all values from the inputs of the app, so such records are corrupt and must not
+    skew the training data or the means of the imputation.
+    A session that submitted the same apartment more than once counts once, with its last price. Records without
+    session (written before it was recorded) are all kept. Runs in linear time in the number of records.
+
+    :param df_feedback: feedback as read by read_feedback_csv() or get_feedback_dataframe(), in order of submission
+    :return: valid records with the dtypes of FEEDBACK_SCHEMA,
+        quarantined records with the first violation of the schema in column 'reason'
+    """
+    import pandas as pd
+    reason = pd.Series(None, index=df_feedback.index, dtype='object')
+    for column, (dtype, minimum, maximum, step) in FEEDBACK_SCHEMA.items():
+        if dtype == 'string':
+            continue
+        values = df_feedback[column]
+        violations = [(values.isna(), f"{column} missing or no number"),
+                      ((values < minimum) | (values > maximum), f"{column} not within [{minimum}, {maximum}]")]
+        if step is not None:
+            violations.append((values % step != 0, f"{column} not in steps of {step}"))
+        for violation, text in violations:
+            reason = reason.mask(reason.isna() & violation, text)
+
+    is_valid = reason.isna()
+    df_quarantined = df_feedback[~is_valid].assign(reason=reason[~is_valid])
+    df_valid = df_feedback[is_valid]
+    # hash-based, the last submission of an apartment by the same session wins
+    repeated = df_valid['session_id'].notna() & df_valid.duplicated(subset=FEEDBACK_COLUMNS[1:], keep='last')
+    df_valid = df_valid[~repeated].astype({column: dtype for column, (dtype, _, _, _) in FEEDBACK_SCHEMA.items()})
+    return df_valid.reset_index(drop=True), df_quarantined.reset_index(drop=True)
+
+
+def compact_feedback_shards(client, bucket=FEEDBACK_BUCKET, min_age=timedelta(minutes=5), now=None):
+    """
+    Merge feedback shards into one new columnar snapshot (Parquet) and delete the merged shards afterwards.
+
+    Only shards older than min_age are compacted, so writers still in flight are never raced.
+    The snapshot remembers the source shard of every row; if the job dies between writing the snapshot
+    and deleting the shards, readers and the next run skip the already compacted shards.
+
+    :param client: MinIO client, see create_client()
+    :param bucket: bucket holding the feedback log
+    :param min_age: minimum age of a shard to be compacted
+    :param now: current time (UTC)
+    :return: object name of the new snapshot, None if there was nothing to compact
+    """
+    now = now or datetime.now(timezone.utc)
+    compacted = set(_read_snapshots(client, bucket)['shard'])
+    shard_objects = [obj for obj in _list_objects(client, bucket, FEEDBACK_SHARD_PREFIX, ".csv")
+                     if obj.last_modified is None or obj.last_modified <= now - min_age]
+
+    new_shards = [obj for obj in shard_objects if obj.object_name not in compacted]
+    snapshot_name = None
+    if new_shards:
+        df_feedback = _read_shards(client, bucket, new_shards)
+        buffer = io.BytesIO()
+        df_feedback[FEEDBACK_COLUMNS + ['shard']].to_parquet(buffer, index=False)
+        data = buffer.getvalue()
+        snapshot_name = f"{FEEDBACK_SNAPSHOT_PREFIX}feedback-{now:%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex}.parquet"
+        client.put_object(bucket, snapshot_name, io.BytesIO(data), length=len(data),
+                          content_type="application/vnd.apache.parquet")
+        print(f"Compacted {len(new_shards)} shards with {len(df_feedback)} records into '{snapshot_name}'.")
+
+    for obj in shard_objects:
+        client.remove_object(bucket, obj.object_name)
+    return snapshot_name
+
+
+class FeedbackWriter:
+    """
+    Background writer for the feedback log.
+
+    submit() only puts the record into a bounded queue and returns immediately. A daemon thread collects records
+    into batches and writes each batch as one shard with put_feedback_shard(), as soon as either batch_size records
+    are waiting or the oldest waiting record is max_delay seconds old. Failed writes are retried with exponential
+    backoff; records are dropped (and counted) only if the queue is full or all retries failed.
+    """
+
+    def __init__(self, client, bucket=FEEDBACK_BUCKET, max_queue_size=10000, batch_size=100, max_delay=5.0,
+                 max_retries=3, retry_backoff=0.5):
+        """
+        :param client: MinIO client, see create_client()
+        :param bucket: bucket holding the feedback log
+        :param max_queue_size: records waiting to be written, submit() drops records beyond that
+        :param batch_size: flush as soon as that many records are waiting
+        :param max_delay: flush at the latest that many seconds after the oldest waiting record was submitted
+        :param max_retries: retries of a failed flush before the batch is dropped
+        :param retry_backoff: seconds to wait before the first retry, doubled for every further retry
+        """
+        self._client = client
+        self._bucket = bucket
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self._counters = {'queued': 0, 'flushed': 0, 'dropped': 0, 'flushes': 0, 'retries': 0,
+                          'flush_seconds_total': 0.0, 'flush_seconds_max': 0.0}
+        self._thread = threading.Thread(target=self._run, name="feedback-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, record) -> bool:
+        """
+        Queue one feedback record for writing, without waiting for the storage.
+
+        :param record: dict of column -> value, see feedback_record()
+        :return: True if queued, False if dropped because the writer is closed or its queue is full
+        :raises ValueError: if the record violates FEEDBACK_SCHEMA
+        """
+        record = feedback_record(record)
+        if not self._closed.is_set():
+            try:
+                self._queue.put_nowait(record)
+                self._count('queued')
+                return True
+            except queue.Full:
+                pass
+        self._count('dropped')
+        return False
+
+    def stats(self) -> dict:
+        """counters of the writer: queued, flushed, dropped records, number of flushes, retries and flush latency"""
+        with self._lock:
+            stats = dict(self._counters)
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+    def close(self, timeout=30.0):
+        """stop accepting records, flush all waiting records and stop the background thread"""
+        self._closed.set()
+        self._thread.join(timeout)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _run(self):
+        """loop of the background thread: collect a batch, flush it, until closed and drained"""
+        while not (self._closed.is_set() and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self._max_delay
+            while len(batch) < self._batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    if self._closed.is_set() or remaining <= 0:
+                        # deadline reached or closing: take only what is already waiting
+                        batch.append(self._queue.get_nowait())
+                    else:
+                        batch.append(self._queue.get(timeout=min(remaining, 0.1)))
+                except queue.Empty:
+                    if self._closed.is_set() or remaining <= 0:
+                        break
+            self._flush(batch)
+
+    def _flush(self, batch):
+        """write one batch as one shard, retry with exponential backoff on failure"""
+        for attempt in range(self._max_retries + 1):
+            started = time.perf_counter()
+            try:
+                put_feedback_shard(self._client, batch, bucket=self._bucket)
+            except Exception as e:  # any failure of the storage must not kill the writer thread
+                print(f"Writing {len(batch)} feedback records failed (attempt {attempt + 1}): {e}")
+                if attempt < self._max_retries:
+                    self._count('retries')
+                    time.sleep(self._retry_backoff * 2 ** attempt)
+                continue
+            seconds = time.perf_counter() - started
+            metrics.observe('feedback_flush_seconds', seconds)
+            metrics.count('feedback_records_total', len(batch), result='flushed')
+            with self._lock:
+                self._counters['flushed'] += len(batch)
+                self._counters['flushes'] += 1
+                self._counters['flush_seconds_total'] += seconds
+                self._counters['flush_seconds_max'] = max(self._counters['flush_seconds_max'], seconds)
+            return
+        metrics.count('feedback_records_total', len(batch), result='dropped')
+        self._count('dropped', len(batch))
+
+
+def main():
+    """
+    Compaction job for the feedback log, to be run periodically.
+    """
+    parser = argparse.ArgumentParser(description='Compact the feedback log into columnar snapshots')
+    parser.add_argument("--bucket", default=FEEDBACK_BUCKET, help="bucket holding the feedback log")
+    parser.add_argument("--min-age", type=int, default=5, help="minimum age of a shard in minutes")
+    args = parser.parse_args()
+
+    client = create_client()
+    compact_feedback_shards(client, bucket=args.bucket, min_age=timedelta(minutes=args.min_age))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+Sweep over model families and hyperparameters for the apartment price estimate
+
+Evaluates several model families with k-fold cross validation in a pool of worker processes:
+* linear:     mean imputation + LinearRegression, the production model of training.py
+* tweedie:    mean imputation + scaling + TweedieRegressor with log link
+* ridge_poly: mean imputation + polynomial terms of the living area + scaling + Ridge
+* boosting:   HistGradientBoostingRegressor, which handles missing values itself
+
+The feature matrix is written once to .npy files and opened by every worker as read-only memory map, so the folds
+share one copy in the page cache instead of pickling the data to each task.
+The result is a leaderboard of accuracy (RMSE, MAE, R²), fit time and predict latency. The best (or a selected)
+candidate can be refitted on all data and registered in the ML Flow model store, from where app.py and service.py
+serve it. A linear candidate is also saved as model artifact like the model of training.py, the fallback of app.py
+and service.py; the artifact holds linear models only, so for other candidates the fallback files stay unchanged:
+
+python sweep.py --folds 5 --workers 4 --save
+python sweep.py --select linear --save
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import drift as drift
+import inference as inference
+import training as training
+
+# index of wohnflaeche in the input matrix, for the polynomial area terms
+AREA_COLUMN = inference.FEATURE_NAMES.index('wohnflaeche')
+
+# feature matrix and labels in each worker process, opened once by _open_shared_data()
+_shared_data = {}
+
+
+def candidate_configurations():
+    """
+    all candidates of the sweep
+
+    :return: dict of candidate name -> (model family, hyperparameters)
+    """
+    candidates = {'linear': ('linear', {})}
+    for power in (1.5, 2.0):
+        for alpha in (0.01, 1.0):
+            candidates[f'tweedie-power={power}-alpha={alpha}'] = ('tweedie', {'power': power, 'alpha': alpha})
+    for degree in (2, 3):
+        for alpha in (0.1, 1.0, 10.0):
+            candidates[f'ridge_poly-degree={degree}-alpha={alpha}'] = ('ridge_poly', {'degree': degree, 'alpha': alpha})
+    for max_iter in (100, 300):
+        candidates[f'boosting-max_iter={max_iter}'] = ('boosting', {'max_iter': max_iter, 'learning_rate': 0.1})
+    return candidates
+
+
+def build_model(family, hyperparameters):
+    """
+    unfitted sklearn pipeline of a model family
+
+    :param family: 'linear', 'tweedie', 'ridge_poly' or 'boosting'
+    :param hyperparameters: keyword arguments of the family, see candidate_configurations()
+    """
+    from sklearn.compose import ColumnTransformer
+    from sklearn.ensemble import HistGradientBoostingRegressor
+    from sklearn.impute import SimpleImputer
+    from sklearn.linear_model import LinearRegression, Ridge, TweedieRegressor
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import PolynomialFeatures, StandardScaler
+
+    imputer = ('imputer', SimpleImputer(missing_values=np.nan, strategy='mean'))
+    if family == 'linear':
+        # same steps as train_regression_model(), so the model has a compact form for serving
+        return Pipeline([imputer, ('regression', LinearRegression())])
+    if family == 'tweedie':
+        return Pipeline([imputer, ('scaler', StandardScaler()),
+                         ('regression', TweedieRegressor(power=hyperparameters['power'], alpha=hyperparameters['alpha'],
+                                                         link='log', max_iter=1000))])
+    if family == 'ridge_poly':
+        area_terms = ColumnTransformer([('area', PolynomialFeatures(hyperparameters['degree'], include_bias=False),
+                                         [AREA_COLUMN])], remainder='passthrough')
+        return Pipeline([imputer, ('area_terms', area_terms), ('scaler', StandardScaler()),
+                         ('regression', Ridge(alpha=hyperparameters['alpha']))])
+    if family == 'boosting':
+        return Pipeline([('regression', HistGradientBoostingRegressor(max_iter=hyperparameters['max_iter'],
+                                                                      learning_rate=hyperparameters['learning_rate'],
+                                                                      random_state=0))])
+    raise ValueError(f"unknown model family '{family}'")
+
+
+def _open_shared_data(data_dir):
+    """initializer of the worker processes: open the feature matrix and labels as read-only memory maps"""
+    _shared_data['X'] = np.load(os.path.join(data_dir, 'X.npy'), mmap_mode='r')
+    _shared_data['y'] = np.load(os.path.join(data_dir, 'y.npy'), mmap_mode='r')
+
+
+def _evaluate_fold(name, family, hyperparameters, n_folds, fold, seed):
+    """fit a candidate on all but one fold and evaluate it on that fold, in a worker process"""
+    X, y = _shared_data['X'], _shared_data['y']
+    folds = np.array_split(np.random.default_rng(seed).permutation(len(y)), n_folds)
+    test_index = folds[fold]
+    train_index = np.concatenate(folds[:fold] + folds[fold + 1:])
+
+    model = build_model(family, hyperparameters)
+    start = time.perf_counter()
+    model.fit(X[train_index], y[train_index])
+    fit_seconds = time.perf_counter() - start
+
+    X_test, y_test = X[test_index], y[test_index]
+    start = time.perf_counter()
+    y_predicted = model.predict(X_test)
+    batch_seconds = time.perf_counter() - start
+
+    # latency of a single estimate as in the app, median of repeated calls
+    single_row = X_test[:1]
+    single_seconds = []
+    for _ in range(20):
+        start = time.perf_counter()
+        model.predict(single_row)
+        single_seconds.append(time.perf_counter() - start)
+
+    residuals = y_test - y_predicted
+    return {'name': name, 'fold': fold,
+            'rmse': float(np.sqrt(np.mean(residuals ** 2))),
+            'mae': float(np.mean(np.abs(residuals))),
+            'r2': float(1 - np.sum(residuals ** 2) / np.sum((y_test - y_test.mean()) ** 2)),
+            'fit_seconds': fit_seconds,
+            'predict_us_per_row': batch_seconds / len(test_index) * 1e6,
+            'predict_us_single': float(np.median(single_seconds)) * 1e6}
+
+
+def run_sweep(X, y, candidates, n_folds=5, workers=None, seed=0):
+    """
+    Evaluate all candidates with k-fold cross validation in a process pool.
+
+    :param X: input matrix of the regression model, with NaN for missing values
+    :param y: prices
+    :param candidates: dict of name -> (family, hyperparameters), see candidate_configurations()
+    :param n_folds: number of folds
+    :param workers: number of worker processes, default: number of CPUs
+    :param seed: seed of the fold assignment, same folds for all candidates
+    :return: leaderboard as list of dicts, averaged over the folds, best RMSE first
+    """
+    data_dir = tempfile.mkdtemp(prefix='sweep-')
+    try:
+        np.save(os.path.join(data_dir, 'X.npy'), np.ascontiguousarray(X, dtype=np.float64))
+        np.save(os.path.join(data_dir, 'y.npy'), np.ascontiguousarray(y, dtype=np.float64))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_open_shared_data, initargs=(data_dir,)) as pool:
+            futures = [pool.submit(_evaluate_fold, name, family, hyperparameters, n_folds, fold, seed)
+                       for name, (family, hyperparameters) in candidates.items() for fold in range(n_folds)]
+            results = [future.result() for future in futures]
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    leaderboard = []
+    for name in candidates:
+        folds = [result for result in results if result['name'] == name]
+        entry = {'name': name}
+        for metric in ('rmse', 'mae', 'r2', 'fit_seconds', 'predict_us_per_row', 'predict_us_single'):
+            entry[metric] = float(np.mean([fold[metric] for fold in folds]))
+        entry['rmse_std'] = float(np.std([fold['rmse'] for fold in folds]))
+        leaderboard.append(entry)
+    return sorted(leaderboard, key=lambda entry: entry['rmse'])
+
+
+def print_leaderboard(leaderboard):
+    print()
+    print(f"{'candidate':42} {'RMSE':>10} {'± std':>9} {'MAE':>10} {'R²':>7} {'fit s':>8} "
+          f"{'µs/row':>8} {'µs single':>10}")
+    for entry in leaderboard:
+        print(f"{entry['name']:42} {entry['rmse']:10,.0f} {entry['rmse_std']:9,.0f} {entry['mae']:10,.0f} "
+              f"{entry['r2']:7.3f} {entry['fit_seconds']:8.3f} {entry['predict_us_per_row']:8.2f} "
+              f"{entry['predict_us_single']:10.1f}")
+
+
+def main() -> int:
+    """
+    Sweep pipeline: load the (cached) preprocessed training data, evaluate all candidates, print the leaderboard,
+    optionally refit the winner on all data and save it like training.py does
+    """
+    parser = argparse.ArgumentParser(description='Cross-validated sweep over model families and hyperparameters')
+    parser.add_argument("-f", action='store_true', help="include feedback data in training")
+    parser.add_argument("--folds", type=int, default=5, help="number of cross validation folds")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default: number of CPUs")
+    parser.add_argument("--only", nargs='*', help="evaluate only these model families")
+    parser.add_argument("--select", help="candidate to refit and save instead of the best one")
+    parser.add_argument("--save", action='store_true', help="refit the selected candidate and save it")
+    parser.add_argument("--leaderboard", default='model/sweep_leaderboard.json', help="JSON file for the leaderboard")
+    parser.add_argument("--synthetic", type=int, help="sweep on that many synthetic offers instead of the CampusFile")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        import synthetic_data
+        with tempfile.TemporaryDirectory() as synthetic_dir:
+            synthetic_file = os.path.join(synthetic_dir, 'synthetic_campusfile.csv')
+            synthetic_data.write_immo24_csv(synthetic_file, args.synthetic)
+            df_offers = training.load_immo24_offers_streaming(synthetic_file, keep_since_year=2007)
+    else:
+        df_offers = training.load_preprocessed_immo24_offers('../data/CampusFile_Wohnungskauf_Leipzig.csv',
+                                                             keep_since_year=2020)
+    df_feedback = training.load_feedback_from_csv_into_pandas_dataframe() if args.f else None
+    X, y = training._prepare_training_data(df_offers, df_feedback)
+
+    candidates = candidate_configurations()
+    if args.only:
+        candidates = {name: candidate for name, candidate in candidates.items() if candidate[0] in args.only}
+    if args.select and args.select not in candidates:
+        print(f"Unknown candidate '{args.select}', choose one of: {', '.join(candidates)}")
+        return 1
+
+    print(f"Sweeping {len(candidates)} candidates with {args.folds}-fold cross validation on {len(y):,} offers.")
+    leaderboard = run_sweep(X, y, candidates, n_folds=args.folds, workers=args.workers)
+    print_leaderboard(leaderboard)
+    with open(args.leaderboard, 'w') as leaderboard_file:
+        json.dump(leaderboard, leaderboard_file, indent=2)
+
+    selected = args.select or leaderboard[0]['name']
+    print(f"\nSelected candidate: {selected}")
+    if args.save:
+        save_candidate(candidates[selected], df_offers, df_feedback, X, y)
+    return 0
+
+
+def save_candidate(candidate, df_offers, df_feedback, X, y):
+    """
+    Refit a candidate on all data and register it in the ML Flow model store, with the drift reference of the data.
+    A linear candidate is the model of training.py, with the coefficient covariance for the price intervals, and is
+    also saved as model artifact, the fallback of app.py and service.py. Other families have no model artifact, so the
+    fallback files are left unchanged for them.
+
+    :param candidate: (family, hyperparameters), see candidate_configurations()
+    :param df_offers: offers the candidate was swept on
+    :param df_feedback: feedback the candidate was swept on, or None
+    :param X: input matrix of the offers and the feedback, see training._prepare_training_data()
+    :param y: prices of the offers and the feedback
+    :return: the refitted sklearn pipeline
+    """
+    family, hyperparameters = candidate
+    drift_reference = training.compute_drift_reference(df_offers, df_feedback)
+    if family == 'linear':
+        regression_model = training.train_regression_model(df_offers, df_feedback)
+        training.save_model_artifact_to_file(regression_model, 'model/lpz_apt_prices_regression_model.lpzm')
+        training.save_compact_model_to_file(regression_model, 'model/lpz_apt_prices_regression_model.json')
+        drift.save_sketch(drift_reference, drift.DRIFT_REFERENCE_FILE)
+        training.save_regression_model_to_model_store(regression_model, drift_reference_file=drift.DRIFT_REFERENCE_FILE)
+        return regression_model
+
+    regression_model = build_model(family, hyperparameters).fit(X, y)
+    print(f"'{family}' models have no model artifact, the fallback files in model/ are left unchanged.")
+    with tempfile.TemporaryDirectory() as reference_dir:
+        # the reference next to the fallback files belongs to the fallback model, so it is registered from elsewhere
+        reference_file = os.path.join(reference_dir, inference.DRIFT_REFERENCE_ARTIFACT)
+        drift.save_sketch(drift_reference, reference_file)
+        training.save_regression_model_to_model_store(regression_model, drift_reference_file=reference_file)
+    return regression_model
+
+
+if __name__ == '__main__':
+    sys.exit(main())
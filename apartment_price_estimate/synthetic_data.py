@@ -0,0 +1,89 @@
+"""
+Synthetic data in the schema of the ImmobilienScout24 CampusFile, for benchmarks
+
+The real CampusFile may not be shared, so benchmarks run on generated offers: same columns, same CSV dialect
+(semicolon-separated, decimal comma, months like '2007m11') and the same sentinel values for missing data
+(-5, -7, -9), at any number of rows.
+"""
+
+import numpy as np
+import pandas as pd
+
+# columns of the CampusFile that are not used by training, generated to keep the width of a row realistic
+EXTRA_COLUMNS = ['baujahr', 'etage', 'anzahletagen', 'nebenkosten', 'heizungsart']
+
+
+def generate_immo24_offers(n_rows, seed=0, first_obid=0) -> pd.DataFrame:
+    """
+    Generate offers for apartments with a linear price structure plus noise.
+
+    :param n_rows: number of offers
+    :param seed: seed of the random generator
+    :param first_obid: obid of the first offer, obids are consecutive
+    :return: pandas dataframe in the column layout of the CampusFile, months as strings like '2007m11'
+    """
+    rng = np.random.default_rng(seed)
+
+    def with_sentinels(values, sentinels, share):
+        """replace a share of the values by randomly chosen sentinel values"""
+        values = values.astype(np.float64)
+        mask = rng.random(n_rows) < share
+        values[mask] = rng.choice(sentinels, mask.sum())
+        return values
+
+    wohnflaeche = np.round(rng.gamma(6.0, 12.0, n_rows) + 20, 2)
+    zimmeranzahl = np.clip(np.round(wohnflaeche / 25 * 2) / 2, 1, 8)
+    schlafzimmer = np.clip(np.floor(zimmeranzahl - 1), 0, 5)
+    badezimmer = np.clip(np.floor(wohnflaeche / 90) + 1, 1, 3)
+    flags = rng.integers(0, 2, (n_rows, 4))
+    energieeffizienzklasse = rng.integers(1, 9, n_rows)
+    kaufpreis = np.round(np.maximum(20_000, 3_000 * wohnflaeche + 25_000 * flags[:, 0] - 4_000 * energieeffizienzklasse
+                                    + rng.normal(0, 40_000, n_rows)), -2)
+
+    # months between 2007 and 2021, ads end 0 to 12 months after they start
+    start_month = rng.integers(2007 * 12, 2022 * 12, n_rows)
+    end_month = np.minimum(start_month + rng.integers(0, 13, n_rows), 2021 * 12 + 11)
+
+    def months(month_index):
+        years, month_numbers = np.divmod(month_index, 12)
+        return pd.Series(years.astype(str)) + "m" + pd.Series((month_numbers + 1).astype(str))
+
+    obid = np.arange(first_obid, first_obid + n_rows)
+    # about 10% of the offers are duplicates of an earlier offer
+    duplicateid = np.where(rng.random(n_rows) < 0.1, np.maximum(obid - rng.integers(1, 1000, n_rows), 0), -9)
+
+    return pd.DataFrame({
+        'obid': obid,
+        'kaufpreis': kaufpreis,
+        'wohnflaeche': wohnflaeche,
+        'zimmeranzahl': with_sentinels(zimmeranzahl, [-5, 0], 0.03),
+        'schlafzimmer': with_sentinels(schlafzimmer, [-5, -9], 0.3),
+        'badezimmer': with_sentinels(badezimmer, [-9], 0.3),
+        'aufzug': flags[:, 0],
+        'balkon': flags[:, 1],
+        'denkmalobjekt': flags[:, 2],
+        'parkplatz': with_sentinels(flags[:, 3], [-9], 0.4),
+        'energieeffizienzklasse': with_sentinels(energieeffizienzklasse, [-7], 0.6),
+        'duplicateid': duplicateid,
+        'adat': months(start_month),
+        'edat': months(end_month),
+        'baujahr': with_sentinels(rng.integers(1870, 2022, n_rows), [-9], 0.2),
+        'etage': with_sentinels(rng.integers(0, 7, n_rows), [-9], 0.2),
+        'anzahletagen': with_sentinels(rng.integers(1, 8, n_rows), [-9], 0.3),
+        'nebenkosten': with_sentinels(np.round(rng.gamma(4.0, 50.0, n_rows), 2), [-9], 0.5),
+        'heizungsart': rng.choice(['Zentralheizung', 'Fernwaerme', 'Etagenheizung', 'Other missing'], n_rows),
+    })
+
+
+def write_immo24_csv(path, n_rows, seed=0, chunk_size=500_000):
+    """
+    Write a synthetic CampusFile CSV, generated in chunks, so files of any size can be written.
+
+    :param path: CSV file to write
+    :param n_rows: number of offers
+    :param seed: seed of the random generator, each chunk derives its own seed from it
+    :param chunk_size: rows generated at once
+    """
+    for i, start in enumerate(range(0, n_rows, chunk_size)):
+        chunk = generate_immo24_offers(min(chunk_size, n_rows - start), seed=seed * 100_003 + i, first_obid=start)
+        chunk.to_csv(path, sep=";", decimal=",", index=False, mode='w' if i == 0 else 'a', header=(i == 0))
@@ -0,0 +1,279 @@
+"""
+Time-aware training windows: which months of offers the model of training.py is trained on
+
+Instead of one hard cut (keep_since_year), the offers are partitioned by the month of their listing (adat), and the
+sufficient statistics of each month (see training.compute_sufficient_statistics()) are computed once. Any window is
+then a (weighted) sum of monthly statistics, solved in O(features^3) without touching a row again:
+* all:                              all months
+* rolling-months=<m>:               the last m months, from prefix sums of the monthly statistics
+* exponential-half_life=<h>:        all months, weighted by 0.5 ** (age in months / h)
+
+backtest() picks the recency that predicts best: for every test month, each window is fitted on the months before
+and scored on the offers of the test month. The squared error of a linear model with mean imputation is a quadratic
+form of the sufficient statistics of the scored rows, so scoring needs no rows either, and a backtest of dozens of
+windows over many months takes well under a second. window_weights() turns the chosen window into weights per offer
+for training.train_regression_model().
+
+Run from within apartment_price_estimate/ for a leaderboard of the windows on the CampusFile:
+python time_windows.py --test-months 12
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+import inference as inference
+import training as training
+
+# column of the month an offer is assigned to: the month it was listed, when its price was set
+MONTH_COLUMN = 'adat'
+
+# candidates of backtest(), from short to long memory
+DEFAULT_WINDOWS = (['all'] + [f'rolling-months={months}' for months in (3, 6, 12, 18, 24, 36, 48, 72)]
+                   + [f'exponential-half_life={half_life}' for half_life in (3, 6, 12, 24, 48)])
+
+# fewest (weighted) offers a window needs to be fitted, below that it is skipped for the test month
+MIN_WINDOW_OFFERS = 50
+
+
+def month_index(dates) -> np.ndarray:
+    """
+    months since January of year 0 (year * 12 + month - 1) of datetime values
+
+    :param dates: pandas series or numpy array of datetime64 values
+    :return: float64 array, NaN for missing dates
+    """
+    months = np.asarray(dates, dtype='datetime64[M]')
+    missing = np.isnat(months)
+    # datetime64[M] counts months since 1970-01
+    index = months.astype(np.int64).astype(np.float64) + 1970 * 12
+    index[missing] = np.nan
+    return index
+
+
+def _month_label(month) -> str:
+    year, month_of_year = divmod(int(month), 12)
+    return f'{year}-{month_of_year + 1:02d}'
+
+
+class MonthlyStatistics:
+    """
+    Sufficient statistics of the offers of each month, from first_month to last_month, months without offers
+    included (with zero statistics), and their prefix sums for rolling windows.
+    """
+
+    def __init__(self, first_month, statistics):
+        """
+        :param first_month: month index of statistics[0], see month_index()
+        :param statistics: numpy array of shape (months, d, d), statistics[i] of month first_month + i
+        """
+        self.first_month = int(first_month)
+        self.statistics = np.asarray(statistics, dtype=np.float64)
+        # prefix[i] = sum of the statistics of the months before first_month + i
+        self._prefix = np.concatenate([np.zeros((1,) + self.statistics.shape[1:]), np.cumsum(self.statistics, axis=0)])
+
+    @property
+    def last_month(self) -> int:
+        return self.first_month + len(self.statistics) - 1
+
+    def offers(self, month) -> float:
+        """number of offers listed in a month"""
+        i = month - self.first_month
+        return float(self.statistics[i, -2, -2]) if 0 <= i < len(self.statistics) else 0.0
+
+    def month_weights(self, window, last_month) -> np.ndarray:
+        """
+        weight of each month (first_month to self.last_month) in a window ending with last_month;
+        months after last_month have weight 0
+
+        :param window: name of the window, see the module documentation
+        :param last_month: newest month of the window
+        """
+        kind, parameter = parse_window(window)
+        age = last_month - np.arange(self.first_month, self.last_month + 1)
+        if kind == 'all':
+            weights = np.ones(len(age))
+        elif kind == 'rolling':
+            weights = (age < parameter).astype(np.float64)
+        else:
+            weights = 0.5 ** (age / parameter)
+        weights[age < 0] = 0.0
+        return weights
+
+    def window(self, window, last_month) -> np.ndarray:
+        """(weighted) sufficient statistics of a window ending with last_month"""
+        kind, parameter = parse_window(window)
+        end = min(last_month, self.last_month) - self.first_month + 1
+        if kind == 'all':
+            return self._prefix[max(end, 0)]
+        if kind == 'rolling':
+            return self._prefix[max(end, 0)] - self._prefix[min(max(end - parameter, 0), len(self.statistics))]
+        return np.tensordot(self.month_weights(window, last_month), self.statistics, axes=1)
+
+
+def parse_window(window):
+    """
+    :param window: name of a window, e.g. 'rolling-months=24'
+    :return: (kind, parameter): ('all', None), ('rolling', months) or ('exponential', half life in months)
+    :raises ValueError: if the name is no window
+    """
+    kind, _, parameter = window.partition('-')
+    if kind == 'all' and not parameter:
+        return kind, None
+    try:
+        if kind == 'rolling' and parameter.startswith('months=') and int(parameter[7:]) > 0:
+            return kind, int(parameter[7:])
+        if kind == 'exponential' and parameter.startswith('half_life=') and float(parameter[10:]) > 0:
+            return kind, float(parameter[10:])
+    except ValueError:
+        pass
+    raise ValueError(f"unknown window '{window}', use 'all', 'rolling-months=<m>' or 'exponential-half_life=<h>'")
+
+
+def monthly_sufficient_statistics(df_offers, chunk_size=200_000) -> MonthlyStatistics:
+    """
+    sufficient statistics of the offers of each month of MONTH_COLUMN, in one pass over the offers;
+    offers without month are left out
+
+    :param df_offers: preprocessed offers, see training.preprocess_immo24_offers()
+    :param chunk_size: offers processed at once, bounds the temporary memory
+    """
+    months = month_index(df_offers[MONTH_COLUMN])
+    dated = np.flatnonzero(~np.isnan(months))
+    if not len(dated):
+        raise ValueError(f"no offers with a month in column '{MONTH_COLUMN}'")
+    first_month, last_month = int(months[dated].min()), int(months[dated].max())
+    p = len(inference.FEATURE_NAMES)
+    statistics = np.zeros((last_month - first_month + 1, 2 * p + 2, 2 * p + 2))
+
+    for start in range(0, len(dated), chunk_size):
+        rows = dated[start:start + chunk_size]
+        X, y = training._prepare_training_data(df_offers.iloc[rows])
+        chunk_months = months[rows].astype(np.int64) - first_month
+        order = np.argsort(chunk_months, kind='stable')
+        for group in np.split(order, np.flatnonzero(np.diff(chunk_months[order])) + 1):
+            statistics[chunk_months[group[0]]] += training._sufficient_statistics_of_arrays(X[group], y[group])
+    return MonthlyStatistics(first_month, statistics)
+
+
+def squared_error(compact_model, statistics):
+    """
+    sum of the squared errors of a model on the rows of sufficient statistics, without the rows
+
+    With mean imputation, the prediction of a row z = [observed values, missing indicators, 1] is w @ z with
+    w = [coef, coef * imputation means, intercept], so the errors y - w @ z square to a quadratic form of Z^T Z.
+
+    :param compact_model: inference.CompactLinearModel, see training.solve_sufficient_statistics()
+    :param statistics: see training.compute_sufficient_statistics()
+    :return: sum of the squared errors, number of rows
+    """
+    w = np.concatenate([compact_model.coef, compact_model.coef * compact_model.imputer_means,
+                        [compact_model.intercept]])
+    zz, zy, yy = statistics[:-1, :-1], statistics[:-1, -1], statistics[-1, -1]
+    return max(yy - 2 * w @ zy + w @ zz @ w, 0.0), statistics[-2, -2]
+
+
+def _fittable(statistics) -> bool:
+    """True if the statistics hold enough offers and an observed value of every feature"""
+    p = len(inference.FEATURE_NAMES)
+    n = statistics[2 * p, 2 * p]
+    return n >= MIN_WINDOW_OFFERS and bool(np.all(statistics[2 * p, p:2 * p] < n))
+
+
+def backtest(monthly, windows=DEFAULT_WINDOWS, test_months=12, min_test_offers=20) -> list:
+    """
+    Score windows by how well a model fitted on the months before a test month predicts the offers of that month,
+    over the last test_months months with at least min_test_offers offers.
+
+    :param monthly: MonthlyStatistics
+    :param windows: names of the windows, see the module documentation
+    :return: leaderboard as list of dicts (window, rmse, test_months, test_offers, mean_window_offers), best first;
+        a window is scored only on the test months it could be fitted for, see MIN_WINDOW_OFFERS
+    """
+    months = [month for month in range(monthly.first_month + 1, monthly.last_month + 1)
+              if monthly.offers(month) >= min_test_offers][-test_months:]
+    leaderboard = []
+    for window in windows:
+        parse_window(window)
+        errors, offers, window_offers, scored = 0.0, 0.0, 0.0, 0
+        for month in months:
+            window_statistics = monthly.window(window, month - 1)
+            if not _fittable(window_statistics):
+                continue
+            compact_model = training.solve_sufficient_statistics(window_statistics)
+            month_errors, month_offers = squared_error(compact_model, monthly.statistics[month - monthly.first_month])
+            errors += month_errors
+            offers += month_offers
+            window_offers += window_statistics[-2, -2]
+            scored += 1
+        if scored:
+            leaderboard.append({'window': window, 'rmse': float(np.sqrt(errors / offers)), 'test_months': scored,
+                                'test_offers': int(offers), 'mean_window_offers': window_offers / scored})
+    # windows that could not be fitted for every test month are ranked after the others
+    leaderboard.sort(key=lambda entry: (entry['test_months'] < len(months), entry['rmse']))
+    return leaderboard
+
+
+def window_weights(df_offers, window, last_month=None) -> np.ndarray:
+    """
+    weight of each offer in a window, for training.train_regression_model(sample_weight=...)
+
+    :param df_offers: preprocessed offers
+    :param window: name of the window, see the module documentation
+    :param last_month: newest month of the window, default: the newest month of the offers
+    :return: float64 array, 0 for offers outside the window and offers without month
+    """
+    kind, parameter = parse_window(window)
+    months = month_index(df_offers[MONTH_COLUMN])
+    if last_month is None:
+        last_month = np.nanmax(months)
+    age = last_month - months
+    with np.errstate(invalid='ignore'):
+        if kind == 'all':
+            weights = np.ones(len(age))
+        elif kind == 'rolling':
+            weights = (age < parameter).astype(np.float64)
+        else:
+            weights = 0.5 ** (age / parameter)
+        weights[~(age >= 0)] = 0.0
+    return weights
+
+
+def print_leaderboard(leaderboard):
+    print(f"{'window':28} {'RMSE':>10} {'months':>7} {'offers':>8} {'offers/fit':>11}")
+    for entry in leaderboard:
+        print(f"{entry['window']:28} {entry['rmse']:10,.0f} {entry['test_months']:>7} {entry['test_offers']:>8,} "
+              f"{entry['mean_window_offers']:11,.0f}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Backtest training windows over the months of the offers')
+    parser.add_argument("--data-file", default='../data/CampusFile_Wohnungskauf_Leipzig.csv')
+    parser.add_argument("--since-year", type=int, default=training.WINDOW_KEEP_SINCE_YEAR,
+                        help="offers listed before are not loaded at all")
+    parser.add_argument("--test-months", type=int, default=12, help="newest months each window is scored on")
+    parser.add_argument("--windows", nargs='+', default=list(DEFAULT_WINDOWS), help="windows to score")
+    parser.add_argument("--leaderboard", default='model/window_leaderboard.json', help="JSON file for the leaderboard")
+    args = parser.parse_args()
+
+    df_offers = training.load_preprocessed_immo24_offers(args.data_file, keep_since_year=args.since_year)
+    started = time.perf_counter()
+    monthly = monthly_sufficient_statistics(df_offers)
+    statistics_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    leaderboard = backtest(monthly, args.windows, args.test_months)
+    backtest_seconds = time.perf_counter() - started
+    print(f"Monthly statistics of {len(df_offers):,} offers from {_month_label(monthly.first_month)} to "
+          f"{_month_label(monthly.last_month)} in {statistics_seconds:.2f} s, backtest of {len(args.windows)} windows "
+          f"in {backtest_seconds:.3f} s:")
+    print_leaderboard(leaderboard)
+    with open(args.leaderboard, 'w') as leaderboard_file:
+        json.dump(leaderboard, leaderboard_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
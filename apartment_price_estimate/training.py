@@ -24,20 +24,24 @@ https://stackabuse.com/linear-regression-in-python-with-scikit-learn/
 """
 
 import sys
-from datetime import datetime
 
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas
-import pandas as pd
-
-from sklearn.impute import SimpleImputer
-from sklearn.linear_model import LinearRegression
 
+import hashlib
+import json
+import os
 import pickle
-import mlflow.sklearn
 import argparse
+import shutil
+import tempfile
+import time
+from datetime import timedelta
 
+import diagnostics as diagnostics
+import drift as drift
+import inference as inference
+import metrics as metrics
+import near_duplicates as near_duplicates
 import storage as storage
 
 from dotenv import load_dotenv
@@ -46,6 +50,66 @@ from dotenv import load_dotenv
 # they are used implicitly by the ML Flow functions
 load_dotenv()
 
+# pandas, matplotlib, sklearn and MLflow are imported on first use only, in the functions that need them,
+# so importing this module (e.g. for save_compact_model_to_file) stays cheap
+
+# cache of preprocessed training data, see load_preprocessed_immo24_offers()
+TRAINING_CACHE_DIR = os.environ.get('TRAINING_CACHE_DIR', '../data/cache')
+
+# bump when the loaders or preprocess_immo24_offers() change their result, to invalidate all caches
+PREPROCESSING_VERSION = 1
+
+# offers are loaded since this year for a training window (--window), see time_windows.py
+WINDOW_KEEP_SINCE_YEAR = 1990
+
+# CampusFiles of regions are named <prefix><Region>.csv, see find_region_files()
+REGION_FILE_PREFIX = 'CampusFile_Wohnungskauf_'
+
+# invalid feedback records of the last training, see _validate_feedback()
+FEEDBACK_QUARANTINE_FILE = 'feedback_quarantine.csv'
+
+# "-i" reads the feedback log again from this long before the newest shard folded in, so shards that sort before it
+# (slow uploads, writers with a clock behind) are still folded in; shards within the lag are recorded by name
+FEEDBACK_WATERMARK_LAG = timedelta(hours=1)
+
+# numeric columns of the feedback records with session kept with the sufficient statistics, see _session_submissions()
+_SUBMISSION_VALUE_COLUMNS = storage.FEEDBACK_COLUMNS[:-1]
+
+
+# columns used from the ImmobilienScout24 CampusFile
+IMMO24_COLUMNS = ['obid', 'kaufpreis', 'wohnflaeche', 'zimmeranzahl',
+                  'schlafzimmer', 'badezimmer', 'aufzug', 'balkon', 'denkmalobjekt',
+                  'parkplatz', 'energieeffizienzklasse', 'duplicateid', 'adat', 'edat']
+
+# sentinel values of ImmobilienScout24 that mean "not available"
+IMMO24_NA_VALUES = {'zimmeranzahl': [-5, 0],
+                    'schlafzimmer': [-5, -9],
+                    'badezimmer': -9,
+                    'parkplatz': -9,
+                    'energieeffizienzklasse': -7,
+                    'duplicateid': -9}
+
+# compact data types for the streaming loader: features and flags as float32 (NaN for missing values; nullable
+# int8 would halve the flags again, but parses about twice as slow), the month columns have only a few distinct values
+IMMO24_DTYPES = {'obid': 'int64', 'kaufpreis': 'float64', 'wohnflaeche': 'float32', 'zimmeranzahl': 'float32',
+                 'schlafzimmer': 'float32', 'badezimmer': 'float32', 'aufzug': 'float32', 'balkon': 'float32',
+                 'denkmalobjekt': 'float32', 'parkplatz': 'float32', 'energieeffizienzklasse': 'float32',
+                 'duplicateid': 'float64', 'adat': 'category', 'edat': 'category'}
+
+
+def _parse_immo24_months(column):
+    """
+    parse date columns like '2007m11' to a datetime value 2007-Nov-01, vectorized:
+    only the distinct months are parsed, which are few, then mapped back onto all rows
+    """
+    import pandas as pd
+
+    if not isinstance(column.dtype, pd.CategoricalDtype):
+        column = column.astype('category')
+    months = pd.to_datetime(column.cat.categories.astype(str), format="%Ym%m", errors='coerce')
+    return pd.Series(months.take(column.cat.codes.to_numpy(), allow_fill=True), index=column.index,
+                     name=column.name)
+
 
 def load_immo24_offers_from_csv_into_pandas_dataframe(path_to_file):
     """
@@ -56,52 +120,113 @@ def load_immo24_offers_from_csv_into_pandas_dataframe(path_to_file):
     :return: pandas dataframe with the selected columms
     """
 
-    def custom_date_parser(x):
-        """custom date parser to parse date columns like '2007m11' to a datetime value 2007-Nov-01"""
-        return datetime.strptime(x, "%Ym%m")
+    import pandas as pd
 
     dataframe = pd.read_csv(path_to_file,
                             sep=";", decimal=",",
-                            verbose=False,
                             on_bad_lines='warn',
                             low_memory=False,  # ensures proper data types, recommended by pandas during run
-                            usecols=['obid', 'kaufpreis', 'wohnflaeche', 'zimmeranzahl',
-                                     'schlafzimmer', 'badezimmer', 'aufzug', 'balkon', 'denkmalobjekt',
-                                     'parkplatz', 'energieeffizienzklasse', 'duplicateid', 'adat', 'edat'],
-                            parse_dates=['adat', 'edat'],
-                            date_parser=custom_date_parser,
-                            na_values={'zimmeranzahl': [-5, 0],
-                                       'schlafzimmer': [-5, -9],
-                                       'badezimmer': -9,
-                                       'parkplatz': -9,
-                                       'energieeffizienzklasse': -7,
-                                       'duplicateid': -9}
+                            usecols=IMMO24_COLUMNS,
+                            dtype={'adat': 'category', 'edat': 'category'},
+                            na_values=IMMO24_NA_VALUES
                             )
+    dataframe['adat'] = _parse_immo24_months(dataframe['adat'])
+    dataframe['edat'] = _parse_immo24_months(dataframe['edat'])
     # print(dataframe.info())
     return dataframe
 
 
+def iter_immo24_offers_from_csv(path_to_file, keep_since_year, remove_duplicates=True, chunk_size=200_000):
+    """
+    Stream offers by ImmobilienScout24 chunk by chunk, already filtered by preprocess_immo24_offers().
+
+    Each chunk is read with the compact data types of IMMO24_DTYPES, so only one chunk of raw rows
+    is in memory at a time, no matter how large the file is.
+
+    :param path_to_file: path to the CSV file
+    :param keep_since_year: see preprocess_immo24_offers()
+    :param remove_duplicates: see preprocess_immo24_offers()
+    :param chunk_size: rows read at once
+    :return: generator of pandas dataframes with the columns IMMO24_COLUMNS
+    """
+    import pandas as pd
+
+    reader = pd.read_csv(path_to_file,
+                         sep=";", decimal=",",
+                         on_bad_lines='warn',
+                         usecols=IMMO24_COLUMNS,
+                         dtype=IMMO24_DTYPES,
+                         na_values=IMMO24_NA_VALUES,
+                         chunksize=chunk_size
+                         )
+    with reader:
+        for chunk in reader:
+            chunk['adat'] = _parse_immo24_months(chunk['adat'])
+            chunk['edat'] = _parse_immo24_months(chunk['edat'])
+            yield preprocess_immo24_offers(chunk, keep_since_year, remove_duplicates)
+
+
+def load_immo24_offers_streaming(path_to_file, keep_since_year, remove_duplicates=True, chunk_size=200_000):
+    """
+    Load and preprocess offers by ImmobilienScout24 in one streaming pass, see iter_immo24_offers_from_csv().
+    Same result as load_immo24_offers_from_csv_into_pandas_dataframe() followed by preprocess_immo24_offers(),
+    but with compact data types and the peak memory of one chunk plus the kept offers.
+
+    :return: pandas dataframe with the preprocessed offers
+    """
+    import pandas as pd
+
+    chunks = list(iter_immo24_offers_from_csv(path_to_file, keep_since_year, remove_duplicates, chunk_size))
+    return pd.concat(chunks, ignore_index=True)
+
+
 def load_feedback_from_csv_into_pandas_dataframe():
     """
-    Load feedback from MinIO
+    Load feedback from MinIO: the legacy feedback.csv plus the sharded feedback log, validated by
+    storage.validate_feedback(). Invalid records are written to FEEDBACK_QUARANTINE_FILE instead.
 
-    :return: pandas dataframe with feedback
+    :return: pandas dataframe with valid feedback, records of the log have the name of their shard in column 'shard'
     """
+    return _validate_feedback(_read_feedback())
+
+
+def _read_feedback():
+    """
+    Read all feedback from MinIO, not validated: the legacy feedback.csv plus the sharded feedback log
+
+    :return: pandas dataframe with the feedback, records of the log have the name of their shard in column 'shard'
+    """
+
+    import pandas as pd
 
     # get feedback file from MinIO to local file
     client = storage.create_client()
     storage.get_feedback_from_minio(client)
 
-    dataframe = pd.read_csv("feedback.csv",
-                            sep=",", decimal=".",
-                            verbose=False,
-                            on_bad_lines='warn',
-                            low_memory=False,  # ensures proper data types, recommended by pandas during run
-                            )
-    # print(dataframe.info())
+    dataframe = storage.get_feedback_dataframe(client, with_shard=True)
+    if os.path.isfile("feedback.csv"):
+        # legacy feedback.csv first, it was written before the feedback log
+        dataframe = pd.concat([storage.read_feedback_csv("feedback.csv"), dataframe], ignore_index=True)
     return dataframe
 
 
+def _validate_feedback(df_feedback):
+    """
+    valid feedback records, see storage.validate_feedback(); invalid ones are written to FEEDBACK_QUARANTINE_FILE
+
+    :param df_feedback: feedback in order of submission
+    :return: pandas dataframe with the valid feedback records
+    """
+    df_valid, df_quarantined = storage.validate_feedback(df_feedback)
+    repeated = len(df_feedback) - len(df_valid) - len(df_quarantined)
+    print(f"Feedback: {len(df_valid)} valid records, {repeated} repeated submissions dropped, "
+          f"{len(df_quarantined)} invalid records quarantined.")
+    if not df_quarantined.empty:
+        df_quarantined.to_csv(FEEDBACK_QUARANTINE_FILE, index=False)
+        print(f"Quarantined feedback written to '{FEEDBACK_QUARANTINE_FILE}', e.g.: {df_quarantined['reason'].iloc[0]}")
+    return df_valid
+
+
 def preprocess_immo24_offers(dataframe, keep_since_year, remove_duplicates=True):
     """
     Remove offers, that are too old (before "keep_since_year").
@@ -123,169 +248,615 @@ def preprocess_immo24_offers(dataframe, keep_since_year, remove_duplicates=True)
     return dataframe
 
 
+def remove_near_duplicate_offers(df_offers):
+    """
+    Remove relisted offers that the duplicateid does not mark, see near_duplicates.py. The merged clusters are
+    written to near_duplicates.NEAR_DUPLICATES_REPORT_FILE.
+
+    :param df_offers: preprocessed offers, see preprocess_immo24_offers()
+    :return: pandas dataframe with one offer per cluster of near duplicates
+    """
+    df_kept, df_report = near_duplicates.remove_near_duplicate_offers(df_offers)
+    near_duplicates.print_report(df_offers, df_kept, df_report)
+    if not df_report.empty:
+        df_report.to_csv(near_duplicates.NEAR_DUPLICATES_REPORT_FILE, index=False)
+        print(f"Merged clusters written to '{near_duplicates.NEAR_DUPLICATES_REPORT_FILE}'.")
+    return df_kept
+
+
+def _sha256_of_file(path_to_file, cache_dir) -> str:
+    """
+    sha256 of a file's content. The hash is remembered per path, size and modification time in cache_dir,
+    so an unchanged file is hashed only once.
+    """
+    stat = os.stat(path_to_file)
+    fingerprint = f"{os.path.abspath(path_to_file)}:{stat.st_size}:{stat.st_mtime_ns}"
+    hashes_file = os.path.join(cache_dir, 'file_hashes.json')
+    try:
+        with open(hashes_file) as f:
+            hashes = json.load(f)
+    except (OSError, ValueError):
+        hashes = {}
+    if fingerprint not in hashes:
+        checksum = hashlib.sha256()
+        with open(path_to_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                checksum.update(block)
+        hashes = {key: value for key, value in hashes.items()
+                  if not key.startswith(f"{os.path.abspath(path_to_file)}:")}
+        hashes[fingerprint] = checksum.hexdigest()
+        with open(hashes_file, 'w') as f:
+            json.dump(hashes, f, indent=2)
+    return hashes[fingerprint]
+
+
+def load_preprocessed_immo24_offers(path_to_file, keep_since_year, remove_duplicates=True, streaming=False,
+                                    cache_dir=TRAINING_CACHE_DIR):
+    """
+    Load and preprocess offers by ImmobilienScout24, cached as Parquet file in cache_dir.
+
+    The cache is keyed by the sha256 of the CSV file, the preprocessing parameters and the loader. If any of them
+    changes, the data is loaded from the CSV again. Caches of an older content of the CSV file are deleted.
+
+    :param path_to_file: path to the CSV file
+    :param keep_since_year: see preprocess_immo24_offers()
+    :param remove_duplicates: see preprocess_immo24_offers()
+    :param streaming: on a cache miss, load with load_immo24_offers_streaming() instead of loading all at once
+    :param cache_dir: directory of the cache files
+    :return: pandas dataframe with the preprocessed offers
+    """
+    import pandas as pd
+
+    os.makedirs(cache_dir, exist_ok=True)
+    file_key = _sha256_of_file(path_to_file, cache_dir)[:16]
+    parameter_key = hashlib.sha256(f"{keep_since_year}:{remove_duplicates}:{streaming}:{PREPROCESSING_VERSION}"
+                                   .encode('utf-8')).hexdigest()[:16]
+    source_name = os.path.splitext(os.path.basename(path_to_file))[0]
+    cache_file = os.path.join(cache_dir, f"{source_name}-{file_key}-{parameter_key}.parquet")
+    if os.path.exists(cache_file):
+        return pd.read_parquet(cache_file)
+
+    if streaming:
+        dataframe = load_immo24_offers_streaming(path_to_file, keep_since_year, remove_duplicates)
+    else:
+        dataframe = load_immo24_offers_from_csv_into_pandas_dataframe(path_to_file)
+        dataframe = preprocess_immo24_offers(dataframe, keep_since_year, remove_duplicates)
+
+    # write to a temporary file first, so an interrupted run never leaves a broken cache behind
+    dataframe.to_parquet(f"{cache_file}.tmp", index=False)
+    os.replace(f"{cache_file}.tmp", cache_file)
+    # caches of older versions of the CSV file are outdated for good
+    for name in os.listdir(cache_dir):
+        if (name.startswith(f"{source_name}-") and name.endswith('.parquet')
+                and not name.startswith(f"{source_name}-{file_key}-")):
+            os.remove(os.path.join(cache_dir, name))
+    return dataframe
+
+
 def plot_input_data(df_immo24_offers, KEEP_SINCE_YEAR):
     """
-    plot distributions of input data on the apartment offers
+    plot distributions of input data on the apartment offers into diagnostics.PLOT_DIR, headless in worker processes,
+    see diagnostics.start_diagnostics(); returns without waiting for the plots
 
     :param df_immo24_offers:  list of apartments with features and price as a pandas data frame
     :param KEEP_SINCE_YEAR:   offers have been cut off before that year, used for labels in charts only
-    :return:
+    :return: diagnostics.DiagnosticsJob to wait() for, None if the plots are up to date for this data
     """
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.scatter(x=df_immo24_offers['wohnflaeche'], y=df_immo24_offers['kaufpreis'])
-    plt.title(f"Kaufpreis zu Wohnfläche (ImmobilienScout24 für Wohnungen in Leipzig ab {KEEP_SINCE_YEAR})")
-    plt.xlabel("Wohnfläche (m²)")
-    plt.ylabel("Kaufpreis (Mio EUR)")
-    plt.xlim([0, 225])
-    plt.ylim([0, 1.5e6])
-    plt.show()
-
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.scatter(x=df_immo24_offers['zimmeranzahl'], y=df_immo24_offers['kaufpreis'])
-    plt.title(f"Kaufpreis zu Zimmeranzahl (ImmobilienScout24 für Wohnungen in Leipzig ab {KEEP_SINCE_YEAR})")
-    plt.xlabel("Zimmeranzahl (Räume)")
-    plt.ylabel("Kaufpreis (Mio EUR)")
-    plt.xlim([0, 9])
-    plt.ylim([0, 1.5e6])
-    plt.show()
-
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.scatter(x=df_immo24_offers['schlafzimmer'], y=df_immo24_offers['kaufpreis'])
-    plt.title(f"Kaufpreis zu Anz Schlafzimmer (ImmobilienScout24 für Wohnungen in Leipzig ab {KEEP_SINCE_YEAR})")
-    plt.xlabel("Schlafzimmeranzahl (Räume)")
-    plt.ylabel("Kaufpreis (Mio EUR)")
-    plt.xlim([-0.5, 5.5])
-    plt.ylim([0, 1.5e6])
-    plt.show()
-
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.scatter(x=df_immo24_offers['badezimmer'], y=df_immo24_offers['kaufpreis'])
-    plt.title(f"Kaufpreis zu Anz Badezimmer (ImmobilienScout24 für Wohnungen in Leipzig ab {KEEP_SINCE_YEAR})")
-    plt.xlabel("Bäderanzahl (Räume)")
-    plt.ylabel("Kaufpreis (Mio EUR)")
-    plt.xlim([0, 3.5])
-    plt.ylim([0, 1.5e6])
-    plt.show()
-
-    n_bins = 100
-    plt.figure(figsize=(10, 6))
-    plt.hist(df_immo24_offers.query('aufzug == 0')['kaufpreis'], bins=n_bins, alpha=0.5, label="Kein Aufzug")
-    plt.hist(df_immo24_offers.query('aufzug == 1')['kaufpreis'], bins=n_bins, alpha=0.5, label="Aufzug vorhanden")
-    plt.xlabel("Kaufpreis (Mio EUR)")
-    plt.ylabel("Anzahl Wohnungen")
-    plt.title(f"Verteilung Preis für Aufzug (ImmobilienScout24 für Wohnungen in Leipzig ab {KEEP_SINCE_YEAR})")
-    plt.legend(loc='upper right')
-    plt.show()
-
-    plt.figure(figsize=(10, 6))
-    plt.hist(df_immo24_offers.query('balkon == 0')['kaufpreis'], bins=n_bins, alpha=0.5, label="Kein Balkon")
-    plt.hist(df_immo24_offers.query('balkon == 1')['kaufpreis'], bins=n_bins, alpha=0.5, label="Balkon vorhanden")
-    plt.xlabel("Kaufpreis (Mio EUR)")
-    plt.ylabel("Anzahl Wohnungen")
-    plt.title(f"Verteilung Preis für Balkon (ImmobilienScout24 für Wohnungen in Leipzig ab {KEEP_SINCE_YEAR})")
-    plt.legend(loc='upper right')
-    plt.show()
-
-    plt.figure(figsize=(10, 6))
-    plt.hist(df_immo24_offers.query('denkmalobjekt == 0')['kaufpreis'], bins=n_bins, alpha=0.5,
-             label="Kein Denkmalobjekt")
-    plt.hist(df_immo24_offers.query('denkmalobjekt == 1')['kaufpreis'], bins=n_bins, alpha=0.5, label="Denkmalobjekt")
-    plt.xlabel("Kaufpreis (Mio EUR)")
-    plt.ylabel("Anzahl Wohnungen")
-    plt.title(f"Verteilung Preis für Denkmalobjekt (ImmobilienScout24 für Wohnungen in Leipzig ab {KEEP_SINCE_YEAR})")
-    plt.legend(loc='upper right')
-    plt.show()
-
-    plt.figure(figsize=(10, 6))
-    plt.hist(df_immo24_offers.query('parkplatz == 0')['kaufpreis'], bins=n_bins, alpha=0.5, label="Kein Parkplatz")
-    plt.hist(df_immo24_offers.query('parkplatz == 1')['kaufpreis'], bins=n_bins, alpha=0.5, label="Parkplatz vorhanden")
-    plt.xlabel("Kaufpreis (Mio EUR)")
-    plt.ylabel("Anzahl Wohnungen")
-    plt.title(f"Verteilung Preis für Parkplatz (ImmobilienScout24 für Wohnungen in Leipzig ab {KEEP_SINCE_YEAR})")
-    plt.legend(loc='upper right')
-    plt.show()
-
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.scatter(x=df_immo24_offers['energieeffizienzklasse'], y=df_immo24_offers['kaufpreis'])
-    plt.title(f"Kaufpreis zu Energieeffizienzklasse (ImmobilienScout24 für Wohnungen in Leipzig ab {KEEP_SINCE_YEAR})")
-    plt.xlabel("Energieeffizienzklasse (1=A, 8=H)")
-    plt.ylabel("Kaufpreis (Mio EUR)")
-    plt.xlim([0, 8.5])
-    plt.ylim([0, 1.5e6])
-    plt.show()
-
-    # plot histogram of each feature
-    # df_immo24_offers.hist('kaufpreis', bins=100)
-    # plt.show()
-    # df_immo24_offers.hist('wohnflaeche', bins=100)
-    # plt.show()
-    # df_immo24_offers.hist('zimmeranzahl', bins=100)
-    # plt.show()
-    # df_immo24_offers.hist('schlafzimmer', bins=100)
-    # plt.show()
-    # df_immo24_offers.hist('badezimmer', bins=100)
-    # plt.show()
-    # df_immo24_offers.hist('aufzug', bins=100)
-    # plt.show()
-    # df_immo24_offers.hist('balkon', bins=100)
-    # plt.show()
-    # df_immo24_offers.hist('denkmalobjekt', bins=100)
-    # plt.show()
-    # df_immo24_offers.hist('parkplatz', bins=100)
-    # plt.show()
-    # df_immo24_offers.hist('energieeffizienzklasse', bins=100)
-    # plt.show()
-
-
-def train_regression_model(df_offers, df_feedback=None):
+    return diagnostics.start_diagnostics(df_immo24_offers, KEEP_SINCE_YEAR)
+
+
+def _prepare_training_data(df_offers, df_feedback=None):
     """
-    train a regression model on a number of training data
-    training data is a list of apartments with features and price, and therefore labeled data
+    input matrix X (with NaN for missing values) and output vector y of the regression model
 
     :param df_offers: list of apartments with features and price as a pandas data frame
     :param df_feedback: optional dataframe with feedback data
-    :return: regression_model as sklearn object
+    :return: X as numpy array with the columns in the order of inference.FEATURE_NAMES, y as numpy array
     """
+    import pandas
+
     # drop unnecessary columns
-    df_offers = df_offers.drop(['obid', 'duplicateid', 'adat', 'edat'], axis=1)
+    df_offers = df_offers.drop(['obid', 'duplicateid', 'adat', 'edat'], axis=1, errors='ignore')
 
     if df_feedback is not None:
         df_offers = pandas.concat([df_offers, df_feedback], ignore_index=True)
 
     # prepare output of the regression model
-    y = df_offers['kaufpreis']
+    y = df_offers['kaufpreis'].to_numpy(dtype=np.float64)
 
-    # prepare input of the regression model
-    X = df_offers.drop(['kaufpreis'], axis=1)
+    # prepare input of the regression model, in the order expected by inference.py
+    X = df_offers[inference.FEATURE_NAMES].to_numpy(dtype=np.float64, na_value=np.nan)
+    return X, y
+
+
+def train_regression_model(df_offers, df_feedback=None, sample_weight=None):
+    """
+    train a regression model on a number of training data
+    training data is a list of apartments with features and price, and therefore labeled data
+
+    :param df_offers: list of apartments with features and price as a pandas data frame
+    :param df_feedback: optional dataframe with feedback data
+    :param sample_weight: optional weight of each offer, e.g. of a training window (see time_windows.py); offers
+        with weight 0 are left out, feedback has weight 1
+    :return: regression_model as sklearn pipeline of mean imputation and linear regression
+    """
+    from sklearn.impute import SimpleImputer
+    from sklearn.linear_model import LinearRegression
+    from sklearn.pipeline import Pipeline
+
+    X, y = _prepare_training_data(df_offers, df_feedback)
+    weights = _training_weights(sample_weight, len(X))
+    if weights is not None:
+        X, y, weights = X[weights > 0], y[weights > 0], weights[weights > 0]
 
     # impute NaN with values that make sense and do not skew the data set
-    imputer_mean = SimpleImputer(missing_values=np.nan, strategy='mean')
-    X_imputed = imputer_mean.fit_transform(X)
+    # the imputer is part of the model, so inference can apply the same imputation to missing values
+    imputer = SimpleImputer(missing_values=np.nan, strategy='mean')
+    if weights is None:
+        imputer.fit(X)
+    else:
+        # SimpleImputer takes no weights: fitted on a single row of the weighted means, it learns exactly these
+        observed = ~np.isnan(X)
+        imputer.fit((weights @ np.where(observed, X, 0.0) / (weights @ observed))[np.newaxis, :])
+    X_imputed = imputer.transform(X)
+    linear_regression = LinearRegression().fit(X_imputed, y, sample_weight=weights)
+    regression_model = Pipeline([('imputer', imputer), ('regression', linear_regression)])
 
-    regression_model = LinearRegression().fit(X_imputed, y)
+    # for the price intervals of inference.py
+    residuals = y - linear_regression.predict(X_imputed)
+    if weights is None:
+        weights = np.ones(len(X))
+    linear_regression.coef_covariance_, linear_regression.residual_variance_ = coefficient_covariance(
+        weights.sum(), weights @ X_imputed, X_imputed.T @ (X_imputed * weights[:, np.newaxis]),
+        weights @ residuals ** 2)
 
     print()
     print("Results of the LinearRegression model:")
-    print(f"""Score: {regression_model.score(X_imputed, y)}""")
-    print(f"""Intercept (Offset): {regression_model.intercept_}""")
-    feature_names = ['wohnflaeche', 'zimmeranzahl',
-                     'schlafzimmer', 'badezimmer', 'aufzug', 'balkon', 'denkmalobjekt',
-                     'parkplatz', 'energieeffizienzklasse']
-    print(f"""Coefficients: {list(zip(feature_names, regression_model.coef_))}""")
+    print(f"""Score: {regression_model.score(X, y, sample_weight=weights)}""")
+    print(f"""Intercept (Offset): {linear_regression.intercept_}""")
+    print(f"""Coefficients: {list(zip(inference.FEATURE_NAMES, linear_regression.coef_))}""")
     return regression_model
 
 
+def _training_weights(sample_weight, n_rows):
+    """weights of the offers extended by weight 1 for the feedback rows that follow them, None for no weights"""
+    if sample_weight is None:
+        return None
+    sample_weight = np.asarray(sample_weight, dtype=np.float64)
+    return np.concatenate([sample_weight, np.ones(n_rows - len(sample_weight))])
+
+
+def coefficient_covariance(n, sum_x, sum_xx, residual_sum_of_squares):
+    """
+    Covariance of [intercept, coef] of a least squares fit, residual_variance * (X^T X)^-1 with X extended by a
+    leading column of ones, for the intervals of inference.CompactLinearModel.predict_interval()
+
+    :param n: number of rows
+    :param sum_x: column sums of the (imputed) inputs
+    :param sum_xx: X^T X of the (imputed) inputs
+    :param residual_sum_of_squares: sum of the squared residuals of the fit
+    :return: covariance as numpy array of shape (p + 1, p + 1), residual variance
+    """
+    residual_variance = residual_sum_of_squares / max(n - len(sum_x) - 1, 1)
+    gram = np.block([[np.array([[n]], dtype=np.float64), sum_x[np.newaxis, :]], [sum_x[:, np.newaxis], sum_xx]])
+    # pinv, so a feature without variance (e.g. only one energy class in a small region) gets no variance either
+    return residual_variance * np.linalg.pinv(gram, hermitian=True), residual_variance
+
+
+def _sufficient_statistics_of_arrays(X, y, sample_weight=None) -> np.ndarray:
+    """
+    Z^T Z for the rows z = [observed values (0 where missing), missing indicators, 1, y], Z^T W Z with weights.
+
+    From these sums alone, the mean imputation and then X^T X and X^T y of the imputed data can be
+    reconstructed, for any number of rows added later, see solve_sufficient_statistics().
+    """
+    observed = ~np.isnan(X)
+    Z = np.column_stack([np.where(observed, X, 0.0), (~observed).astype(np.float64), np.ones(len(X)), y])
+    if sample_weight is None:
+        return Z.T @ Z
+    return Z.T @ (Z * sample_weight[:, np.newaxis])
+
+
+def compute_sufficient_statistics(df_offers, df_feedback=None, sample_weight=None) -> np.ndarray:
+    """
+    sufficient statistics of the training data for the regression model, see _sufficient_statistics_of_arrays()
+    statistics of several data sets are combined by adding them up
+
+    :param df_offers: list of apartments with features and price as a pandas data frame
+    :param df_feedback: optional dataframe with feedback data
+    :param sample_weight: optional weight of each offer, see train_regression_model()
+    :return: symmetric numpy array of shape (2 * 9 + 2, 2 * 9 + 2)
+    """
+    X, y = _prepare_training_data(df_offers, df_feedback)
+    return _sufficient_statistics_of_arrays(X, y, _training_weights(sample_weight, len(X)))
+
+
+def compute_drift_reference(df_offers, df_feedback=None, sample_weight=None) -> drift.DriftSketch:
+    """
+    sketch of the features and prices the model is trained on, for the drift monitor of drift.py
+
+    :param df_offers: list of apartments with features and price as a pandas data frame
+    :param df_feedback: optional dataframe with feedback data
+    :param sample_weight: optional weight of each offer, see train_regression_model()
+    :return: drift.DriftSketch of drift.FEEDBACK_COLUMNS
+    """
+    X, y = _prepare_training_data(df_offers, df_feedback)
+    sketch = drift.DriftSketch(drift.FEEDBACK_COLUMNS)
+    sketch.observe_rows(np.column_stack([X, y]), _training_weights(sample_weight, len(X)))
+    return sketch
+
+
+def training_window_weights(df_offers, window):
+    """
+    weights of the offers in a training window, see time_windows.py
+
+    :param df_offers: preprocessed offers of all months the window may cover
+    :param window: name of the window, e.g. 'rolling-months=24', or 'auto' for the best window of a backtest
+    :return: numpy array of the weight of each offer, for train_regression_model()
+    """
+    import time_windows as time_windows
+
+    if window == 'auto':
+        leaderboard = time_windows.backtest(time_windows.monthly_sufficient_statistics(df_offers))
+        if not leaderboard:
+            raise ValueError("no training window could be backtested, too few offers per month")
+        time_windows.print_leaderboard(leaderboard)
+        window = leaderboard[0]['window']
+    weights = time_windows.window_weights(df_offers, window)
+    print(f"Training window '{window}': {np.count_nonzero(weights):,} of {len(weights):,} offers, "
+          f"total weight {weights.sum():,.0f}")
+    return weights
+
+
+def compute_sufficient_statistics_streaming(paths_to_files, keep_since_year, remove_duplicates=True,
+                                            chunk_size=200_000, df_feedback=None, drift_sketch=None) -> np.ndarray:
+    """
+    sufficient statistics of one or more CampusFiles in a single streaming pass, see iter_immo24_offers_from_csv()
+
+    Only one chunk is in memory at a time. The statistics of a chunk are summed up right away; since they include
+    the missing indicators, the means for the imputation need no pass of their own, see solve_sufficient_statistics().
+
+    :param paths_to_files: paths to the CSV files
+    :param keep_since_year: see preprocess_immo24_offers()
+    :param remove_duplicates: see preprocess_immo24_offers()
+    :param chunk_size: rows read at once, bounds the memory
+    :param df_feedback: optional dataframe with feedback data
+    :param drift_sketch: optional drift.DriftSketch of drift.FEEDBACK_COLUMNS, the chunks are added to it as well
+    :return: see compute_sufficient_statistics()
+    """
+    p = len(inference.FEATURE_NAMES)
+    statistics = np.zeros((2 * p + 2, 2 * p + 2))
+    for path_to_file in paths_to_files:
+        for df_offers in iter_immo24_offers_from_csv(path_to_file, keep_since_year, remove_duplicates, chunk_size):
+            statistics += compute_sufficient_statistics(df_offers)
+            if drift_sketch is not None:
+                drift_sketch.merge(compute_drift_reference(df_offers))
+    if df_feedback is not None and not df_feedback.empty:
+        statistics += _sufficient_statistics_of_arrays(*_prepare_training_data(df_feedback))
+        if drift_sketch is not None:
+            drift_sketch.merge(compute_drift_reference(df_feedback))
+    return statistics
+
+
+def train_regression_model_out_of_core(paths_to_files, keep_since_year, df_feedback=None, chunk_size=200_000,
+                                       drift_sketch=None):
+    """
+    Train the regression model of train_regression_model() on CampusFiles of any size,
+    from sufficient statistics accumulated chunk by chunk, see compute_sufficient_statistics_streaming().
+    Same result as train_regression_model() on all offers, up to rounding.
+
+    :param paths_to_files: paths to the CSV files
+    :param keep_since_year: see preprocess_immo24_offers()
+    :param df_feedback: optional dataframe with feedback data
+    :param chunk_size: rows read at once
+    :param drift_sketch: see compute_sufficient_statistics_streaming()
+    :return: regression_model as sklearn pipeline, sufficient statistics for incremental updates
+    """
+    statistics = compute_sufficient_statistics_streaming(paths_to_files, keep_since_year, chunk_size=chunk_size,
+                                                         df_feedback=df_feedback, drift_sketch=drift_sketch)
+    p = len(inference.FEATURE_NAMES)
+    compact_model = solve_sufficient_statistics(statistics)
+
+    print()
+    print(f"Results of the LinearRegression model, out of core on {statistics[2 * p, 2 * p]:,.0f} rows:")
+    print(f"""Intercept (Offset): {compact_model.intercept}""")
+    print(f"""Coefficients: {list(zip(inference.FEATURE_NAMES, compact_model.coef))}""")
+    return regression_model_from_compact_model(compact_model), statistics
+
+
+def find_region_files(data_dir) -> dict:
+    """
+    CampusFiles of all regions in a directory, named like CampusFile_Wohnungskauf_Leipzig.csv
+
+    :return: dict of region key (see inference.normalize_region()) -> path of the CampusFile
+    """
+    region_files = {}
+    for file_name in sorted(os.listdir(data_dir)):
+        if file_name.startswith(REGION_FILE_PREFIX) and file_name.endswith('.csv'):
+            region = inference.normalize_region(file_name[len(REGION_FILE_PREFIX):-len('.csv')])
+            region_files[region] = os.path.join(data_dir, file_name)
+    return region_files
+
+
+def _train_region_model(region, path_to_file, keep_since_year, model_dir):
+    """train the model of one region out of core and save it as model artifact <region>.lpzm, in a worker process"""
+    started = time.perf_counter()
+    statistics = compute_sufficient_statistics_streaming([path_to_file], keep_since_year)
+    compact_model = solve_sufficient_statistics(statistics)
+    inference.save_model_artifact(compact_model,
+                                  os.path.join(model_dir, f'{region}{inference.MODEL_ARTIFACT_EXTENSION}'))
+    p = len(inference.FEATURE_NAMES)
+    return region, int(statistics[2 * p, 2 * p]), time.perf_counter() - started
+
+
+def train_region_models(region_files, keep_since_year, model_dir=inference.REGION_MODEL_DIR, workers=None) -> dict:
+    """
+    Train the models of many regions in parallel worker processes, each out of core like
+    train_regression_model_out_of_core(), and save them to model_dir for inference.ModelRegistry
+
+    :param region_files: dict of region key -> path of its CampusFile, see find_region_files()
+    :param keep_since_year: see preprocess_immo24_offers()
+    :param model_dir: directory for the model files <region>.lpzm
+    :param workers: number of worker processes, default: number of CPUs
+    :return: dict of region key -> number of offers trained on
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    os.makedirs(model_dir, exist_ok=True)
+    trained = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_train_region_model, region, path_to_file, keep_since_year, model_dir)
+                   for region, path_to_file in region_files.items()]
+        for future in as_completed(futures):
+            region, rows, seconds = future.result()
+            trained[region] = rows
+            print(f"Trained model of region '{region}' on {rows:,} offers in {seconds:.1f} s.")
+    return trained
+
+
+def solve_sufficient_statistics(statistics) -> inference.CompactLinearModel:
+    """
+    Fit mean imputation and linear regression from sufficient statistics alone, in O(features^2) memory.
+    Same result as train_regression_model() on all rows the statistics were computed from, up to rounding.
+
+    :param statistics: see compute_sufficient_statistics()
+    :return: the model as CompactLinearModel
+    """
+    p = len(inference.FEATURE_NAMES)
+    values, missing, one, label = slice(0, p), slice(p, 2 * p), 2 * p, 2 * p + 1
+    n = statistics[one, one]
+    n_missing = statistics[one, missing]
+    means = statistics[one, values] / (n - n_missing)
+
+    # every imputed value x_j = value_j + missing_j * mean_j, so the sums expand into the blocks of the statistics
+    sum_x = statistics[one, values] + n_missing * means
+    cross = statistics[values, missing] * means[np.newaxis, :]
+    sum_xx = (statistics[values, values] + cross + cross.T
+              + np.outer(means, means) * statistics[missing, missing])
+    sum_xy = statistics[values, label] + means * statistics[missing, label]
+
+    # least squares with intercept on the centered data, like LinearRegression
+    mean_x, mean_y = sum_x / n, statistics[one, label] / n
+    covariance = sum_xx / n - np.outer(mean_x, mean_x)
+    cross_covariance = sum_xy / n - mean_x * mean_y
+    coef = np.linalg.lstsq(covariance, cross_covariance, rcond=None)[0]
+
+    # residual sum of squares from the centered moments, which keeps the cancellation of large prices small
+    residual_sum_of_squares = max(n * (statistics[label, label] / n - mean_y ** 2 - coef @ cross_covariance), 0.0)
+    coef_covariance, residual_variance = coefficient_covariance(n, sum_x, sum_xx, residual_sum_of_squares)
+    return inference.CompactLinearModel(coef, mean_y - mean_x @ coef, means, covariance=coef_covariance,
+                                        residual_variance=residual_variance)
+
+
+def regression_model_from_compact_model(compact_model):
+    """
+    sklearn pipeline of mean imputation and linear regression with the arrays of a compact model,
+    as trained by train_regression_model(), e.g. for save_regression_model_to_model_store();
+    the plain linear regression for a compact model without imputation
+    """
+    from sklearn.impute import SimpleImputer
+    from sklearn.linear_model import LinearRegression
+    from sklearn.pipeline import Pipeline
+
+    # fit on dummy data to set up the fitted state, then take over the coefficients
+    linear_regression = LinearRegression().fit(np.zeros((2, len(compact_model.coef))), np.zeros(2))
+    linear_regression.coef_ = compact_model.coef.copy()
+    linear_regression.intercept_ = compact_model.intercept
+    if compact_model.has_intervals:
+        linear_regression.coef_covariance_ = compact_model.covariance.copy()
+        linear_regression.residual_variance_ = compact_model.residual_variance
+    if compact_model.imputer_means is None:
+        return linear_regression
+    # fitted on a single row of the means, the imputer learns exactly these means
+    imputer = SimpleImputer(missing_values=np.nan, strategy='mean').fit(compact_model.imputer_means[np.newaxis, :])
+    return Pipeline([('imputer', imputer), ('regression', linear_regression)])
+
+
+def save_sufficient_statistics(statistics, last_feedback_shard, file_name, folded_shards=(), df_submissions=None):
+    """
+    save sufficient statistics next to the model
+
+    :param statistics: see compute_sufficient_statistics()
+    :param last_feedback_shard: name of the newest feedback shard included, None if none
+    :param file_name: .npz file to write
+    :param folded_shards: names of the shards included that were submitted within FEEDBACK_WATERMARK_LAG before
+        last_feedback_shard, see _feedback_watermark()
+    :param df_submissions: feedback records included that have a session, see _session_submissions()
+    """
+    if df_submissions is None:
+        df_submissions = _session_submissions(None)
+    np.savez(file_name, statistics=statistics, feature_names=np.array(inference.FEATURE_NAMES),
+             last_feedback_shard=np.array(last_feedback_shard or ''),
+             folded_shards=np.array(sorted(folded_shards), dtype=str),
+             submission_values=df_submissions[_SUBMISSION_VALUE_COLUMNS].to_numpy(dtype=np.float64),
+             submission_sessions=df_submissions['session_id'].to_numpy(dtype=str),
+             submission_shards=df_submissions['shard'].fillna('').to_numpy(dtype=str))
+
+
+def load_sufficient_statistics(file_name):
+    """
+    load sufficient statistics saved before with save_sufficient_statistics()
+
+    :return: statistics, name of the newest feedback shard included (None if none),
+        names of the shards included within FEEDBACK_WATERMARK_LAG before it,
+        feedback records included that have a session (both empty for files written without them)
+    """
+    import pandas as pd
+
+    with np.load(file_name) as stats_file:
+        if list(stats_file['feature_names']) != inference.FEATURE_NAMES:
+            raise ValueError(f"statistics in '{file_name}' are for other features: {list(stats_file['feature_names'])}")
+        folded_shards = [str(name) for name in stats_file['folded_shards']] if 'folded_shards' in stats_file else []
+        df_submissions = _session_submissions(None)
+        if 'submission_values' in stats_file:
+            df_submissions = pd.DataFrame(stats_file['submission_values'], columns=_SUBMISSION_VALUE_COLUMNS)
+            df_submissions['session_id'] = pd.Series(stats_file['submission_sessions'], dtype='string')
+            df_submissions['shard'] = pd.Series(stats_file['submission_shards'], dtype='string').replace('', None)
+        return (stats_file['statistics'], str(stats_file['last_feedback_shard']) or None, folded_shards,
+                df_submissions)
+
+
+def _session_submissions(df_feedback):
+    """
+    valid feedback records that have a session, one per session and apartment, with their shard: kept with the
+    sufficient statistics, so that "-i" drops repeated submissions against the records included before
+
+    :param df_feedback: valid feedback, see _validate_feedback(), None for none
+    """
+    import pandas as pd
+
+    columns = storage.FEEDBACK_COLUMNS + ['shard']
+    if df_feedback is None:
+        return pd.DataFrame({column: pd.Series(dtype='string' if column in ('session_id', 'shard') else 'float64')
+                             for column in columns})
+    if 'shard' not in df_feedback:
+        # legacy feedback.csv only
+        df_feedback = df_feedback.assign(shard=pd.Series(None, index=df_feedback.index, dtype='string'))
+    return df_feedback.loc[df_feedback['session_id'].notna(), columns].reset_index(drop=True)
+
+
+def _drop_repeated_submissions(df_feedback, df_submissions):
+    """
+    drop repeated submissions of a session across incremental updates, like storage.validate_feedback() does within
+    the feedback read at once: per session and apartment, the record of the newest shard counts
+
+    :param df_feedback: new valid feedback with column 'shard'
+    :param df_submissions: feedback records with session included before, see _session_submissions()
+    :return: new records to include, records included before to take out again, records with session included after
+    """
+    import pandas as pd
+
+    df_all = pd.concat([df_submissions.assign(included=True), df_feedback.assign(included=False)], ignore_index=True)
+    # stable, so records of the same shard stay in the order of submission
+    df_all = df_all.iloc[np.argsort(df_all['shard'].fillna('').to_numpy(dtype=str), kind='stable')]
+    repeated = df_all['session_id'].notna() & df_all.duplicated(subset=storage.FEEDBACK_COLUMNS[1:], keep='last')
+    df_kept = df_all[~repeated]
+    return (df_kept[~df_kept['included']].drop(columns='included'),
+            df_all[repeated & df_all['included']].drop(columns='included'),
+            _session_submissions(df_kept.drop(columns='included')))
+
+
+def _feedback_watermark(shards, last_feedback_shard=None, folded_shards=()):
+    """
+    watermark of the feedback included in the sufficient statistics: the newest shard, plus the names of the shards
+    submitted within FEEDBACK_WATERMARK_LAG before it, as these are read again by the next incremental update
+
+    :param shards: names of the shards of the feedback read, valid or not, NaN for the legacy feedback.csv
+    :param last_feedback_shard: newest shard included before, None if none
+    :param folded_shards: shards included before within the lag of last_feedback_shard
+    :return: name of the newest shard (None if none), names of the shards included within the lag of it
+    """
+    shards = set(shards.dropna()) | set(folded_shards) | ({last_feedback_shard} if last_feedback_shard else set())
+    if not shards:
+        return None, []
+    last_feedback_shard = max(shards)
+    since_shard = storage.shard_watermark(last_feedback_shard, FEEDBACK_WATERMARK_LAG)
+    return last_feedback_shard, sorted(shard for shard in shards if shard > since_shard)
+
+
+def update_regression_model_incrementally(statistics_file, client=None, bucket=storage.FEEDBACK_BUCKET):
+    """
+    Fold feedback submitted since the last update into the saved sufficient statistics and re-solve the model,
+    without loading the ImmobilienScout24 data again. Same result as a full training on the same data, up to rounding.
+
+    Feedback is tracked by the name of its shard in the feedback log, which sorts by time of submission. As a shard can
+    land after newer ones (slow upload, clock of the writer behind), the log is read again from FEEDBACK_WATERMARK_LAG
+    before the newest shard included, skipping the shards included by name. Shards landing later than that are missed.
+    A session that submits an apartment again replaces its earlier record, also one included by an earlier update:
+    the statistics are additive, so the earlier record is subtracted again.
+
+    :param statistics_file: sufficient statistics saved by a full training, updated in place
+    :param client: MinIO client, default: see storage.create_client()
+    :param bucket: bucket holding the feedback log
+    :return: regression_model as sklearn pipeline, None if there was no new feedback
+    """
+    statistics, last_feedback_shard, folded_shards, df_submissions = load_sufficient_statistics(statistics_file)
+    since_shard = storage.shard_watermark(last_feedback_shard, FEEDBACK_WATERMARK_LAG) if last_feedback_shard else None
+    client = client or storage.create_client()
+    df_feedback = storage.get_feedback_dataframe(client, bucket=bucket, since_shard=since_shard, with_shard=True)
+    df_feedback = df_feedback[~df_feedback['shard'].isin(folded_shards)]
+    if df_feedback.empty:
+        print(f"No new feedback since {last_feedback_shard}.")
+        return None
+
+    # also quarantined records count as read, so the next update does not read them again
+    last_feedback_shard, folded_shards = _feedback_watermark(df_feedback['shard'], last_feedback_shard, folded_shards)
+    df_feedback, df_replaced, df_submissions = _drop_repeated_submissions(_validate_feedback(df_feedback),
+                                                                          df_submissions)
+    X, y = _prepare_training_data(df_feedback)
+    statistics = statistics + _sufficient_statistics_of_arrays(X, y)
+    if not df_replaced.empty:
+        X_replaced, y_replaced = _prepare_training_data(df_replaced)
+        statistics = statistics - _sufficient_statistics_of_arrays(X_replaced, y_replaced)
+    compact_model = solve_sufficient_statistics(statistics)
+    save_sufficient_statistics(statistics, last_feedback_shard, statistics_file, folded_shards, df_submissions)
+
+    print(f"Folded {len(df_feedback)} new feedback records into the model, replacing {len(df_replaced)} earlier "
+          f"submissions of the same sessions.")
+    print(f"""Intercept (Offset): {compact_model.intercept}""")
+    print(f"""Coefficients: {list(zip(inference.FEATURE_NAMES, compact_model.coef))}""")
+    return regression_model_from_compact_model(compact_model)
+
+
 def save_regression_model_to_file(regression_model, file_name):
-    """save the model to disk"""
-    pickle.dump(regression_model, open(file_name, 'wb'))
+    """save the model to disk, pickled, for models without compact form only, see save_model_artifact_to_file()"""
+    with open(file_name, 'wb') as model_file:
+        pickle.dump(regression_model, model_file)
+
+
+def save_model_artifact_to_file(regression_model, file_name):
+    """save the arrays of a linear model as model artifact, loaded without pickle and sklearn, see inference.py"""
+    inference.save_model_artifact(regression_model, file_name)
+
+
+def save_compact_model_to_file(regression_model, file_name):
+    """save coefficients, intercept, imputation means and feature order of the model as JSON, see inference.py"""
+    compact_model = inference.compact_model_from_regression_model(regression_model)
+    with open(file_name, 'w') as model_file:
+        json.dump(compact_model.to_dict(), model_file, indent=2)
+
 
+def save_regression_model_to_model_store(regression_model, model_name=inference.REGISTERED_MODEL_NAME,
+                                         drift_reference_file=None):
+    """
+    save the model to model store in ML Flow, see inference.registered_model_name() for the models of regions
+
+    :param drift_reference_file: sketch of the training data, see drift.py; registered with the model version as
+        inference.DRIFT_REFERENCE_ARTIFACT, so the live data of the version is compared with its own training data
+    """
+    import mlflow
+    import mlflow.sklearn
 
-def save_regression_model_to_model_store(regression_model):
-    """save the model to model store in ML Flow"""
-    # log model
-    result = mlflow.sklearn.log_model(sk_model=regression_model,
-                                      artifact_path='group7-linear-regression-model',
-                                      registered_model_name='group7-linear-regression-model')
+    with mlflow.start_run() as run, tempfile.TemporaryDirectory() as save_dir:
+        model_dir = os.path.join(save_dir, model_name)
+        mlflow.sklearn.save_model(regression_model, model_dir)
+        if drift_reference_file is not None and os.path.isfile(drift_reference_file):
+            shutil.copyfile(drift_reference_file, os.path.join(model_dir, inference.DRIFT_REFERENCE_ARTIFACT))
+        elif drift_reference_file is not None:
+            print(f"Warning: drift reference '{drift_reference_file}' is missing, the model is registered without it.")
+        # log model, the reference is part of the model directory and so of the registered version
+        mlflow.log_artifacts(model_dir, artifact_path=model_name)
+        result = mlflow.register_model(f"runs:/{run.info.run_id}/{model_name}", model_name)
     print(result)
 
 
@@ -295,29 +866,159 @@ def main() -> int:
     """
     parser = argparse.ArgumentParser(description='Training pipeline with optional feedback processing')
     parser.add_argument("-f", action='store_true', help="include feedback data in training")
+    parser.add_argument("-s", "--streaming", action='store_true',
+                        help="load the CampusFile chunk by chunk with compact data types (constant peak memory)")
+    parser.add_argument("--no-cache", action='store_true',
+                        help=f"always parse the CampusFile, do not use the cache in {TRAINING_CACHE_DIR}")
+    parser.add_argument("--no-plots", action='store_true',
+                        help=f"do not render the diagnostics plots into {diagnostics.PLOT_DIR}")
+    parser.add_argument("-i", "--incremental", action='store_true',
+                        help="only fold new feedback into the sufficient statistics of the last training")
+    parser.add_argument("-o", "--out-of-core", action='store_true',
+                        help="train from sufficient statistics accumulated chunk by chunk (memory independent of "
+                             "the data size), without plots")
+    parser.add_argument("--data-files", nargs='+',
+                        help="CampusFiles to train on out of core, default: the CampusFile of Leipzig")
+    parser.add_argument("--regions-dir",
+                        help=f"train one model per {REGION_FILE_PREFIX}<Region>.csv in this directory, in parallel "
+                             f"and out of core, into {inference.REGION_MODEL_DIR}")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes for --regions-dir, default: number of CPUs")
+    parser.add_argument("--near-duplicates", action='store_true',
+                        help="also remove relisted offers that the duplicateid does not mark, see near_duplicates.py "
+                             "(not with --out-of-core and --regions-dir)")
+    parser.add_argument("--window", metavar="WINDOW",
+                        help="train on the offers of a time window over all years, e.g. 'rolling-months=24' or "
+                             "'exponential-half_life=12', or 'auto' for the best window of a backtest, see "
+                             "time_windows.py (not with --out-of-core, --regions-dir and -i)")
+    parser.add_argument("--metrics-file", default=metrics.METRICS_FILE,
+                        help="write the stage times in the Prometheus text format to this file at the end")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="sample the stacks of the run and write them as collapsed stacks to this file")
     args = parser.parse_args()
+    if args.window and (args.out_of_core or args.regions_dir or args.incremental):
+        # the window weighs each offer by its month, these modes only have statistics summed up over all months
+        parser.error("--window needs the offers in memory, not with --out-of-core, --regions-dir or -i")
+
+    if args.metrics_file:
+        metrics.enable()
+    profiler = metrics.SamplingProfiler(args.profile).start() if args.profile else None
+    try:
+        with metrics.timer('training_stage_seconds', stage='total'):
+            return run_training_pipeline(args)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        if args.metrics_file:
+            metrics.write_file(args.metrics_file)
+            print(f"Metrics written to '{args.metrics_file}'.")
+
+
+def _stage(name):
+    """timer of one stage of the training pipeline"""
+    return metrics.timer('training_stage_seconds', stage=name)
+
+
+def run_training_pipeline(args) -> int:
+    """the stages of the training pipeline, as chosen by the command line arguments of main()"""
+    import pandas as pd
 
     # print(os.getcwd()) => "c:/.../se4ai-2022-7/apartment_price_estimate"
     IMMO24_DATA_FILE = '../data/CampusFile_Wohnungskauf_Leipzig.csv'
     KEEP_SINCE_YEAR = 2020
+    STATISTICS_FILE = 'model/lpz_apt_prices_regression_stats.npz'
+    if args.window:
+        # the window picks the months, so all of them are loaded
+        KEEP_SINCE_YEAR = WINDOW_KEEP_SINCE_YEAR
+
+    if args.incremental:
+        with _stage('incremental_update'):
+            regression_model = update_regression_model_incrementally(STATISTICS_FILE)
+        if regression_model is not None:
+            with _stage('save'):
+                save_model_artifact_to_file(regression_model, 'model/lpz_apt_prices_regression_model.lpzm')
+                save_compact_model_to_file(regression_model, 'model/lpz_apt_prices_regression_model.json')
+            with _stage('register'):
+                # the feedback folded in hardly moves the training data, so the reference of the last training stays
+                save_regression_model_to_model_store(regression_model, drift_reference_file=drift.DRIFT_REFERENCE_FILE)
+        return 0
 
-    df_immo24_offers = load_immo24_offers_from_csv_into_pandas_dataframe(IMMO24_DATA_FILE)
-    df_immo24_offers = preprocess_immo24_offers(df_immo24_offers,
-                                                keep_since_year=KEEP_SINCE_YEAR, remove_duplicates=True)
-    pd.options.display.max_columns = df_immo24_offers.shape[1]
-    # print(df_immo24_offers.describe())
-    plot_input_data(df_immo24_offers, KEEP_SINCE_YEAR)
+    if args.regions_dir:
+        with _stage('train_regions'):
+            trained = train_region_models(find_region_files(args.regions_dir), KEEP_SINCE_YEAR, workers=args.workers)
+        with _stage('register'):
+            for region in sorted(trained):
+                compact_model = inference.load_model_artifact(
+                    os.path.join(inference.REGION_MODEL_DIR, f'{region}{inference.MODEL_ARTIFACT_EXTENSION}'))
+                save_regression_model_to_model_store(regression_model_from_compact_model(compact_model),
+                                                     inference.registered_model_name(region))
+        return 0
 
     if args.f:
         print("Training on Immoscout24 data *** plus feedback data ***.")
-        df_feedback = load_feedback_from_csv_into_pandas_dataframe()
-        regression_model = train_regression_model(df_immo24_offers, df_feedback)
+        with _stage('load_feedback'):
+            df_feedback = _read_feedback()
+            # also invalid and repeated records count as read, so "-i" does not read them again
+            last_feedback_shard, folded_shards = _feedback_watermark(df_feedback['shard'])
+            df_feedback = _validate_feedback(df_feedback)
     else:
         print("Training on Immoscout24 data only. Feedback is neglected.")
-        regression_model = train_regression_model(df_immo24_offers)
+        df_feedback = None
+        last_feedback_shard, folded_shards = None, []
+
+    diagnostics_job = None
+    if args.out_of_core:
+        drift_reference = drift.DriftSketch(drift.FEEDBACK_COLUMNS)
+        with _stage('train_out_of_core'):
+            regression_model, statistics = train_regression_model_out_of_core(
+                args.data_files or [IMMO24_DATA_FILE], KEEP_SINCE_YEAR, df_feedback, drift_sketch=drift_reference)
+    else:
+        with _stage('load_offers'):
+            if not args.no_cache:
+                df_immo24_offers = load_preprocessed_immo24_offers(IMMO24_DATA_FILE, keep_since_year=KEEP_SINCE_YEAR,
+                                                                   remove_duplicates=True, streaming=args.streaming)
+            elif args.streaming:
+                df_immo24_offers = load_immo24_offers_streaming(IMMO24_DATA_FILE, keep_since_year=KEEP_SINCE_YEAR,
+                                                                remove_duplicates=True)
+            else:
+                df_immo24_offers = load_immo24_offers_from_csv_into_pandas_dataframe(IMMO24_DATA_FILE)
+                df_immo24_offers = preprocess_immo24_offers(df_immo24_offers,
+                                                            keep_since_year=KEEP_SINCE_YEAR, remove_duplicates=True)
+        if args.near_duplicates:
+            with _stage('near_duplicates'):
+                df_immo24_offers = remove_near_duplicate_offers(df_immo24_offers)
+        sample_weight = None
+        if args.window:
+            with _stage('window'):
+                sample_weight = training_window_weights(df_immo24_offers, args.window)
+        metrics.count('training_offers_total', len(df_immo24_offers))
+        pd.options.display.max_columns = df_immo24_offers.shape[1]
+        # print(df_immo24_offers.describe())
+        # rendered in the background while the model is trained
+        with _stage('start_plots'):
+            diagnostics_job = None if args.no_plots else plot_input_data(df_immo24_offers, KEEP_SINCE_YEAR)
+
+        with _stage('train'):
+            regression_model = train_regression_model(df_immo24_offers, df_feedback, sample_weight)
+        with _stage('sufficient_statistics'):
+            statistics = compute_sufficient_statistics(df_immo24_offers, df_feedback, sample_weight)
+        with _stage('drift_reference'):
+            drift_reference = compute_drift_reference(df_immo24_offers, df_feedback, sample_weight)
+
+    with _stage('save'):
+        # keep the sufficient statistics for incremental updates with "-i"
+        save_sufficient_statistics(statistics, last_feedback_shard, STATISTICS_FILE, folded_shards,
+                                   _session_submissions(df_feedback))
 
-    save_regression_model_to_file(regression_model, 'model/lpz_apt_prices_regression_model.pickle')
-    save_regression_model_to_model_store(regression_model)
+        save_model_artifact_to_file(regression_model, 'model/lpz_apt_prices_regression_model.lpzm')
+        save_compact_model_to_file(regression_model, 'model/lpz_apt_prices_regression_model.json')
+        # the live data of this model is compared with its training data, see drift.py
+        drift.save_sketch(drift_reference, drift.DRIFT_REFERENCE_FILE)
+    with _stage('register'):
+        save_regression_model_to_model_store(regression_model, drift_reference_file=drift.DRIFT_REFERENCE_FILE)
+    if diagnostics_job is not None:
+        with _stage('wait_plots'):
+            diagnostics_job.wait()
     return 0
 
 
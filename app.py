@@ -5,48 +5,227 @@ Web application for the apartment price estimate
 * uses two states:
   * get_input : get input variables and show a price estimate live
   * render_feedback: to inform about successfully having sent feedback
-* loads regression model via inference.py which also does the predictions
-* appends feedback with suggested pricing to a CSV file on a MinIO S3 bucket via storage.py
+* loads regression model once per process via inference.py which also does the predictions
+* keeps the model, the estimates and the feedback writer once per server process (st.cache_resource), not per rerun
+* renders the inputs, the estimate and the feedback on it as a fragment: an input change reruns only this panel,
+  see benchmark_app.py
+* appends feedback with suggested pricing to a feedback log on a MinIO S3 bucket via storage.py
+* observes the estimated apartments and the feedback in the drift monitor of drift.py, which compares them with the
+  training data of the served model version
+* with METRICS_ENABLED=1 METRICS_PORT=<port>, serves the latencies of estimate and feedback on
+  http://<host>:<port>/metrics, and with PROFILE_OUTPUT=<file> samples its stacks, see metrics.py
 """
 
+import uuid
+from functools import lru_cache
+
 import streamlit as st
 import numpy as np
+import apartment_price_estimate.drift as drift
 import apartment_price_estimate.inference as inference
+import apartment_price_estimate.metrics as metrics
 import apartment_price_estimate.storage as storage
 
 
+# model file to serve, if the ML Flow model registry is unavailable and no model is cached on disk yet
+MODEL_FALLBACK_FILE = "apartment_price_estimate/model/lpz_apt_prices_regression_model.lpzm"
+
+# probability that the price of an apartment lies in the displayed price range
+PRICE_RANGE_LEVEL = 0.8
+
+# translate energy efficiency class labels to numeric values, the table of inference.py shared by all reruns
+energy_efficency_classes_dict = inference.ENERGY_EFFICIENCY_CLASSES
+
+# initial values of the session state variables, set once per session
+SESSION_DEFAULTS = {'size': 75,
+                    'room_nr': 3.0,
+                    'sleeping_room_nr': 1,
+                    'bathroom_nr': 1,
+                    'lift': False,
+                    'balcony': False,
+                    'monument': False,
+                    'parking': True,
+                    'energy_efficiency_class': "D",
+                    'price': 0,
+                    'price_range': None,
+                    'price_feedback': 184865 / 1000,
+                    'ui_state': "get_input"}
+
+# range of the feedback slider, in thousand EUR
+FEEDBACK_PRICE_RANGE = (20, 1400)
+
+# distinct apartments whose estimates are kept per server process, see _get_estimator()
+ESTIMATE_CACHE_SIZE = 4096
+
+SIDEBAR_TEXT = """
+    Diese einfache streamlit Applikation schätzt Preise von Eigentumswohnungen in Leipzig mit einem 
+    einfachen linearen Regressionsmodell.
+            
+    Es nutzt dafür alle Verkaufsanzeigen von Eigentumswohnungen von ImmobilienScout24 aus den Jahren 2020 und 2021, 
+    aus denen es das lineare Modell abgeleitet hat. Diese Verkaufsanzeigen von Eigentumswohnungen haben im 
+    Public Use File zum Zwecke der Anonymisierung nur eine Zuordnung zur Stadt Leipzig an sich, aber nicht zu 
+    einem Stadtteil oder einer Adresse in Leipzig.
+
+    Die Nutzerin oder der Nutzer sind selbst aufgefordert, sinnvolle Kombinationen der Parameter 
+    einzustellen.
+    
+    Einschränkungen: Selbst für sinnvolle Kombinationen ist der Schätzwert des linearen Modells teils nicht
+    plausibel. An den Rändern der Bereiche passt das lineare Modell an sich nicht. Für kleine Wohnungen
+    unterschätzt das Modell die Preise deutlich. Die binären Optionen wie Aufzug, Balkon, Denkmalobjekt, 
+    Parkplatz bekommen durch das Modell einen festen Preiseinfluss.
+    Der Heizkosteneinfluss bekommt durch das Modell auch einen festen Preiseinfluss pro Stufe, ganz gleich
+    ob 1-Raum-Wohnung oder sehr große 6-Raum-Wohnung.
+    Der Lageeinfluss einer Wohnung innerhalb der Stadt Leipzig bleibt völlig unberücksichtigt, weil
+    ImmobilienScout24 keine Lageinformationen in den Public Use Files bereitstellt.
+    Die reale Preisbildung von Eigentumswohnungen ist deutlich komplexer und kann durch das Modell höchstens 
+    näherungsweise nachgebildet werden.
+    """
+
+
+def _get_model_provider():
+    """
+    The provider of the regression model: inference.py creates it once per server process (not per rerun), so it
+    loads the model once and caches it on local disk. A new "Production" version in the ML Flow model registry is
+    swapped in in the background. Predictions run on the compact form of the model: a plain dot product instead of
+    sklearn's predict().
+    """
+    return inference.get_model_provider(compact=True, fallback_file=MODEL_FALLBACK_FILE)
+
+
+def _get_regression_model():
+    """the current regression model, see _get_model_provider()"""
+    return _get_model_provider().get()
+
+
+@st.cache_resource
+def _get_estimator():
+    """
+    One estimate function per server process, with the estimates of the last ESTIMATE_CACHE_SIZE distinct
+    apartments: all sessions share them, and an input another session has seen is answered without NumPy.
+    The model is part of the key, so a model swapped in by the provider is estimated anew.
+    """
+    @lru_cache(maxsize=ESTIMATE_CACHE_SIZE)
+    def estimate(regression_model, apartment_features):
+        """
+        :param apartment_features: tuple of the 9 feature values in the order of inference.FEATURE_NAMES
+        :return: price, price range (None if the model has no intervals)
+        """
+        features = np.array([apartment_features], dtype=np.float64)
+        # inputs of the UI are answered from the precomputed lookup table of the model, others by the model itself
+        price = inference.predict_price_with_lookup_table(regression_model, features)
+        # price range in closed form, a few microseconds; models registered before it was introduced have none
+        price_range = None
+        if inference.supports_prediction_intervals(regression_model):
+            price_range = inference.predict_price_interval(regression_model, features, level=PRICE_RANGE_LEVEL)
+        return price, price_range
+
+    return estimate
+
+
 def _calculate_apartment():
     """
     Calculate apartment estimate . inference.py does the heavy lifting.
 
     :return: price for the apartment via session state
     """
-    apartment_features = np.array([[int(st.session_state.size),
-                                    st.session_state.room_nr,
-                                    int(st.session_state.sleeping_room_nr),
-                                    int(st.session_state.bathroom_nr),
-                                    int(st.session_state.lift),
-                                    int(st.session_state.balcony),
-                                    int(st.session_state.monument),
-                                    int(st.session_state.parking),
-                                    energy_efficency_classes_dict[st.session_state.energy_efficiency_class]
-                                    ]])
-
-    st.session_state.price = inference.predict_price_on_regression_model(
-        regression_model,
-        apartment_features
-    )
+    apartment_features = (int(st.session_state.size),
+                          st.session_state.room_nr,
+                          int(st.session_state.sleeping_room_nr),
+                          int(st.session_state.bathroom_nr),
+                          int(st.session_state.lift),
+                          int(st.session_state.balcony),
+                          int(st.session_state.monument),
+                          int(st.session_state.parking),
+                          energy_efficency_classes_dict[st.session_state.energy_efficiency_class])
+
+    with metrics.timer('app_seconds', step='estimate'):
+        price, price_range = _get_estimator()(_get_regression_model(), apartment_features)
+
+    # the feedback slider starts at a new estimate, and keeps a price the user has set as long as the estimate holds
+    if price != st.session_state.price:
+        st.session_state.price_feedback = min(max(int(price / 1000), FEEDBACK_PRICE_RANGE[0]), FEEDBACK_PRICE_RANGE[1])
+    st.session_state.price, st.session_state.price_range = price, price_range
+
+    # an apartment is observed once per change of the inputs, not on every rerun of the panel
+    if st.session_state.get('drift_features') != apartment_features:
+        st.session_state.drift_features = apartment_features
+        _get_drift_monitor().observe('query', apartment_features)
+
+
+def _get_drift_monitor():
+    """
+    the drift monitor of the server process, created by drift.py on first use; it compares with the training data of
+    the model version served by _get_model_provider(), see inference.ModelProvider.drift_reference_file
+    """
+    return drift.get_drift_monitor(model_provider=_get_model_provider())
+
+
+@st.cache_resource
+def _get_feedback_writer():
+    """
+    One background feedback writer per server process, shared by all sessions and reruns.
+    """
+    return storage.FeedbackWriter(storage.create_client())
+
+
+@st.cache_resource
+def _start_instrumentation():
+    """
+    Once per server process: the metrics endpoint on METRICS_PORT, if metrics are enabled, and the sampling
+    profiler, if PROFILE_OUTPUT is set.
+    """
+    metrics.start_profiler_from_environment()
+    return metrics.start_http_server() if metrics.ENABLED else None
+
+
+def _pretty_number(price: int) -> str:
+    first_part, residue = divmod(price, 1000)
+    return str(first_part) + " " + str(f"{residue:03d}")
 
 
 def _get_input():
     """
     First state in the UI state model:
-    Load language model and vectorization layer from the inference functions.
-    Provide text box for user to input text sample.
-    Provide button to start language detection.
-    Wait for on_click event on button to proceed, then start .
+    Provide the inputs for the 9 features of an apartment, show the price estimate live and take feedback on it,
+    see _input_panel(). Submitting the feedback leads to the next state.
+    """
+    _input_panel()
+
+
+@st.fragment
+def _input_panel():
     """
+    The inputs, the price estimate and the feedback on it. As a fragment, a change of its inputs reruns only this
+    panel, not the whole app (title, sidebar, session state). The feedback slider is part of the panel, so it is
+    rendered anew with the estimate it starts from.
+    """
+    with metrics.timer('app_seconds', step='input_panel'):
+        _render_input_panel()
+        _render_feedback_input()
+
+
+def _render_feedback_input():
+    st.subheader("Entspricht der berechnete Preis dem, was du gedacht hattest?")
+
+    if st.button('Ja'):
+        _submit_feedback()
 
+    # Collapsed container for submitting feedback
+    with st.expander("Nein"):
+        # starts at the estimate, see _calculate_apartment()
+        st.slider(
+            label="Realistischer Preis der Wohnung (in Tausend EUR)?",
+            min_value=FEEDBACK_PRICE_RANGE[0],
+            max_value=FEEDBACK_PRICE_RANGE[1],
+            step=10,
+            disabled=False,
+            key="price_feedback"
+        )
+        if st.button('Feedback übermitteln'):
+            _submit_feedback()
+
+
+def _render_input_panel():
     st.slider(
         label="Wohnfläche in m²",
         min_value=30,
@@ -118,62 +297,43 @@ def _get_input():
 
     st.write(f"""Wohnungen mit diesen Eigenschaften kosten etwa:""")
 
-    def pretty_number(price: int) -> str:
-        first_part, residue = divmod(price, 1000)
-        return str(first_part) + " " + str(f"{residue:03d}")
-
-    st.markdown(f"""### {pretty_number(st.session_state.price)} €""")
-
-    st.subheader("Entspricht der berechnete Preis dem, was du gedacht hattest?")
-
-    st.button('Ja', on_click=_submit_feedback)
-
-    # Collapsed container for submitting feedback
-    with st.expander("Nein"):
-        st.slider(
-            label="Realistischer Preis der Wohnung (in Tausend EUR)?",
-            min_value=20,
-            max_value=1400,
-            value=int(st.session_state.price / 1000),
-            step=10,
-            disabled=False,
-            key="price_feedback"
-        )
-        st.button('Feedback übermitteln', on_click=_submit_feedback)
+    st.markdown(f"""### {_pretty_number(st.session_state.price)} €""")
+    if st.session_state.price_range is not None:
+        lower, upper = st.session_state.price_range
+        st.caption(f"{PRICE_RANGE_LEVEL:.0%} solcher Wohnungen kosten zwischen {_pretty_number(max(lower, 0))} € "
+                   f"und {_pretty_number(upper)} €.")
 
 
 def _submit_feedback():
     """
-    Insert a feedback record into a table in on an S3 bucket. With "training.py -f"
-    this feedback can be queried from the CSV and put into data/feedback
+    Insert a feedback record into the feedback log on an S3 bucket. With "training.py -f"
+    this feedback can be queried from the log and put into data/feedback
     for retraining the model on this additional data.
     """
 
     if st.session_state.price_feedback > 0:
-        # get feedback file from MinIO to local file
-        storage.get_feedback_from_minio(client)
-
-        # Open local file for writing, append mode to append current feedback record
-        with open("feedback.csv", "a") as csv_file:
-            # assemble row of current feedback record in appropriate order
-            csv_file.write(
-                f"""{st.session_state.price_feedback * 1000},"""
-                f"""{int(st.session_state.size)},"""
-                f"""{st.session_state.room_nr},"""  # is of type "float" to match apartments with 1.5 or 2.5 rooms
-                f"""{int(st.session_state.sleeping_room_nr)},"""
-                f"""{int(st.session_state.bathroom_nr)},"""
-                f"""{int(st.session_state.lift)},"""
-                f"""{int(st.session_state.balcony)},"""
-                f"""{int(st.session_state.monument)},"""
-                f"""{int(st.session_state.parking)},"""
-                f"""{energy_efficency_classes_dict[st.session_state.energy_efficiency_class]}\n"""
-            )
-
-        # put file back to file storage
-        storage.upload_to_minio(client)
-
-    # turn UI state model to next state
+        # assemble current feedback record by the column names of storage.FEEDBACK_SCHEMA
+        feedback_record = {'kaufpreis': st.session_state.price_feedback * 1000,
+                           'wohnflaeche': int(st.session_state.size),
+                           'zimmeranzahl': st.session_state.room_nr,  # "float" to match apartments with 1.5 rooms
+                           'schlafzimmer': int(st.session_state.sleeping_room_nr),
+                           'badezimmer': int(st.session_state.bathroom_nr),
+                           'aufzug': int(st.session_state.lift),
+                           'balkon': int(st.session_state.balcony),
+                           'denkmalobjekt': int(st.session_state.monument),
+                           'parkplatz': int(st.session_state.parking),
+                           'energieeffizienzklasse':
+                               energy_efficency_classes_dict[st.session_state.energy_efficiency_class],
+                           'session_id': st.session_state.session_id}
+
+        # hand record over to the background writer, which validates it and appends it to the feedback log
+        with metrics.timer('app_seconds', step='feedback'):
+            _get_feedback_writer().submit(feedback_record)
+        _get_drift_monitor().observe('feedback', [feedback_record[column] for column in drift.FEEDBACK_COLUMNS])
+
+    # turn UI state model to next state, by a rerun of the whole app instead of the input panel only
     st.session_state.ui_state = "render_feedback"
+    st.rerun()
 
 
 def _render_feedback():
@@ -193,76 +353,29 @@ def main():
     Uses session variables to handle state.
     """
 
-    # common UI elements for all screens
-    st.title("Wohnungspreisschätzer - Leipzig")
-
-    # initialize session state variables
-    if "size" not in st.session_state:
-        st.session_state.size = 75
-    if "room_nr" not in st.session_state:
-        st.session_state.room_nr = 3.0
-    if "sleeping_room_nr" not in st.session_state:
-        st.session_state.sleeping_room_nr = 1
-    if "bathroom_nr" not in st.session_state:
-        st.session_state.bathroom_nr = 1
-    if "lift" not in st.session_state:
-        st.session_state.lift = False
-    if "balcony" not in st.session_state:
-        st.session_state.balcony = False
-    if "monument" not in st.session_state:
-        st.session_state.monument = False
-    if "parking" not in st.session_state:
-        st.session_state.parking = True
-    if "energy_efficiency_class" not in st.session_state:
-        st.session_state.energy_efficiency_class = "D"
-    if "price" not in st.session_state:
-        st.session_state.price = 0
-    if "price_feedback" not in st.session_state:
-        st.session_state.price_feedback = 184865 / 1000
-    if "ui_state" not in st.session_state:
-        st.session_state.ui_state = "get_input"
-
-    with st.sidebar:
-        """
-        Diese einfache streamlit Applikation schätzt Preise von Eigentumswohnungen in Leipzig mit einem 
-        einfachen linearen Regressionsmodell.
-                
-        Es nutzt dafür alle Verkaufsanzeigen von Eigentumswohnungen von ImmobilienScout24 aus den Jahren 2020 und 2021, 
-        aus denen es das lineare Modell abgeleitet hat. Diese Verkaufsanzeigen von Eigentumswohnungen haben im 
-        Public Use File zum Zwecke der Anonymisierung nur eine Zuordnung zur Stadt Leipzig an sich, aber nicht zu 
-        einem Stadtteil oder einer Adresse in Leipzig.
-
-        Die Nutzerin oder der Nutzer sind selbst aufgefordert, sinnvolle Kombinationen der Parameter 
-        einzustellen.
-        
-        Einschränkungen: Selbst für sinnvolle Kombinationen ist der Schätzwert des linearen Modells teils nicht
-        plausibel. An den Rändern der Bereiche passt das lineare Modell an sich nicht. Für kleine Wohnungen
-        unterschätzt das Modell die Preise deutlich. Die binären Optionen wie Aufzug, Balkon, Denkmalobjekt, 
-        Parkplatz bekommen durch das Modell einen festen Preiseinfluss.
-        Der Heizkosteneinfluss bekommt durch das Modell auch einen festen Preiseinfluss pro Stufe, ganz gleich
-        ob 1-Raum-Wohnung oder sehr große 6-Raum-Wohnung.
-        Der Lageeinfluss einer Wohnung innerhalb der Stadt Leipzig bleibt völlig unberücksichtigt, weil
-        ImmobilienScout24 keine Lageinformationen in den Public Use Files bereitstellt.
-        Die reale Preisbildung von Eigentumswohnungen ist deutlich komplexer und kann durch das Modell höchstens 
-        näherungsweise nachgebildet werden.
-        """
-        # st.write(st.session_state)
+    _start_instrumentation()
 
-    # simple two-state state machine
-    if st.session_state.ui_state == "get_input":
-        _get_input()
-    elif st.session_state.ui_state == "render_feedback":
-        _render_feedback()
+    # server time of a whole rerun; changes of the inputs rerun only the input panel, see _get_input()
+    with metrics.timer('app_seconds', step='rerun'):
+        # common UI elements for all screens
+        st.title("Wohnungspreisschätzer - Leipzig")
 
+        # initialize session state variables
+        for key, value in SESSION_DEFAULTS.items():
+            if key not in st.session_state:
+                st.session_state[key] = value
+        if "session_id" not in st.session_state:
+            # identifies repeated feedback of the same session, see storage.validate_feedback()
+            st.session_state.session_id = uuid.uuid4().hex
 
-if __name__ == "__main__":
-    # regression_model = inference.load_regression_model_from_file(
-    #     "apartment_price_estimate/model/lpz_apt_prices_regression_model.pickle")
-    regression_model = inference.load_regression_model_from_model_store()
+        st.sidebar.markdown(SIDEBAR_TEXT)
 
-    # create client for minio server
-    client = storage.create_client()
+        # simple two-state state machine
+        if st.session_state.ui_state == "get_input":
+            _get_input()
+        elif st.session_state.ui_state == "render_feedback":
+            _render_feedback()
 
-    # translate energy efficiency class labels to numeric values
-    energy_efficency_classes_dict = {'A': 1, 'B': 2, 'C': 3, 'D': 4, 'E': 5, 'F': 6, 'G': 7, 'H': 8}
+
+if __name__ == "__main__":
     main()
@@ -0,0 +1,82 @@
+"""
+Benchmark of the server time per rerun of the Streamlit app in app.py
+
+The app is run headless with Streamlit's AppTest, and random input changes are applied one after the other, as by a
+user moving sliders. The server time is taken from the app's own timers (metrics.py, app_seconds):
+* rerun: a whole rerun of main() - the first page view, and every input change before the input panel became a
+  fragment
+* input_panel: the fragment of the inputs, the estimate and the feedback, all a browser session reruns on an input
+  change
+* estimate: the price estimate within the panel, from the process-wide estimate cache or the model
+AppTest itself always reruns the whole script, so every input change is measured at all three levels.
+Run from the repository root, with the model file of MODEL_FALLBACK_FILE or a model registry available:
+python benchmark_app.py --changes 300
+"""
+
+import argparse
+import time
+
+import numpy as np
+from streamlit.testing.v1 import AppTest
+
+import apartment_price_estimate.metrics as metrics
+
+# widgets of the input panel and the values a user may choose, see UI_GRID of inference.py
+INPUT_CHOICES = {'size': list(range(30, 231, 5)),
+                 'room_nr': [value / 2 for value in range(2, 17)],
+                 'sleeping_room_nr': list(range(0, 6)),
+                 'bathroom_nr': list(range(1, 4)),
+                 'lift': [False, True],
+                 'balcony': [False, True],
+                 'monument': [False, True],
+                 'parking': [False, True],
+                 'energy_efficiency_class': list('ABCDEFGH')}
+
+
+def _set_input(app_test, key, value):
+    if key == 'energy_efficiency_class':
+        app_test.select_slider(key=key).set_value(value)
+    elif isinstance(value, bool):
+        app_test.checkbox(key=key).check() if value else app_test.checkbox(key=key).uncheck()
+    else:
+        app_test.slider(key=key).set_value(value)
+
+
+def _mean_ms(step) -> float:
+    histogram = metrics._histograms.get(('app_seconds', (('step', step),)))
+    return histogram.sum / histogram.count * 1000 if histogram is not None and histogram.count else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the server time per rerun of the Streamlit app')
+    parser.add_argument("--changes", type=int, default=300, help="random input changes, one rerun each")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    metrics.enable()
+    app_test = AppTest.from_file('app.py', default_timeout=600)
+    started = time.perf_counter()
+    app_test.run()
+    print(f"First page view (model and lookup table loaded): {time.perf_counter() - started:.2f} s")
+
+    metrics.reset()
+    rng = np.random.default_rng(args.seed)
+    keys = list(INPUT_CHOICES)
+    started = time.perf_counter()
+    for _ in range(args.changes):
+        key = keys[rng.integers(len(keys))]
+        _set_input(app_test, key, INPUT_CHOICES[key][rng.integers(len(INPUT_CHOICES[key]))])
+        app_test.run()
+    seconds = time.perf_counter() - started
+    if app_test.exception:
+        raise RuntimeError(f"app failed: {app_test.exception[0].value}")
+
+    rerun_ms, panel_ms, estimate_ms = _mean_ms('rerun'), _mean_ms('input_panel'), _mean_ms('estimate')
+    print(f"{args.changes} input changes, {seconds / args.changes * 1000:.1f} ms each including AppTest")
+    print(f"server time per rerun: whole app {rerun_ms:.2f} ms, input panel (fragment) {panel_ms:.2f} ms, "
+          f"estimate {estimate_ms:.3f} ms")
+    print(f"an input change costs {panel_ms / rerun_ms:.0%} of a whole rerun")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Fixtures of the tests: an S3 stand-in for the MinIO server, run by moto's ThreadedMotoServer in the test process,
+and synthetic offers in the schema of the CampusFile, see synthetic_data.py
+"""
+
+import uuid
+
+import pytest
+from moto.server import ThreadedMotoServer
+
+import apartment_price_estimate.storage as storage
+
+# offers of the synthetic CampusFile, enough for stable coefficients and histograms
+SYNTHETIC_OFFERS = 20_000
+
+
+@pytest.fixture(scope='session')
+def s3_endpoint():
+    """host:port of an S3 server for the whole test session"""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # any credentials are accepted, but requests are signed with them
+        monkeypatch.setenv('ACCESS_KEY', 'testing')
+        monkeypatch.setenv('SECRET_KEY', 'testing')
+        server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+        server.start()
+        host, port = server.get_host_and_port()
+        yield f'{host}:{port}'
+        server.stop()
+
+
+@pytest.fixture
+def client(s3_endpoint):
+    """MinIO client of the S3 server, see storage.create_client()"""
+    return storage.create_client(s3_endpoint, secure=False)
+
+
+@pytest.fixture
+def bucket(client, tmp_path, monkeypatch):
+    """new empty bucket per test, with a local cache of downloads of its own"""
+    monkeypatch.setattr(storage, 'STORAGE_CACHE_DIR', str(tmp_path / 'storage-cache'))
+    name = f'feedback-{uuid.uuid4().hex[:12]}'
+    client.make_bucket(name)
+    return name
+
+
+@pytest.fixture(scope='session')
+def synthetic_campusfile(tmp_path_factory):
+    """path of a synthetic CampusFile for the whole test session"""
+    import synthetic_data
+    path = str(tmp_path_factory.mktemp('data') / 'CampusFile_Wohnungskauf_Leipzig.csv')
+    synthetic_data.write_immo24_csv(path, SYNTHETIC_OFFERS)
+    return path
+
+
+@pytest.fixture(scope='session')
+def df_offers(synthetic_campusfile):
+    """preprocessed offers of the synthetic CampusFile, as training.py loads them"""
+    import training
+    return training.load_immo24_offers_streaming(synthetic_campusfile, keep_since_year=2007)
+
+
+@pytest.fixture(scope='session')
+def regression_model(df_offers):
+    """model of training.py on the synthetic offers: pipeline of mean imputation and linear regression"""
+    import training
+    return training.train_regression_model(df_offers)
@@ -0,0 +1,40 @@
+"""
+Tests of the drift monitor of drift.py against a reference of synthetic training data
+"""
+
+import numpy as np
+
+import drift
+import training
+
+
+def _live_rows(X, y, n_rows, seed=1) -> np.ndarray:
+    """rows drawn from the observed values of every column, without missing values, like the apartments of the UI"""
+    rng = np.random.default_rng(seed)
+    columns = [rng.choice(values[~np.isnan(values)], n_rows) for values in list(X.T) + [y]]
+    return np.column_stack(columns)
+
+
+def test_live_data_of_the_training_distribution_does_not_drift(df_offers):
+    X, y = training._prepare_training_data(df_offers)
+    # the missing values of the training data must not make a drift of their own
+    assert np.isnan(X).any(axis=0).sum() >= 4
+    reference = training.compute_drift_reference(df_offers)
+    live = drift.DriftSketch(drift.FEEDBACK_COLUMNS)
+    live.observe_rows(_live_rows(X, y, 5_000))
+
+    report = drift.compare_sketches(reference, live)
+
+    assert drift.drifted_columns(report) == []
+    assert max(entry['psi'] for entry in report.values()) < 0.05
+
+
+def test_shifted_live_data_drifts(df_offers):
+    X, y = training._prepare_training_data(df_offers)
+    reference = training.compute_drift_reference(df_offers)
+    rows = _live_rows(X, y, 5_000)
+    rows[:, drift.FEEDBACK_COLUMNS.index('wohnflaeche')] *= 1.6
+    live = drift.DriftSketch(drift.FEEDBACK_COLUMNS)
+    live.observe_rows(rows)
+
+    assert drift.drifted_columns(drift.compare_sketches(reference, live)) == ['wohnflaeche']
@@ -0,0 +1,63 @@
+"""
+Tests of the compact form of the model that inference.py serves
+"""
+
+import numpy as np
+
+import inference
+import training
+
+
+def _apartments_with_missing_values(df_offers, n_rows=2_000, seed=0) -> np.ndarray:
+    """apartments of the training data, with a share of the values of every feature set missing"""
+    X, _ = training._prepare_training_data(df_offers)
+    rng = np.random.default_rng(seed)
+    X = X[rng.choice(len(X), n_rows, replace=False)].copy()
+    X[rng.random(X.shape) < 0.2] = np.nan
+    return X
+
+
+def test_compact_model_predicts_like_the_sklearn_pipeline(regression_model, df_offers):
+    X = _apartments_with_missing_values(df_offers)
+    assert np.isnan(X).any(axis=1).mean() > 0.5
+
+    compact_model = inference.compact_model_from_regression_model(regression_model)
+
+    np.testing.assert_allclose(compact_model.predict(X), regression_model.predict(X), rtol=1e-9)
+
+
+def test_model_artifact_predicts_like_the_sklearn_pipeline(regression_model, df_offers, tmp_path):
+    X = _apartments_with_missing_values(df_offers)
+    artifact_file = str(tmp_path / f'model{inference.MODEL_ARTIFACT_EXTENSION}')
+    inference.save_model_artifact(inference.compact_model_from_regression_model(regression_model), artifact_file)
+
+    compact_model = inference.load_model_artifact(artifact_file)
+
+    np.testing.assert_allclose(compact_model.predict(X), regression_model.predict(X), rtol=1e-9)
+    np.testing.assert_allclose(inference.predict_prices_batch(compact_model, X),
+                               np.round(regression_model.predict(X)), atol=1)
+
+
+def test_price_intervals_match_the_textbook_formula(df_offers):
+    # a small fit, so the intervals are wide and the covariance of the coefficients matters
+    df_small = df_offers.sample(300, random_state=0)
+    X_new = _apartments_with_missing_values(df_offers, n_rows=50, seed=1)
+    z = inference._normal_quantile(0.9)
+
+    X, y = training._prepare_training_data(df_small)
+    means = np.nanmean(X, axis=0)
+    design = np.column_stack([np.ones(len(X)), np.where(np.isnan(X), means, X)])
+    beta, residual_sum_of_squares = np.linalg.lstsq(design, y, rcond=None)[:2]
+    s2 = residual_sum_of_squares[0] / (len(X) - X.shape[1] - 1)
+    x_new = np.column_stack([np.ones(len(X_new)), np.where(np.isnan(X_new), means, X_new)])
+    leverage = np.einsum('ij,jk,ik->i', x_new, np.linalg.inv(design.T @ design), x_new)
+    estimates = x_new @ beta
+
+    # fitted by sklearn and solved from the sufficient statistics of incremental updates
+    for compact_model in (inference.compact_model_from_regression_model(training.train_regression_model(df_small)),
+                          training.solve_sufficient_statistics(training.compute_sufficient_statistics(df_small))):
+        for kind, variance in (('prediction', s2 * (1 + leverage)), ('confidence', s2 * leverage)):
+            estimated, lower, upper = compact_model.predict_interval(X_new, level=0.9, kind=kind)
+            np.testing.assert_allclose(estimated, estimates, rtol=1e-6)
+            np.testing.assert_allclose(upper - estimated, z * np.sqrt(variance), rtol=1e-6)
+            np.testing.assert_allclose(estimated - lower, z * np.sqrt(variance), rtol=1e-6)
@@ -0,0 +1,162 @@
+"""
+Tests of the feedback log of storage.py against an S3 stand-in, see conftest.py
+"""
+
+import io
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import apartment_price_estimate.storage as storage
+
+SUBMITTED = datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc)
+
+
+def _feedback(kaufpreis=250_000, session_id='session-a', **values) -> dict:
+    """feedback of an apartment as submitted by the app"""
+    feedback = {'kaufpreis': kaufpreis, 'wohnflaeche': 60, 'zimmeranzahl': 2, 'schlafzimmer': 1, 'badezimmer': 1,
+                'aufzug': 0, 'balkon': 1, 'denkmalobjekt': 0, 'parkplatz': 0, 'energieeffizienzklasse': 3,
+                'session_id': session_id}
+    feedback.update(values)
+    return feedback
+
+
+def _put_shard(client, bucket, *feedback, minutes=0) -> str:
+    """write the feedback as one shard, submitted minutes after SUBMITTED"""
+    records = [storage.feedback_record(values) for values in feedback]
+    return storage.put_feedback_shard(client, records, bucket=bucket, now=SUBMITTED + timedelta(minutes=minutes))
+
+
+def _object_names(client, bucket, prefix) -> list:
+    return sorted(obj.object_name for obj in client.list_objects(bucket, prefix=prefix, recursive=True))
+
+
+def test_put_feedback_shard_writes_one_object_per_batch(client, bucket):
+    shard = _put_shard(client, bucket, _feedback(200_000), _feedback(300_000, session_id='session-b'))
+
+    assert shard.startswith(f"{storage.FEEDBACK_SHARD_PREFIX}dt=2026-10-17/hour=12/20261017T120000000000-")
+    assert _object_names(client, bucket, storage.FEEDBACK_SHARD_PREFIX) == [shard]
+    df_feedback = storage.get_feedback_dataframe(client, bucket=bucket, with_shard=True)
+    assert list(df_feedback.columns) == storage.FEEDBACK_COLUMNS + ['shard']
+    assert list(df_feedback['kaufpreis']) == [200_000, 300_000]
+    assert list(df_feedback['session_id']) == ['session-a', 'session-b']
+    assert set(df_feedback['shard']) == {shard}
+
+
+def test_feedback_record_rejects_values_outside_the_schema():
+    with pytest.raises(ValueError, match="kaufpreis"):
+        storage.feedback_record(_feedback(kaufpreis=10))
+    with pytest.raises(ValueError, match="in steps of 0.5"):
+        storage.feedback_record(_feedback(zimmeranzahl=2.25))
+    with pytest.raises(ValueError, match="separators"):
+        storage.feedback_record(_feedback(session_id='a,b'))
+    with pytest.raises(ValueError, match="lacks columns"):
+        storage.feedback_record({'kaufpreis': 250_000})
+
+
+def test_put_feedback_shard_rejects_records_of_wrong_length(client, bucket):
+    with pytest.raises(ValueError, match="needs"):
+        storage.put_feedback_shard(client, [[250_000, 60]], bucket=bucket)
+    assert _object_names(client, bucket, storage.FEEDBACK_SHARD_PREFIX) == []
+
+
+def test_validate_feedback_quarantines_corrupt_records_and_counts_repeated_submissions_once(client, bucket):
+    _put_shard(client, bucket, _feedback(200_000), minutes=0)
+    _put_shard(client, bucket, _feedback(220_000), minutes=1)
+    # same apartment from another session: kept
+    _put_shard(client, bucket, _feedback(230_000, session_id='session-b'), minutes=2)
+    # same apartment twice without session, as written before it was recorded (no header, legacy columns): both kept
+    legacy = b"240000,60,2,1,1,0,1,0,0,3\n250000,60,2,1,1,0,1,0,0,3\n"
+    client.put_object(bucket, f"{storage.FEEDBACK_SHARD_PREFIX}dt=2026-10-17/hour=12/20261017T120230000000-l.csv",
+                      io.BytesIO(legacy), length=len(legacy))
+    # written around feedback_record(), as a corrupt writer would
+    corrupt = ("kaufpreis,wohnflaeche,zimmeranzahl,schlafzimmer,badezimmer,aufzug,balkon,denkmalobjekt,parkplatz,"
+               "energieeffizienzklasse,session_id\n250000,60,2,9,1,0,1,0,0,3,session-c\n").encode('utf-8')
+    client.put_object(bucket, f"{storage.FEEDBACK_SHARD_PREFIX}dt=2026-10-17/hour=12/20261017T120300000000-x.csv",
+                      io.BytesIO(corrupt), length=len(corrupt))
+
+    df_feedback = storage.get_feedback_dataframe(client, bucket=bucket)
+    df_valid, df_quarantined = storage.validate_feedback(df_feedback)
+
+    # the last price of session-a wins
+    assert list(df_valid['kaufpreis']) == [220_000, 230_000, 240_000, 250_000]
+    assert df_valid['session_id'].isna().sum() == 2
+    assert list(df_quarantined['reason']) == ["schlafzimmer not within [0, 5]"]
+
+
+def test_compact_feedback_shards_deletes_the_shards_and_keeps_the_snapshot(client, bucket):
+    shards = [_put_shard(client, bucket, _feedback(200_000 + 10_000 * minute), minutes=minute) for minute in range(3)]
+    before = storage.get_feedback_dataframe(client, bucket=bucket, with_shard=True)
+
+    snapshot = storage.compact_feedback_shards(client, bucket=bucket,
+                                               now=datetime.now(timezone.utc) + timedelta(hours=1))
+
+    assert snapshot.startswith(storage.FEEDBACK_SNAPSHOT_PREFIX) and snapshot.endswith('.parquet')
+    assert _object_names(client, bucket, storage.FEEDBACK_SHARD_PREFIX) == []
+    assert _object_names(client, bucket, storage.FEEDBACK_SNAPSHOT_PREFIX) == [snapshot]
+    after = storage.get_feedback_dataframe(client, bucket=bucket, with_shard=True)
+    assert list(after['kaufpreis']) == list(before['kaufpreis'])
+    assert list(after['shard']) == shards
+    # nothing left to compact
+    assert storage.compact_feedback_shards(client, bucket=bucket,
+                                           now=datetime.now(timezone.utc) + timedelta(hours=1)) is None
+
+
+def test_compact_feedback_shards_keeps_shards_younger_than_min_age(client, bucket):
+    shard = _put_shard(client, bucket, _feedback())
+
+    assert storage.compact_feedback_shards(client, bucket=bucket, min_age=timedelta(minutes=5)) is None
+    assert _object_names(client, bucket, storage.FEEDBACK_SHARD_PREFIX) == [shard]
+
+
+def test_get_feedback_dataframe_since_shard(client, bucket):
+    shards = [_put_shard(client, bucket, _feedback(200_000 + 10_000 * minute), minutes=minute) for minute in range(4)]
+    storage.compact_feedback_shards(client, bucket=bucket, now=datetime.now(timezone.utc) + timedelta(hours=1))
+    shards.append(_put_shard(client, bucket, _feedback(240_000), minutes=4))
+
+    # one record from the snapshot, one from the shard not compacted yet
+    df_feedback = storage.get_feedback_dataframe(client, bucket=bucket, since_shard=shards[2], with_shard=True)
+
+    assert list(df_feedback['shard']) == shards[3:]
+    assert list(df_feedback['kaufpreis']) == [230_000, 240_000]
+    assert storage.get_feedback_dataframe(client, bucket=bucket, since_shard=shards[-1]).empty
+
+
+def test_get_feedback_dataframe_since_shard_watermark_includes_late_shards(client, bucket):
+    newest = _put_shard(client, bucket, _feedback(200_000), minutes=30)
+    # lands after the newest shard was read, named by a writer with a clock 10 minutes behind
+    late = _put_shard(client, bucket, _feedback(210_000), minutes=20)
+
+    since_shard = storage.shard_watermark(newest, timedelta(hours=1))
+    df_feedback = storage.get_feedback_dataframe(client, bucket=bucket, since_shard=since_shard, with_shard=True)
+
+    assert set(df_feedback['shard']) == {newest, late}
+
+
+def test_download_object_skips_an_unchanged_object(client, bucket, tmp_path):
+    client.put_object(bucket, 'feedback.csv', io.BytesIO(b'first'), length=5)
+    file_name = str(tmp_path / 'feedback.csv')
+
+    assert storage.download_object(client, bucket, 'feedback.csv', file_name)
+    # sent with the ETag of the first download, answered with 304 Not Modified
+    assert not storage.download_object(client, bucket, 'feedback.csv', file_name)
+
+    client.put_object(bucket, 'feedback.csv', io.BytesIO(b'second'), length=6)
+    assert storage.download_object(client, bucket, 'feedback.csv', file_name, chunk_size=2)
+    with open(file_name, 'rb') as f:
+        assert f.read() == b'second'
+
+
+def test_feedback_writer_flushes_waiting_records_on_close(client, bucket):
+    writer = storage.FeedbackWriter(client, bucket=bucket, batch_size=100, max_delay=60.0)
+    for kaufpreis in (200_000, 210_000, 220_000):
+        assert writer.submit(_feedback(kaufpreis))
+
+    writer.close()
+
+    stats = writer.stats()
+    assert (stats['flushed'], stats['flushes'], stats['dropped'], stats['pending']) == (3, 1, 0, 0)
+    assert len(_object_names(client, bucket, storage.FEEDBACK_SHARD_PREFIX)) == 1
+    assert list(storage.get_feedback_dataframe(client, bucket=bucket)['kaufpreis']) == [200_000, 210_000, 220_000]
+    # closed: further records are dropped
+    assert not writer.submit(_feedback())
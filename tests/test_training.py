@@ -0,0 +1,98 @@
+"""
+Tests of training.py: incremental updates with feedback and out-of-core training against a full training
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import inference
+import storage
+import training
+
+SUBMITTED = datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc)
+
+
+def _feedback(n_records, seed) -> list:
+    """feedback records within FEEDBACK_SCHEMA, of a handful of sessions"""
+    rng = np.random.default_rng(seed)
+    records = []
+    for i in range(n_records):
+        wohnflaeche = float(rng.integers(30, 200))
+        records.append({'kaufpreis': float(np.clip(round(3_000 * wohnflaeche + rng.normal(0, 30_000), -2),
+                                                   20_000, 1_400_000)),
+                        'wohnflaeche': wohnflaeche,
+                        'zimmeranzahl': float(np.clip(round(wohnflaeche / 25 * 2) / 2, 1, 8)),
+                        'schlafzimmer': int(rng.integers(0, 4)), 'badezimmer': int(rng.integers(1, 4)),
+                        'aufzug': int(rng.integers(0, 2)), 'balkon': int(rng.integers(0, 2)),
+                        'denkmalobjekt': int(rng.integers(0, 2)), 'parkplatz': int(rng.integers(0, 2)),
+                        'energieeffizienzklasse': int(rng.integers(1, 9)), 'session_id': f'session-{seed}-{i % 7}'})
+    return records
+
+
+def _put_shards(client, bucket, records, minutes, batch_size=10):
+    """write the records in shards of batch_size, submitted from minutes after SUBMITTED on"""
+    for i, start in enumerate(range(0, len(records), batch_size)):
+        batch = [storage.feedback_record(record) for record in records[start:start + batch_size]]
+        storage.put_feedback_shard(client, batch, bucket=bucket, now=SUBMITTED + timedelta(minutes=minutes, seconds=i))
+
+
+def test_incremental_update_equals_a_full_training(df_offers, client, bucket, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = _feedback(100, seed=1)
+    _put_shards(client, bucket, first, minutes=0)
+    # the full training of "training.py -f"
+    df_feedback = storage.get_feedback_dataframe(client, bucket=bucket, with_shard=True)
+    last_feedback_shard, folded_shards = training._feedback_watermark(df_feedback['shard'])
+    df_feedback = training._validate_feedback(df_feedback)
+    statistics_file = str(tmp_path / 'stats.npz')
+    training.save_sufficient_statistics(training.compute_sufficient_statistics(df_offers, df_feedback),
+                                        last_feedback_shard, statistics_file, folded_shards,
+                                        training._session_submissions(df_feedback))
+
+    # within the lag of the watermark: new apartments, and apartments of the first feedback submitted again with
+    # another price by the same session, which replace the records included before
+    resubmitted = [dict(record, kaufpreis=record['kaufpreis'] + 50_000) for record in first[:10]]
+    _put_shards(client, bucket, _feedback(50, seed=2) + resubmitted, minutes=10)
+    regression_model = training.update_regression_model_incrementally(statistics_file, client, bucket)
+
+    df_all_feedback = training._validate_feedback(storage.get_feedback_dataframe(client, bucket=bucket))
+    assert len(df_all_feedback) == 150
+    expected = inference.compact_model_from_regression_model(training.train_regression_model(df_offers,
+                                                                                             df_all_feedback))
+    compact_model = inference.compact_model_from_regression_model(regression_model)
+    np.testing.assert_allclose(compact_model.coef, expected.coef, rtol=1e-6)
+    np.testing.assert_allclose(compact_model.intercept, expected.intercept, rtol=1e-6)
+    np.testing.assert_allclose(compact_model.imputer_means, expected.imputer_means, rtol=1e-9)
+    X, _ = training._prepare_training_data(df_offers)
+    np.testing.assert_allclose(compact_model.predict(X), expected.predict(X), rtol=1e-6)
+
+    # everything is included now
+    assert training.update_regression_model_incrementally(statistics_file, client, bucket) is None
+
+
+def test_out_of_core_training_equals_the_in_memory_training(tmp_path):
+    import pandas as pd
+    import synthetic_data
+
+    # the offers of several regions, each file read in chunks
+    paths = [str(tmp_path / f'CampusFile_Wohnungskauf_{region}.csv') for region in ('Leipzig', 'Dresden', 'Halle')]
+    for seed, path in enumerate(paths):
+        synthetic_data.write_immo24_csv(path, 7_000, seed=seed)
+    df_feedback = pd.DataFrame(_feedback(100, seed=3))
+
+    regression_model, statistics = training.train_regression_model_out_of_core(paths, keep_since_year=2007,
+                                                                               df_feedback=df_feedback,
+                                                                               chunk_size=2_000)
+
+    df_offers = pd.concat([training.load_immo24_offers_streaming(path, keep_since_year=2007) for path in paths],
+                          ignore_index=True)
+    assert statistics[-2, -2] == len(df_offers) + len(df_feedback)
+    expected = inference.compact_model_from_regression_model(training.train_regression_model(df_offers,
+                                                                                             df_feedback))
+    compact_model = inference.compact_model_from_regression_model(regression_model)
+    np.testing.assert_allclose(compact_model.coef, expected.coef, rtol=1e-6)
+    np.testing.assert_allclose(compact_model.intercept, expected.intercept, rtol=1e-6)
+    np.testing.assert_allclose(compact_model.imputer_means, expected.imputer_means, rtol=1e-9)
+    X, _ = training._prepare_training_data(df_offers)
+    np.testing.assert_allclose(compact_model.predict(X), expected.predict(X), rtol=1e-6)